@@ -0,0 +1,436 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks for the volume pipeline of the Simodont model builder
+
+Times nrrd reading/writing, compositing, mask chains, resizing, the built
+in generators and exporting on synthetic volumes of several sizes. Runs
+without a display, results are written as json so runs on different
+commits can be compared:
+
+    python benchmarks/bench.py --sizes 64 128 --output before.json
+    python benchmarks/bench.py --sizes 64 128 --compare before.json
+"""
+
+import argparse
+import copy
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tkinter as tk
+
+import numpy as np
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+ROOTDIR = os.path.dirname(BENCHDIR)
+sys.path.insert(0, ROOTDIR)
+
+# generators and layers keep their settings in Tk variables. A Tcl
+# interpreter without Tk is enough to hold them and needs no display
+tk._default_root = tk.Tcl()
+
+import smb  # noqa: E402
+import nrrd  # noqa: E402
+from PIL import Image  # noqa: E402
+
+Layer = smb.LayerSystem.Layer
+Mask = smb.LayerSystem.Mask
+LayerObject = smb.LayerSystem.LayerObject
+
+ENCODINGS = ["raw", "gzip", "bzip2"]
+BLEND_MODES = {
+    "color": ["REPLACE", "ADD", "MULTIPLY"],
+    "density": ["REPLACE", "ADD", "MULTIPLY"],
+    "iso": ["REPLACE", "ADD", "MULTIPLY"],
+    "segment": ["REPLACE", "SMART"]
+}
+# generators too slow to run on big volumes
+GENERATOR_MAX_SIZE = {"Noise": 64}
+
+
+class BenchInfo():
+    """Shape and voxel size normally held by InformationWidget"""
+
+    class Text():
+        text = "0.0002"
+
+    def __init__(self, shape):
+        self.shape = shape
+        self.voxel_size = self.Text()
+
+    def get_shape(self):
+        return self.shape
+
+    def set_shape(self, shape):
+        self.shape = tuple(shape[:3])
+
+
+class BenchViewer():
+    """Takes the place of ModelViewerWidget"""
+
+    def __init__(self):
+        self.data = {}
+
+    def push(self, data, level=0):
+        self.data = data
+
+    def get_images(self):
+        img = Image.new("RGB", (64, 64), "white")
+        return zip([img] * 3, ["axis0", "axis1", "axis2"])
+
+
+class BenchApp():
+    def __init__(self, shape):
+        self.main_iw = BenchInfo(shape)
+        self.main_mvw = BenchViewer()
+
+
+def setting(var_class, value):
+    var = var_class()
+    var.set(value)
+    return var
+
+
+class BenchLayer():
+    """Layer with the data handling of LayerSystem.Layer but no widgets"""
+
+    get_level = LayerObject.get_level
+    drop_levels = LayerObject.drop_levels
+    modify = LayerObject.modify
+    resample_targets = Layer.resample_targets
+    get_params = Layer.get_params
+    get_source = Layer.get_source
+    set_source = Layer.set_source
+    get_channel = Layer.get_channel
+    set_channel = Layer.set_channel
+
+    def __init__(self, data, composites=None, opacity=1.0):
+        self.data = data
+        self.source = dict(data)
+        self.resampled = {}
+        self.pyramid = {}
+        self.visible = True
+        self.uid = next(LayerObject.uids)
+        self.version = 0
+        composites = composites or {}
+        self.composites = {m: setting(tk.StringVar,
+                                      composites.get(m, "REPLACE"))
+                           for m in smb.TASKMODEL.modes}
+        self.opacities = {m: setting(tk.DoubleVar, opacity)
+                          for m in smb.TASKMODEL.modes}
+
+
+class BenchMask():
+    """Mask with the data handling of LayerSystem.Mask but no widgets"""
+
+    get_level = LayerObject.get_level
+    drop_levels = LayerObject.drop_levels
+    modify = LayerObject.modify
+    resample_targets = Mask.resample_targets
+    get_source = Mask.get_source
+    set_source = Mask.set_source
+    get_channel = Mask.get_channel
+    set_channel = Mask.set_channel
+
+    def __init__(self, maskdata):
+        self.maskdata = maskdata
+        self.source = maskdata
+        self.resampled = {}
+        self.pyramid = {}
+        self.visible = True
+        self.uid = next(LayerObject.uids)
+        self.version = 0
+
+
+class BenchStack():
+    """Layer stack using the compositing code of LayerSystem"""
+
+    Layer = BenchLayer
+    Mask = BenchMask
+    render = smb.LayerSystem.render
+    render_layer = smb.LayerSystem.render_layer
+    composite_onto = smb.LayerSystem.composite_onto
+    seek_masks = smb.LayerSystem.seek_masks
+    mask_chain = smb.LayerSystem.mask_chain
+    combine_masks = smb.LayerSystem.combine_masks
+    composite_slabs = smb.LayerSystem.composite_slabs
+    fixed_stack = smb.LayerSystem.fixed_stack
+    stack_keys = smb.LayerSystem.stack_keys
+    composite_layer = smb.LayerSystem.composite_layer
+    resize_all = smb.LayerSystem.resize_all
+
+    def __init__(self, layers):
+        self.layers = layers
+        self.refine_job = None
+        self.mask_cache = smb.LRUCache(smb.MASK_CACHE_BYTES)
+
+    def cancel_refine(self):
+        pass
+
+    def update_memory(self):
+        pass
+
+
+def synthetic_volume(shape, seed=0):
+    """Blocky structure with some noise, compresses roughly like real
+    models rather than like pure noise"""
+    rs = np.random.RandomState(seed)
+    idx = np.indices(shape, sparse=True)
+    pattern = sum((i // 8) * (17 * (n + 1)) for n, i in enumerate(idx))
+    noise = rs.randint(0, 4, size=shape)
+    return ((pattern + noise) % 256).astype(np.uint8)
+
+
+def synthetic_data(shape, seed=0):
+    base = synthetic_volume(shape, seed)
+    return {
+        "color": np.stack([base, 255 - base, base // 2], axis=3),
+        "density": base[:, :, :, np.newaxis],
+        "iso": base.copy(),
+        "segment": (base % 16)[:, :, :, np.newaxis]
+    }
+
+
+def synthetic_mask(shape, seed=0):
+    """Sphere filling most of the volume, soft edged"""
+    idx = np.indices(shape).astype(np.float32)
+    centre = np.array(shape, dtype=np.float32).reshape(3, 1, 1, 1) / 2
+    dist = np.sqrt(((idx - centre) ** 2).sum(axis=0)) / (min(shape) / 2)
+    return (np.clip(1.2 - dist, 0, 1) * 255).astype(np.uint8)
+
+
+class Runner():
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = []
+
+    def time(self, name, size, fn, setup=None, **params):
+        """Runs fn repeat times, setup is run untimed before each call and
+        returns the arguments for fn"""
+        times = []
+        for _ in range(self.repeat):
+            args = setup() if setup is not None else ()
+            start = time.perf_counter()
+            fn(*args)
+            times.append(time.perf_counter() - start)
+        result = {
+            "name": name,
+            "size": size,
+            "params": params,
+            "best": min(times),
+            "mean": sum(times) / len(times),
+            "repeat": self.repeat
+        }
+        self.results.append(result)
+        print("{:<28} {:>4} {:<32} {:>10.2f} ms".format(
+            name, size, format_params(params), result["best"] * 1000))
+        return result
+
+
+def format_params(params):
+    return " ".join("{}={}".format(k, v) for k, v in sorted(params.items()))
+
+
+def bench_nrrd(runner, size, shape, data, tempdir):
+    color = smb.TASKMODEL.reshape_data(data["color"])
+    for encoding in ENCODINGS:
+        path = os.path.join(tempdir, "bench_{}.nrrd".format(encoding))
+        runner.time("nrrd.write", size,
+                    lambda: nrrd.write(path, color, {"encoding": encoding}),
+                    encoding=encoding)
+        runner.time("nrrd.read", size,
+                    lambda: nrrd.read(path),
+                    encoding=encoding)
+        # a slice across the slowest axis, read through the seek index
+        runner.time("nrrd.read_slice", size,
+                    lambda: nrrd.read_slice(path, 3, shape[2] // 2),
+                    encoding=encoding)
+
+
+def bench_composite(runner, size, shape, data):
+    for mode, comps in BLEND_MODES.items():
+        for comp in comps:
+            layer = BenchLayer(data, {mode: comp})
+            old = data[mode][::-1].copy()
+            runner.time("composite_layer", size,
+                        BenchStack.composite_layer,
+                        lambda: (None, old.copy(), layer, 255, mode),
+                        mode=mode, comp=comp)
+
+
+def bench_masks(runner, size, shape, data, layer_counts):
+    for count in layer_counts:
+        masks = [BenchMask(synthetic_mask(shape, i)) for i in range(count)]
+        stack = BenchStack([BenchLayer(data)] + masks)
+        runner.time("seek_masks", size,
+                    lambda: stack.seek_masks(0),
+                    lambda: stack.mask_cache.clear() or (),
+                    masks=count)
+        runner.time("seek_masks", size,
+                    lambda: stack.seek_masks(0),
+                    masks=count, cached=True)
+
+
+def bench_render(runner, size, shape, data, layer_counts):
+    for count in layer_counts:
+        layers = [BenchLayer(synthetic_data(shape, i)) for i in range(count)]
+        stack = BenchStack(layers)
+        runner.time("render", size,
+                    stack.render,
+                    layers=count)
+
+
+def bench_resize(runner, size, shape, data, layer_counts):
+    target = tuple(n * 3 // 4 for n in shape)
+    for count in layer_counts:
+        stack = BenchStack([])
+
+        def setup():
+            # fresh layers, so nothing comes from the resample cache
+            stack.layers = [BenchLayer(dict(data)) for _ in range(count)]
+            return ()
+        smb.APP.main_iw.shape = target
+        runner.time("resize_all", size, stack.resize_all, setup,
+                    layers=count)
+    smb.APP.main_iw.shape = shape
+
+
+def bench_frame(module, shape):
+    """Generator frames are Tk widgets, which need a display. This gives
+    get_data an object with the same settings, using the generator's class
+    level defaults and the instance defaults set up by its __init__"""
+    frame_class = type("BenchFrame", (),
+                       {k: v for k, v in vars(module.MainFrame).items()
+                        if not k.startswith('__')})
+    frame = frame_class()
+    frame.shape = shape
+    frame.colour = (255, 255, 255)
+    frame.image = Image.open(os.path.join(ROOTDIR, "bitmaps", "circle.png"))
+    frame.image = frame.image.convert(mode="RGB")
+    seqdir = os.path.join(ROOTDIR, "sequences", "circlespiral")
+    frame.images = [Image.open(os.path.join(seqdir, f)).convert(mode="RGB")
+                    for f in sorted(os.listdir(seqdir))]
+    return frame
+
+
+def bench_generators(runner, size, shape):
+    shapes = smb.get_shapes_dict()
+    for gen in smb.load_generators():
+        if size > GENERATOR_MAX_SIZE.get(gen.name, size):
+            continue
+        try:
+            module = gen.load()
+        except ImportError as e:
+            print("Skipping generator {}: missing {}".format(gen.name, e.name))
+            continue
+        frame = bench_frame(module, shapes)
+        runner.time("generator.get_data", size, frame.get_data,
+                    generator=gen.name)
+
+
+def bench_export(runner, size, shape, data, tempdir):
+    smb.TASKMODEL.setup_template()
+    smb.APP.main_iw.set_shape(shape)
+    smb.TASKMODEL.update_options()
+    outdir = os.path.join(tempdir, "nrrds")
+    os.makedirs(outdir, exist_ok=True)
+    runner.time("save_nrrds", size,
+                smb.TASKMODEL.save_nrrds,
+                lambda: (copy.deepcopy(data), outdir, False))
+    zip_path = os.path.join(tempdir, "bench_model.zip")
+    runner.time("export_model", size,
+                smb.TASKMODEL.export_model,
+                lambda: (copy.deepcopy(data), zip_path))
+    # composited and written a slab at a time
+    smb.APP.layersystem = BenchStack([BenchLayer(data)])
+    runner.time("export_stack", size,
+                smb.TASKMODEL.export_stack,
+                lambda: smb.EXPORT_CACHE.clear() or (zip_path,))
+    # nothing changed since, every channel is copied from the export cache
+    runner.time("export_stack", size,
+                smb.TASKMODEL.export_stack,
+                lambda: (zip_path,),
+                cached=True)
+
+
+def git_commit():
+    try:
+        out = subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                      cwd=ROOTDIR,
+                                      stderr=subprocess.DEVNULL)
+        return out.decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, path):
+    """Prints the ratio of each best time to the one in an earlier run"""
+    with open(path) as f:
+        old = json.load(f)
+    key = lambda r: (r["name"], r["size"], format_params(r["params"]))
+    previous = {key(r): r["best"] for r in old["results"]}
+    print("\nCompared with {} ({})".format(path, old.get("commit")))
+    for r in results:
+        before = previous.get(key(r))
+        if before:
+            print("{:<28} {:>4} {:<32} {:>6.2f}x".format(
+                r["name"], r["size"], format_params(r["params"]),
+                r["best"] / before))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[64, 128, 256],
+                        help="cube edge lengths, up to 512")
+    parser.add_argument("--layers", type=int, nargs="+", default=[1, 4, 8],
+                        help="layer and mask counts for stack benchmarks")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", nargs="+",
+                        help="only run benchmarks with these names")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", help="earlier results to compare with")
+    args = parser.parse_args(argv)
+
+    smb.TASKMODEL = smb.TaskModel()
+    runner = Runner(args.repeat)
+    groups = {
+        "nrrd": lambda: bench_nrrd(runner, size, shape, data, tempdir),
+        "composite_layer": lambda: bench_composite(runner, size, shape, data),
+        "seek_masks": lambda: bench_masks(runner, size, shape, data,
+                                          args.layers),
+        "render": lambda: bench_render(runner, size, shape, data,
+                                       args.layers),
+        "resize_all": lambda: bench_resize(runner, size, shape, data,
+                                           args.layers),
+        "generators": lambda: bench_generators(runner, size, shape),
+        "export": lambda: bench_export(runner, size, shape, data, tempdir)
+    }
+    for size in args.sizes:
+        shape = (size, size, size)
+        smb.APP = BenchApp(shape)
+        data = synthetic_data(shape)
+        with tempfile.TemporaryDirectory() as tempdir:
+            for name, group in groups.items():
+                if args.only is None or name in args.only:
+                    group()
+
+    out = {
+        "commit": git_commit(),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "results": runner.results
+    }
+    with open(args.output, "w") as f:
+        json.dump(out, f, indent=1)
+    print("Results written to {}".format(args.output))
+    if args.compare:
+        compare(runner.results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
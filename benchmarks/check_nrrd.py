@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Checks of the nrrd reader and writer against numpy
+
+Writes synthetic volumes slab by slab with nrrd.write_slabs, reads them
+back whole with nrrd.read and compares random regions and slices read with
+nrrd.read_region and nrrd.read_slice against slicing of the whole. Covers
+raw, gzip written with flush points, gzip as a single stream, bzip2 and
+detached data files. Exits with an error on the first mismatch:
+
+    python benchmarks/check_nrrd.py
+"""
+
+import argparse
+import gzip
+import json
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCHDIR), "modules"))
+
+import nrrd  # noqa: E402
+
+
+def synthetic(shape, dtype, seed=0):
+    """Noise on a ramp along the last axis, so slices differ"""
+    rs = np.random.RandomState(seed)
+    ramp = np.arange(shape[-1]).reshape((1,) * (len(shape) - 1) + (-1,))
+    return (rs.randint(0, 8, size=shape) + ramp).astype(dtype)
+
+
+def random_box(rs, shape):
+    box = []
+    for n in shape:
+        start = rs.randint(0, n)
+        box.append((start, rs.randint(start + 1, n + 1)))
+    # whole axes given as None
+    box[rs.randint(0, len(shape))] = None
+    return box
+
+
+def check_equal(what, got, expected):
+    if got.shape != expected.shape or not (got == expected).all():
+        raise AssertionError("{}: got {} {}, expected {} {}".format(
+            what, got.shape, got.dtype, expected.shape, expected.dtype))
+
+
+def check_file(path, data, rs, boxes):
+    full, _ = nrrd.read(path)
+    check_equal(path + " read", full, data)
+    for _ in range(boxes):
+        box = random_box(rs, data.shape)
+        region, header = nrrd.read_region(path, box)
+        index = tuple(slice(None) if b is None else slice(*b) for b in box)
+        check_equal("{} read_region {}".format(path, box), region,
+                    data[index])
+        if list(header['sizes']) != list(region.shape):
+            raise AssertionError("{} read_region {}: header sizes {}".format(
+                path, box, header['sizes']))
+    for axis, n in enumerate(data.shape):
+        for i in (0, n // 2, n - 1):
+            piece, _ = nrrd.read_slice(path, axis, i)
+            check_equal("{} read_slice {} {}".format(path, axis, i), piece,
+                        np.take(data, i, axis=axis))
+
+
+def check_slabs(folder, rs, boxes):
+    """write_slabs round trips and region reads for every encoding, with
+    slabs small enough for several gzip flush points"""
+    for dtype in (np.uint8, ">u2", "<u2"):
+        data = synthetic((3, 20, 30, 40), dtype)
+        slab_bytes = data[..., :7].nbytes
+        for encoding in ("raw", "gzip", "bzip2"):
+            path = os.path.join(folder, "slabs_{}_{}.nrrd".format(
+                np.dtype(dtype).str[0], encoding))
+            points = nrrd.write_slabs(path, nrrd.slabs_of(data, slab_bytes),
+                                      data.shape, data.dtype,
+                                      {"encoding": encoding})
+            check_file(path, data, rs, boxes)
+            if encoding == "gzip":
+                with open(nrrd.index_path(path)) as f:
+                    index = [tuple(p) for p in json.load(f)["points"]]
+                if index[1:] != points:
+                    raise AssertionError("{} seek index {}, flush points "
+                                         "{}".format(path, index, points))
+
+
+def check_single_stream(folder, rs, boxes):
+    """Gzip data without flush points, only read from its start"""
+    data = synthetic((17, 23, 31), np.uint8, 1)
+    options = {"encoding": "gzip"}
+    nrrd._fill_options(options, data.shape, data.dtype)
+    path = os.path.join(folder, "single.nrrd")
+    with open(path, "wb") as f:
+        nrrd._write_header(f, options)
+        f.write(gzip.compress(data.tobytes(order="F")))
+    check_file(path, data, rs, boxes)
+
+
+def check_detached(folder, rs, boxes):
+    for encoding in ("raw", "gzip"):
+        data = synthetic((11, 13, 19), np.uint8, 2)
+        path = os.path.join(folder, "detached_{}.nhdr".format(encoding))
+        nrrd.write(path, data, {"encoding": encoding})
+        check_file(path, data, rs, boxes)
+
+
+def check_stale_index(folder, rs, boxes):
+    """A rewritten file gets a new seek index, which is read back from
+    INDEX_FOLDER by a later run. Nothing is added next to the file"""
+    path = os.path.join(folder, "stale", "rewritten.nrrd")
+    os.makedirs(os.path.dirname(path))
+    for seed in (3, 4):
+        data = synthetic((3, 10, 12, 30 + seed), np.uint8, seed)
+        nrrd.write_slabs(path, nrrd.slabs_of(data, data[..., :4].nbytes),
+                         data.shape, data.dtype, {"encoding": "gzip"})
+        check_file(path, data, rs, boxes)
+    nrrd._indices.clear()
+    check_file(path, data, rs, boxes)
+    if os.listdir(os.path.dirname(path)) != ["rewritten.nrrd"]:
+        raise AssertionError("files added next to {}: {}".format(
+            path, os.listdir(os.path.dirname(path))))
+
+
+def check_origin(folder):
+    """The space origin of a region is that of its first element"""
+    data = synthetic((3, 8, 9, 10), np.uint8)
+    path = os.path.join(folder, "origin.nrrd")
+    nrrd.write(path, data, {"encoding": "raw",
+                            "space": "left-posterior-superior",
+                            "space origin": [1.0, 2.0, 3.0],
+                            "space directions": ["none", [0.5, 0, 0],
+                                                 [0, 0.5, 0], [0, 0, 2.0]]})
+    _, header = nrrd.read_region(path, [None, (2, 4), (1, 9), (5, 6)])
+    if header['space origin'] != [2.0, 2.5, 13.0]:
+        raise AssertionError("region space origin {}".format(
+            header['space origin']))
+
+
+def check_errors(folder):
+    data = synthetic((4, 5, 6), np.uint8)
+    path = os.path.join(folder, "errors.nrrd")
+    bad_slabs = [[data[..., :3]], [data, data[..., :1]],
+                 [data.astype(np.uint16)], [data[:2]]]
+    for slabs in bad_slabs:
+        try:
+            nrrd.write_slabs(path, iter(slabs), data.shape, data.dtype)
+        except nrrd.NrrdError:
+            continue
+        raise AssertionError("write_slabs accepted slabs of shapes {}".format(
+            [s.shape for s in slabs]))
+    nrrd.write(path, data, {"encoding": "raw"})
+    for box in ([(0, 5), None, None], [None, (2, 2), None], [None, None]):
+        try:
+            nrrd.read_region(path, box)
+        except nrrd.NrrdError:
+            continue
+        raise AssertionError("read_region accepted box {}".format(box))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--boxes", type=int, default=25,
+                        help="random regions read per file")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    rs = np.random.RandomState(args.seed)
+    with tempfile.TemporaryDirectory() as folder:
+        nrrd.INDEX_FOLDER = os.path.join(folder, "index")
+        check_slabs(folder, rs, args.boxes)
+        check_single_stream(folder, rs, args.boxes)
+        check_detached(folder, rs, args.boxes)
+        check_stale_index(folder, rs, args.boxes)
+        check_origin(folder)
+        check_errors(folder)
+    print("nrrd checks passed")
+
+
+if __name__ == "__main__":
+    main()
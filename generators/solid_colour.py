@@ -8,6 +8,12 @@ Created on Mon Feb 20 19:42:00 2017
 import tkinter as tk
 from tkinter import colorchooser
 import numpy as np
+try:
+    # holds one value instead of a full volume
+    from constant import ConstantVolume as full
+except ImportError:
+    # run on its own, without the model builder's modules
+    full = np.full
 GENERATOR_NAME = "Solid"
 GENERATOR_DESCRIPTION = "Generates a single value for each mode across the model"
 
@@ -47,7 +53,7 @@ class MainFrame(tk.Frame):
 
     def get_data(self):
         data = {}
-        data['color'] = np.full(self.shape['color'], self.colour, dtype=np.uint8)
+        data['color'] = full(self.shape['color'], self.colour, dtype=np.uint8)
 
         try:
             denval = capnbit(self.denvar.get(), 8)
@@ -55,8 +61,8 @@ class MainFrame(tk.Frame):
             print("density error")
             denval = 0
 
-        data['density'] = np.full(self.shape['density'], denval, dtype=np.uint8)
-        data['iso'] = np.full(self.shape['iso'], denval, dtype=np.uint8)
+        data['density'] = full(self.shape['density'], denval, dtype=np.uint8)
+        data['iso'] = full(self.shape['iso'], denval, dtype=np.uint8)
 
         try:
             segval = capnbit(self.segvar.get(), 4)
@@ -64,7 +70,7 @@ class MainFrame(tk.Frame):
             print("segment error")
             segval = 1
 
-        data['segment'] = np.full(self.shape['segment'], segval, dtype=np.uint8)
+        data['segment'] = full(self.shape['segment'], segval, dtype=np.uint8)
         #print(data['segment'])
         return data
 
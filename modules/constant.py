@@ -0,0 +1,94 @@
+"""
+Volumes holding the same value everywhere, stored as that value only.
+The value covers the trailing (channel) axes, so a colour volume keeps one
+rgb triple.
+
+Numpy operations between constant volumes and scalars give constant
+volumes again. Anything else fills in the full volume first
+"""
+
+import numpy as np
+from numpy.lib.mixins import NDArrayOperatorsMixin
+
+
+class ConstantVolume(NDArrayOperatorsMixin):
+    """Takes the same arguments as np.full"""
+
+    def __init__(self, shape, value, dtype=None):
+        self.shape = tuple(shape)
+        value = np.asarray(value, dtype)
+        # a single value for every channel
+        self.value = np.array(np.broadcast_to(value, self.shape[3:]))
+        self.dtype = self.value.dtype
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        out = np.empty(self.shape, self.dtype if dtype is None else dtype)
+        out[...] = self.value
+        return out
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        constant = (method == "__call__" and "out" not in kwargs and
+                    all(np.ndim(i) == 0 or
+                        (is_constant(i) and i.shape == self.shape)
+                        for i in inputs))
+        if constant:
+            values = [i.value if is_constant(i) else i for i in inputs]
+            return ConstantVolume(self.shape, ufunc(*values, **kwargs))
+        if any(is_constant(o) for o in kwargs.get("out", ())):
+            raise TypeError("ConstantVolume is read only")
+        inputs = [np.asarray(i) if is_constant(i) else i for i in inputs]
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def __getitem__(self, index):
+        return np.asarray(self)[index]
+
+    def astype(self, dtype):
+        return ConstantVolume(self.shape, self.value, dtype)
+
+    def tolist(self):
+        return np.asarray(self).tolist()
+
+    def squeeze(self):
+        """Drops the channel axes of length one, the spatial axes stay"""
+        shape = self.shape[:3] + tuple(n for n in self.shape[3:] if n != 1)
+        return ConstantVolume(shape, self.value.reshape(shape[3:]))
+
+    def resized(self, shape):
+        return ConstantVolume(shape, self.value)
+
+    def downsample(self):
+        shape = tuple((n + 1) // 2 for n in self.shape[:3]) + self.shape[3:]
+        return self.resized(shape)
+
+
+def constant_of(data):
+    """Returns data as a ConstantVolume if every voxel holds the same
+    value, otherwise data itself"""
+    if not isinstance(data, np.ndarray) or data.ndim < 3 or data.size == 0:
+        return data
+    value = data[0, 0, 0]
+    # most volumes are ruled out by a coarse look
+    if not (data[::7, ::7, ::7] == value).all():
+        return data
+    if not (data == value).all():
+        return data
+    return ConstantVolume(data.shape, value)
+
+
+def is_constant(data):
+    return isinstance(data, ConstantVolume)
@@ -0,0 +1,85 @@
+"""
+Encoded nrrd files kept from earlier exports, so a channel that did not
+change since is copied instead of encoded again. Files are keyed by
+whatever the caller derives from the channel's content, and live in a
+folder removed when the program exits
+"""
+
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+import scratch
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        # deleted from outside, nothing left to free
+        pass
+
+
+class ExportCache():
+    """Folder of encoded files created on first use in parent, the least
+    recently used ones deleted past maxbytes. Safe to use from several
+    threads"""
+
+    def __init__(self, parent, maxbytes):
+        self.parent = parent
+        self.maxbytes = maxbytes
+        self.folder = None
+        self.files = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def remove_stale(self):
+        """Removes the folders sessions that did not exit normally left in
+        parent. Those of running sessions are kept"""
+        scratch.remove_stale(self.parent, "export_")
+
+    def get_folder(self):
+        if self.folder is None:
+            self.folder = scratch.make_folder(self.parent, "export_")
+        return self.folder
+
+    def fetch(self, key, target):
+        """Copies the file kept for key to target, returns False if there
+        is none"""
+        with self.lock:
+            if key not in self.files:
+                return False
+            path = os.path.join(self.folder, key)
+            if not os.path.isfile(path):
+                # deleted from outside, forget it
+                self.nbytes -= self.files.pop(key)
+                return False
+            self.files.move_to_end(key)
+            # copied under the lock, so it is not evicted half way
+            shutil.copyfile(path, target)
+        return True
+
+    def store(self, key, source):
+        """Keeps a copy of the file at source for key"""
+        size = os.path.getsize(source)
+        if size > self.maxbytes:
+            return
+        with self.lock:
+            path = os.path.join(self.get_folder(), key)
+            shutil.copyfile(source, path)
+            if key in self.files:
+                self.nbytes -= self.files.pop(key)
+            self.files[key] = size
+            self.nbytes += size
+            while self.nbytes > self.maxbytes:
+                old, oldsize = self.files.popitem(last=False)
+                self.nbytes -= oldsize
+                _remove(os.path.join(self.folder, old))
+
+    def clear(self):
+        with self.lock:
+            for key in self.files:
+                _remove(os.path.join(self.folder, key))
+            self.files.clear()
+            self.nbytes = 0
@@ -0,0 +1,207 @@
+"""
+Undo and redo history. A step is a pair of functions, one undoing and one
+redoing a change, plus the bytes it keeps alive. Data changes are stored
+as compressed XOR deltas against the data they were applied to
+"""
+
+import time
+import zlib
+from collections import deque
+
+import numpy as np
+
+# slices along the first axis compressed at a time
+SLAB_SLICES = 16
+
+
+class Delta():
+    """Difference between two arrays of the same shape. XOR with the new
+    data gives the old data and the other way round. Slabs that differ by
+    the same value everywhere (an inverted channel for example) are stored
+    as just that value, others are compressed"""
+
+    def __init__(self, old, new):
+        old, new = np.asarray(old), np.asarray(new)
+        self.shape = old.shape
+        self.slabs = []
+        for i in range(0, self.shape[0], SLAB_SLICES):
+            x = np.bitwise_xor(old[i:i + SLAB_SLICES], new[i:i + SLAB_SLICES])
+            first = x.flat[0] if x.size else 0
+            if (x == first).all():
+                self.slabs.append(first)
+            else:
+                self.slabs.append(zlib.compress(x.tobytes(), 1))
+        self.nbytes = sum(len(s) if isinstance(s, bytes) else 1
+                          for s in self.slabs)
+
+    def apply(self, data):
+        data = np.asarray(data)
+        out = np.empty_like(data)
+        for n, slab in enumerate(self.slabs):
+            i = n * SLAB_SLICES
+            part = data[i:i + SLAB_SLICES]
+            if isinstance(slab, bytes):
+                slab = np.frombuffer(zlib.decompress(slab),
+                                     data.dtype).reshape(part.shape)
+            np.bitwise_xor(part, slab, out=out[i:i + SLAB_SLICES])
+        return out
+
+    # xor is its own inverse
+    undo = redo = apply
+
+
+class Replace():
+    """Change that can't be stored as a delta (a new shape or type), kept
+    as the old and new values"""
+
+    def __init__(self, old, new):
+        self.old, self.new = old, new
+        self.nbytes = sum(x.nbytes for x in (old, new)
+                          if isinstance(x, np.ndarray))
+
+    def undo(self, data):
+        return self.old
+
+    def redo(self, data):
+        return self.new
+
+
+def diff(old, new):
+    """Smallest record of the change from old to new"""
+    if (np.ndim(old) > 0 and np.shape(old) == np.shape(new) and
+            old.dtype == new.dtype and old.dtype.kind in "biu"):
+        return Delta(old, new)
+    return Replace(old, new)
+
+
+class Step():
+    """A change that can be undone and redone. drop is called once the
+    step is forgotten, to free anything kept alive for it"""
+
+    def __init__(self, name, undo, redo, nbytes=0, merge_key=None,
+                 drop=None):
+        self.name = name
+        self.undo = undo
+        self.redo = redo
+        self.nbytes = nbytes
+        self.merge_key = merge_key
+        self.drop = drop
+        self.time = time.monotonic()
+
+    def forget(self):
+        if self.drop is not None:
+            self.drop()
+
+
+class History():
+    """Undo and redo stacks. The oldest steps are dropped once the steps
+    kept take more than maxbytes"""
+
+    # steps with the same merge key this close together become one, so
+    # dragging a slider is undone in one go
+    MERGE_SECONDS = 1.0
+
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.undo_steps = deque()
+        self.redo_steps = []
+        self.nbytes = 0
+        # set while a step is being undone or redone, nothing is recorded
+        self.applying = False
+        self.groups = []
+
+    def record(self, name, undo, redo, nbytes=0, merge_key=None,
+               drop=None):
+        if self.applying:
+            return
+        step = Step(name, undo, redo, nbytes, merge_key, drop)
+        if self.groups:
+            self.groups[-1].append(step)
+            return
+        self.push(step)
+
+    def push(self, step):
+        top = self.undo_steps[-1] if self.undo_steps else None
+        if (step.merge_key is not None and top is not None and
+                not self.redo_steps and
+                top.merge_key == step.merge_key and
+                step.time - top.time < self.MERGE_SECONDS):
+            top.redo = step.redo
+            top.time = step.time
+            return
+        self.clear_redo()
+        self.undo_steps.append(step)
+        self.nbytes += step.nbytes
+        self.evict()
+
+    def begin(self):
+        """Collects the steps recorded until end into one"""
+        self.groups.append([])
+
+    def end(self, name):
+        steps = self.groups.pop()
+        if not steps:
+            return
+        if len(steps) == 1:
+            step = steps[0]
+            step.name = name
+        else:
+            def undo():
+                for s in reversed(steps):
+                    s.undo()
+
+            def redo():
+                for s in steps:
+                    s.redo()
+            def drop():
+                for s in steps:
+                    s.forget()
+            step = Step(name, undo, redo, sum(s.nbytes for s in steps),
+                        drop=drop)
+        if self.groups:
+            self.groups[-1].append(step)
+        else:
+            self.push(step)
+
+    def evict(self):
+        while self.undo_steps and self.nbytes > self.maxbytes:
+            step = self.undo_steps.popleft()
+            self.nbytes -= step.nbytes
+            step.forget()
+
+    def clear_redo(self):
+        for step in self.redo_steps:
+            self.nbytes -= step.nbytes
+            step.forget()
+        self.redo_steps = []
+
+    def clear(self):
+        for step in list(self.undo_steps) + self.redo_steps:
+            step.forget()
+        self.undo_steps.clear()
+        self.redo_steps = []
+        self.nbytes = 0
+
+    def undo(self):
+        """Undoes the last step, returning its name or None"""
+        if not self.undo_steps:
+            return None
+        step = self.undo_steps.pop()
+        self.apply(step.undo)
+        self.redo_steps.append(step)
+        return step.name
+
+    def redo(self):
+        if not self.redo_steps:
+            return None
+        step = self.redo_steps.pop()
+        self.apply(step.redo)
+        self.undo_steps.append(step)
+        return step.name
+
+    def apply(self, func):
+        self.applying = True
+        try:
+            func()
+        finally:
+            self.applying = False
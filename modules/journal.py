@@ -0,0 +1,185 @@
+"""
+Autosave journal. Checkpoints of the layer stack are appended to a single
+file by a worker thread, so saving never holds up the caller. Each
+checkpoint holds the layer settings plus the channels that changed since
+the one before, channels that did not change are referred to by id.
+
+Records are a fixed header (kind, header length, payload length), a json
+header and a payload. A record cut short by a crash is ignored on
+recovery, the last complete checkpoint wins
+"""
+
+import json
+import os
+import queue
+import struct
+import threading
+import zlib
+
+import numpy as np
+
+import constant
+
+RECORD = struct.Struct("<4sII")
+BLOB, STATE = b"BLOB", b"STAT"
+# the file is rewritten with only the live channels once it is this many
+# times bigger than them
+COMPACT_RATIO = 3
+COMPACT_MIN_BYTES = 64 * 2**20
+# slices along the first axis compressed at a time
+SLAB_SLICES = 16
+
+
+def encode(data):
+    """Header and payload of a channel. Constant volumes are stored as
+    their value only"""
+    if constant.is_constant(data):
+        return {"shape": data.shape, "dtype": data.dtype.str,
+                "fill": data.value.tolist()}, b""
+    data = np.asarray(data)
+    comp = zlib.compressobj(1)
+    parts = [comp.compress(np.ascontiguousarray(data[i:i + SLAB_SLICES]))
+             for i in range(0, len(data), SLAB_SLICES)]
+    parts.append(comp.flush())
+    return {"shape": data.shape, "dtype": data.dtype.str}, b"".join(parts)
+
+
+def decode(header, payload):
+    shape, dtype = tuple(header["shape"]), np.dtype(header["dtype"])
+    if "fill" in header:
+        return constant.ConstantVolume(shape, header["fill"], dtype)
+    data = np.frombuffer(zlib.decompress(payload), dtype)
+    return data.reshape(shape).copy()
+
+
+def read_records(f):
+    """Yields (kind, header, payload offset, payload length) of every
+    complete record"""
+    while True:
+        head = f.read(RECORD.size)
+        if len(head) < RECORD.size:
+            return
+        kind, hlen, plen = RECORD.unpack(head)
+        raw = f.read(hlen)
+        offset = f.tell()
+        f.seek(plen, os.SEEK_CUR)
+        if len(raw) < hlen or f.tell() > os.fstat(f.fileno()).st_size:
+            return
+        try:
+            header = json.loads(raw.decode("utf-8"))
+        except ValueError:
+            return
+        yield kind, header, offset, plen
+
+
+def recover(path):
+    """Returns (state, channels by id) of the last complete checkpoint in
+    the journal at path, or None if there is nothing to recover"""
+    if not os.path.isfile(path):
+        return None
+    blobs, last = {}, None
+    with open(path, "rb") as f:
+        for kind, header, offset, plen in read_records(f):
+            if kind == BLOB:
+                blobs[header["id"]] = (header, offset, plen)
+            elif kind == STATE:
+                last = header
+        if last is None:
+            return None
+        channels = {}
+        for blobid in last["blobs"]:
+            header, offset, plen = blobs[blobid]
+            f.seek(offset)
+            channels[blobid] = decode(header, f.read(plen))
+    return last["state"], channels
+
+
+class Journal():
+    """Append only journal at path, written by its own thread. Any
+    journal left there before is replaced"""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    @property
+    def busy(self):
+        return self.jobs.unfinished_tasks > 0
+
+    def checkpoint(self, state, channels):
+        """Queues a checkpoint. channels maps blob ids to arrays, only the
+        ids not already in the file are written. The arrays must not be
+        changed in place afterwards"""
+        self.jobs.put((state, channels))
+
+    def close(self, remove=True):
+        """Waits for queued checkpoints, then removes the journal"""
+        self.jobs.put(None)
+        self.thread.join()
+        if remove and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def run(self):
+        # blob id -> (record offset, record length) in the file
+        index = {}
+        f = open(self.path, "w+b")
+        try:
+            while True:
+                job = self.jobs.get()
+                try:
+                    if job is None:
+                        return
+                    state, channels = job
+                    live = list(channels)
+                    for blobid, data in channels.items():
+                        if blobid in index:
+                            continue
+                        header, payload = encode(data)
+                        header["id"] = blobid
+                        index[blobid] = self.append(f, BLOB, header, payload)
+                    self.append(f, STATE, {"state": state, "blobs": live})
+                    f.flush()
+                    os.fsync(f.fileno())
+                    livebytes = sum(index[k][1] for k in live)
+                    if f.tell() > max(COMPACT_MIN_BYTES,
+                                      COMPACT_RATIO * livebytes):
+                        f, index = self.compact(f, index, state, live)
+                except Exception as e:
+                    # autosave failing must not stop the program
+                    print("Autosave failed: {}".format(e))
+                finally:
+                    self.jobs.task_done()
+        finally:
+            f.close()
+
+    @staticmethod
+    def append(f, kind, header, payload=b""):
+        raw = json.dumps(header).encode("utf-8")
+        start = f.tell()
+        f.write(RECORD.pack(kind, len(raw), len(payload)))
+        f.write(raw)
+        f.write(payload)
+        return start, f.tell() - start
+
+    def compact(self, f, index, state, live):
+        """Rewrites the journal with only the live channels and the
+        latest checkpoint"""
+        temp = self.path + ".new"
+        newindex = {}
+        with open(temp, "wb") as out:
+            for blobid in live:
+                start, length = index[blobid]
+                f.seek(start)
+                newindex[blobid] = (out.tell(), length)
+                out.write(f.read(length))
+            self.append(out, STATE, {"state": state, "blobs": live})
+            out.flush()
+            os.fsync(out.fileno())
+        f.close()
+        os.replace(temp, self.path)
+        f = open(self.path, "r+b")
+        f.seek(0, os.SEEK_END)
+        return f, newindex
@@ -0,0 +1,25 @@
+"""
+Deferred imports for heavy modules, so they are only loaded the first time
+one of their attributes is used
+"""
+
+import importlib.util
+import sys
+
+
+def lazy_import(name):
+    """Returns a module object for name without executing it. The real
+    import happens on first attribute access"""
+    try:
+        return sys.modules[name]
+    except KeyError:
+        pass
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError("No module named '{}'".format(name), name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
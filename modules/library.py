@@ -0,0 +1,198 @@
+"""
+Index of the models found in a set of folders. Metadata and a thumbnail
+of every model are cached in a json file, and a refresh only reads the
+models whose files have changed since they were last indexed
+"""
+
+import base64
+import io
+import json
+import os
+import re
+import zipfile
+
+import numpy as np
+
+import nrrd
+from lazy import lazy_import
+
+Image = lazy_import("PIL.Image")
+
+THUMBNAIL_SIZE = (64, 64)
+
+# <mode>_data/<file>.nrrd inside a model
+_NRRD_MEMBER = re.compile(r'(\w+)_data/[^/]+\.nrrd$')
+
+
+class ModelSource():
+    """Read access to the files of a model stored as a .zip or a folder"""
+
+    def __init__(self, path):
+        self.path = path
+        self.is_zip = path.lower().endswith('.zip')
+
+    def files(self):
+        """Returns a dictionary of relative path: size in bytes"""
+        if self.is_zip:
+            with zipfile.ZipFile(self.path) as zf:
+                return {i.filename: i.file_size for i in zf.infolist()
+                        if not i.is_dir()}
+        files = {}
+        for dirpath, _, filenames in os.walk(self.path):
+            for f in filenames:
+                full = os.path.join(dirpath, f)
+                rel = os.path.relpath(full, self.path).replace(os.sep, '/')
+                files[rel] = os.path.getsize(full)
+        return files
+
+    def stamp(self):
+        """Changes whenever any file of the model changes"""
+        if self.is_zip:
+            st = os.stat(self.path)
+            return [st.st_mtime, st.st_size]
+        latest, total, count = 0, 0, 0
+        for dirpath, _, filenames in os.walk(self.path):
+            for f in filenames:
+                st = os.stat(os.path.join(dirpath, f))
+                latest = max(latest, st.st_mtime)
+                total += st.st_size
+                count += 1
+        return [latest, total, count]
+
+    def __enter__(self):
+        self.zf = zipfile.ZipFile(self.path) if self.is_zip else None
+        return self
+
+    def __exit__(self, *args):
+        if self.zf is not None:
+            self.zf.close()
+
+    def open(self, rel):
+        if self.zf is not None:
+            return self.zf.open(rel)
+        return open(os.path.join(self.path, rel), 'rb')
+
+
+class ModelLibrary():
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.cache_path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            with open(self.cache_path, 'w') as f:
+                json.dump(self.entries, f)
+        except OSError as e:
+            print("Could not save model library: {}".format(e))
+
+    def refresh(self, folders):
+        """Scans folders for model .zips and model folders, indexing only
+        the ones that are new or have changed. Returns the entries of every
+        model found, sorted by path. Paths that are not models are kept as
+        failed entries, so they are skipped until they change"""
+        seen, changed = [], False
+        for folder in folders:
+            if not os.path.isdir(folder):
+                continue
+            for f in sorted(os.listdir(folder)):
+                path = os.path.normpath(os.path.join(folder, f))
+                if not (f.lower().endswith('.zip') or os.path.isdir(path)):
+                    continue
+                source = ModelSource(path)
+                stamp = source.stamp()
+                entry = self.entries.get(path)
+                if entry is None or entry['stamp'] != stamp:
+                    try:
+                        with source:
+                            entry = self.index(source)
+                    except (OSError, ValueError, KeyError,
+                            zipfile.BadZipFile, nrrd.NrrdError) as e:
+                        print("Could not index model {}: {}".format(path, e))
+                        entry = {"path": path, "error": str(e)}
+                    entry['stamp'] = stamp
+                    self.entries[path] = entry
+                    changed = True
+                seen.append(path)
+
+        for path in list(self.entries):
+            if path not in seen:
+                del self.entries[path]
+                changed = True
+        if changed:
+            self.save()
+        return [self.entries[p] for p in sorted(seen)
+                if "error" not in self.entries[p]]
+
+    def index(self, source):
+        """Reads the metadata of a single model"""
+        files = source.files()
+        entry = {
+            "path": source.path,
+            "name": os.path.splitext(os.path.basename(source.path))[0],
+            "size": sum(files.values()),
+            "channels": {},
+            "segments": [],
+            "thumbnail": None
+        }
+        members = {}
+        for rel in files:
+            match = _NRRD_MEMBER.search(rel)
+            if match:
+                members[match.group(1)] = rel
+            elif rel.endswith('screenshot.png'):
+                with source.open(rel) as f:
+                    entry["thumbnail"] = make_thumbnail(Image.open(f))
+
+        if 'iso' not in members:
+            raise KeyError("No iso channel found")
+
+        for mode, rel in members.items():
+            with source.open(rel) as f:
+                header = nrrd.read_header(f)
+                entry["channels"][mode] = {
+                    k: header.get(k) for k in
+                    ('sizes', 'spacings', 'type', 'encoding')}
+                if mode == 'segment':
+                    data = nrrd.read_data(header, f)
+                    entry["segments"] = used_segments(data)
+                elif mode == 'color' and entry["thumbnail"] is None:
+                    data = nrrd.read_data(header, f)
+                    entry["thumbnail"] = make_thumbnail(middle_slice(data))
+
+        iso = entry["channels"]['iso']
+        entry["shape"] = list(reversed(iso['sizes']))[:3]
+        entry["spacing"] = iso['spacings'][-1]
+        return entry
+
+
+def used_segments(data):
+    """Segments are stored as powers of two"""
+    values = np.unique(data)
+    return [int(v).bit_length() - 1 for v in values if v > 0]
+
+
+def middle_slice(data):
+    """Image of the middle top view slice of raw (channel first) colour
+    data"""
+    mid = data.shape[-1] // 2
+    rgb = np.ascontiguousarray(data[:, :, :, mid].transpose((2, 1, 0)))
+    return Image.fromarray(rgb.astype(np.uint8), 'RGB')
+
+
+def make_thumbnail(img):
+    """Returns a small png of img, base64 encoded"""
+    img = img.convert('RGB')
+    img.thumbnail(THUMBNAIL_SIZE)
+    out = io.BytesIO()
+    img.save(out, 'PNG')
+    return base64.b64encode(out.getvalue()).decode('ascii')
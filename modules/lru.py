@@ -0,0 +1,59 @@
+"""
+Least recently used cache with a memory cap
+"""
+
+from collections import OrderedDict
+
+
+class LRUCache():
+    """Keeps items until the combined size of everything stored goes over
+    maxbytes, then evicts the least recently used ones. Sizes are given by
+    the caller when an item is stored"""
+
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.items = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        try:
+            value, _ = self.items[key]
+        except KeyError:
+            return default
+        self.items.move_to_end(key)
+        return value
+
+    def put(self, key, value, size):
+        self.pop(key)
+        # never worth keeping something bigger than the whole cache
+        if size > self.maxbytes:
+            return
+        self.items[key] = (value, size)
+        self.nbytes += size
+        self.evict()
+
+    def pop(self, key, default=None):
+        try:
+            value, size = self.items.pop(key)
+        except KeyError:
+            return default
+        self.nbytes -= size
+        return value
+
+    def evict(self, maxbytes=None):
+        """Drops least recently used items until under maxbytes"""
+        if maxbytes is None:
+            maxbytes = self.maxbytes
+        while self.items and self.nbytes > maxbytes:
+            _, (_, size) = self.items.popitem(last=False)
+            self.nbytes -= size
+
+    def clear(self):
+        self.items.clear()
+        self.nbytes = 0
@@ -11,6 +11,10 @@ Copyright (c) 2011-2017 Maarten Everts and others. See LICENSE and AUTHORS.
 
 import zlib
 import bz2
+import bisect
+import hashlib
+import io
+import json
 import os
 from datetime import datetime
 
@@ -21,6 +25,16 @@ import numpy as np
 # further. The following two values define the size of the chunks.
 _READ_CHUNKSIZE = 2**20
 _WRITE_CHUNKSIZE = 2**20
+# data is converted to fortran order this much at a time when writing
+_WRITE_SLABSIZE = 16 * 2**20
+# gzip data is decompressed at most this much at a time when reading a region
+_READ_MAXOUT = 16 * 2**20
+# folder seek indices of gzip data are cached in, keyed by the path of the
+# data file. With None they are only kept until the program exits
+INDEX_FOLDER = None
+_INDEX_VERSION = 1
+# path: (stamp, points) of the seek indices built or read so far
+_indices = {}
 
 class NrrdError(Exception):
     """Exceptions for Nrrd class."""
@@ -245,7 +259,11 @@ def read_data(fields, filehandle, filename=None):
 
     if fields['encoding'] == 'raw':
         datafilehandle.seek(byteskip, os.SEEK_CUR)
-        data = np.fromfile(datafilehandle, dtype)
+        try:
+            data = np.fromfile(datafilehandle, dtype)
+        except io.UnsupportedOperation:
+            # not a real file, e.g. a member of a zip archive
+            data = np.frombuffer(datafilehandle.read(), dtype)
     else:
         # Probably the data is compressed then
         if fields['encoding'] == 'gzip' or\
@@ -264,7 +282,7 @@ def read_data(fields, filehandle, filename=None):
                 break
             decompressed_data += decompobj.decompress(chunk)
         # byteskip applies to the _decompressed_ byte stream
-        data = np.fromstring(decompressed_data[byteskip:], dtype)
+        data = np.frombuffer(decompressed_data[byteskip:], dtype)
 
     if datafilehandle:
         datafilehandle.close()
@@ -372,6 +390,13 @@ def read_header(nrrdfile):
     return header
 
 
+def read_header_only(filename):
+    """Read only the header of a nrrd file. Parsing stops at the blank line
+    separating it from the data, so nothing is decompressed."""
+    with open(filename, 'rb') as filehandle:
+        return read_header(filehandle)
+
+
 def read(filename):
     """Read a nrrd file and return a tuple (data, header)."""
     with open(filename, 'rb') as filehandle:
@@ -380,6 +405,311 @@ def read(filename):
         return (data, header)
 
 
+def _check_box(fields, box):
+    """box as a (start, stop) pair per axis, None standing for the whole
+    axis"""
+    sizes = list(fields['sizes'])
+    if len(box) != len(sizes):
+        raise NrrdError('Region has %d axes, the data %d' % (len(box), len(sizes)))
+    checked = []
+    for axis_box, size in zip(box, sizes):
+        start, stop = (0, size) if axis_box is None else map(int, axis_box)
+        if not 0 <= start < stop <= size:
+            raise NrrdError('Region %s outside of sizes %s' % (box, sizes))
+        checked.append((start, stop))
+    return checked
+
+
+def _data_file(fields, filehandle, filename):
+    """(file handle, file name) of the data, a new file for detached
+    headers"""
+    datafile = fields.get('datafile', fields.get('data file', None))
+    if datafile is None:
+        return filehandle, filename
+    if not os.path.isabs(datafile):
+        datafile = os.path.join(os.path.dirname(filename), datafile)
+    return open(datafile, 'rb'), datafile
+
+
+def _region_spans(sizes, box, itemsize):
+    """(start, stop) byte offsets in the data of each slice of box along
+    the last axis, from its first to its last element in that slice"""
+    strides = [itemsize * int(n) for n in np.cumprod([1] + list(sizes[:-1]))]
+    first = sum(start * s for (start, _), s in zip(box[:-1], strides))
+    last = sum((stop - 1) * s for (_, stop), s in zip(box[:-1], strides))
+    start, stop = box[-1]
+    for k in range(start, stop):
+        yield k * strides[-1] + first, k * strides[-1] + last + itemsize
+
+
+def _read_spans(fields, box, read_span):
+    """The data inside box, taken out of the span of each of its slices
+    read by read_span(start, stop)"""
+    dtype = _determine_dtype(fields)
+    sizes = list(fields['sizes'])
+    extents = [stop - start for start, stop in box]
+    strides = [dtype.itemsize * int(n) for n in np.cumprod([1] + sizes[:-2])]
+    data = np.empty(extents, dtype, order='F')
+    for k, (start, stop) in enumerate(_region_spans(sizes, box, dtype.itemsize)):
+        span = np.frombuffer(read_span(start, stop), dtype)
+        data[..., k] = np.lib.stride_tricks.as_strided(
+            span, shape=extents[:-1], strides=strides[:len(extents) - 1])
+    return data
+
+
+def _inflate(decompobj, data):
+    """Decompresses data in pieces of at most _READ_MAXOUT bytes"""
+    while not decompobj.eof:
+        out = decompobj.decompress(data, _READ_MAXOUT)
+        if out:
+            yield out
+        data = decompobj.unconsumed_tail
+        # a full piece may leave output behind even with no input left
+        if not data and len(out) < _READ_MAXOUT:
+            return
+
+
+def _build_gzip_index(filehandle, offset):
+    """Points gzip data starting at offset can be decompressed from, as
+    (raw offset, compressed offset relative to offset) pairs. The start is
+    one, the others are full flushes (see _write_slabs), which are found by
+    decompressing all of the data once. A full flush ends in an empty
+    stored block (00 00 ff ff), nothing after it refers back to the data
+    before. Every such marker is checked by decompressing from there on
+    its own up to the next one, which must give the same data"""
+    filehandle.seek(offset)
+    marker = b'\x00\x00\xff\xff'
+    main = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    points = [(0, 0)]
+    raw, fed = 0, 0
+    # candidate being checked: [point, decompressor, ok, crc and length of
+    # its output, crc and length of the main output since the point]
+    trial = None
+
+    def feed(data):
+        nonlocal raw, fed
+        fed += len(data)
+        for out in _inflate(main, data):
+            raw += len(out)
+            if trial is not None:
+                trial[5] = zlib.crc32(out, trial[5])
+                trial[6] += len(out)
+        if trial is not None and trial[2]:
+            try:
+                for out in _inflate(trial[1], data):
+                    trial[3] = zlib.crc32(out, trial[3])
+                    trial[4] += len(out)
+            except zlib.error:
+                trial[2] = False
+
+    def settle():
+        if (trial is not None and trial[2] and trial[3:5] == trial[5:7] and
+                trial[0][0] > points[-1][0]):
+            points.append(trial[0])
+
+    tail = b''
+    while not main.eof:
+        chunk = filehandle.read(_READ_CHUNKSIZE)
+        if not chunk:
+            break
+        data = tail + chunk
+        done = 0
+        found = data.find(marker)
+        while found != -1:
+            # end of the marker, within chunk as tail is shorter than it
+            end = found + len(marker) - len(tail)
+            feed(chunk[done:end])
+            done = end
+            settle()
+            trial = None
+            if not main.eof:
+                trial = [(raw, fed), zlib.decompressobj(-zlib.MAX_WBITS),
+                         True, 0, 0, 0, 0]
+            found = data.find(marker, found + 1)
+        feed(chunk[done:])
+        tail = data[-(len(marker) - 1):]
+    settle()
+    return points
+
+
+def index_path(datafilename):
+    """File in INDEX_FOLDER the seek index of a data file is cached in"""
+    key = os.path.normcase(os.path.abspath(datafilename))
+    name = hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json'
+    return os.path.join(INDEX_FOLDER, name)
+
+
+def _gzip_index(filehandle, offset, datafilename):
+    """Seek index of the gzip data at offset, see _build_gzip_index. It is
+    built once and kept until the file changes, in INDEX_FOLDER if set so
+    nothing is added next to the data"""
+    key = os.path.normcase(os.path.abspath(datafilename))
+    st = os.fstat(filehandle.fileno())
+    stamp = [st.st_size, st.st_mtime_ns, offset]
+    known = _indices.get(key)
+    if known is not None and known[0] == stamp:
+        return known[1]
+    path = None if INDEX_FOLDER is None else index_path(datafilename)
+    points = None
+    if path is not None:
+        try:
+            with open(path) as indexfile:
+                index = json.load(indexfile)
+            if (index['version'] == _INDEX_VERSION and
+                    index['stamp'] == stamp):
+                points = [tuple(point) for point in index['points']]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    if points is None:
+        points = _build_gzip_index(filehandle, offset)
+        if path is not None:
+            try:
+                os.makedirs(INDEX_FOLDER, exist_ok=True)
+                with open(path + '.tmp', 'w') as indexfile:
+                    json.dump({'version': _INDEX_VERSION, 'stamp': stamp,
+                               'points': points}, indexfile)
+                os.replace(path + '.tmp', path)
+            except OSError:
+                # kept for this run only
+                pass
+    _indices[key] = (stamp, points)
+    return points
+
+
+class _GzipReader():
+    """Reads increasing ranges of the decompressed data, decompressing
+    from the last point of the seek index before each"""
+
+    def __init__(self, filehandle, offset, points):
+        self.filehandle = filehandle
+        self.offset = offset
+        self.points = points
+        self.raws = [raw for raw, _ in points]
+        # raw offset of the start of buf
+        self.pos = None
+        self.buf = memoryview(b'')
+
+    def restart(self, point):
+        raw, compressed = point
+        self.filehandle.seek(self.offset + compressed)
+        wbits = zlib.MAX_WBITS | 16 if compressed == 0 else -zlib.MAX_WBITS
+        self.pieces = self.decompress(zlib.decompressobj(wbits))
+        self.pos, self.buf = raw, memoryview(b'')
+
+    def decompress(self, decompobj):
+        while not decompobj.eof:
+            data = self.filehandle.read(_READ_CHUNKSIZE)
+            if not data:
+                return
+            yield from _inflate(decompobj, data)
+
+    def more(self):
+        self.pos += len(self.buf)
+        try:
+            self.buf = memoryview(next(self.pieces))
+        except StopIteration:
+            raise NrrdError('Data ends before the region')
+
+    def read(self, start, stop):
+        point = self.points[bisect.bisect_right(self.raws, start) - 1]
+        if (self.pos is None or start < self.pos or
+                point[0] > self.pos + len(self.buf)):
+            self.restart(point)
+        while self.pos + len(self.buf) <= start:
+            self.more()
+        parts = []
+        while start < stop:
+            if start >= self.pos + len(self.buf):
+                self.more()
+            part = self.buf[start - self.pos:stop - self.pos]
+            parts.append(part)
+            start += len(part)
+        return b''.join(parts)
+
+
+def _region_header(header, box):
+    """header with the sizes of box, and the space origin moved to its
+    first element"""
+    header = dict(header)
+    header['sizes'] = [stop - start for start, stop in box]
+    if 'space origin' in header and 'space directions' in header:
+        origin = np.array(header['space origin'], dtype=float)
+        for (start, _), direction in zip(box, header['space directions']):
+            if direction != 'none':
+                origin += start * np.array(direction, dtype=float)
+        header['space origin'] = origin.tolist()
+    return header
+
+
+def read_region(filename, box):
+    """Read the part of a nrrd file inside box and return a tuple (data,
+    header) like read(). box has a (start, stop) pair or None (the whole
+    axis) per axis, in the order of the header's sizes. The header's sizes
+    and space origin are those of the region, the other fields are the
+    file's.
+
+    Raw data is read with a seek and a read per slice along the last axis,
+    from the first to the last element of the box in it. Gzip data is
+    decompressed from the last point of a seek index before the box, see
+    _build_gzip_index, and only up to its end. Other encodings are read
+    whole.
+
+    """
+    with open(filename, 'rb') as filehandle:
+        header = read_header(filehandle)
+        box = _check_box(header, box)
+        encoding = header['encoding']
+        if encoding not in ('raw', 'gzip', 'gz'):
+            data = read_data(header, filehandle, filename)
+            return (data[tuple(slice(*b) for b in box)].copy(order='F'),
+                    _region_header(header, box))
+        datafilehandle, datafilename = _data_file(header, filehandle, filename)
+        try:
+            dtype = _determine_dtype(header)
+            lineskip = header.get('lineskip', header.get('line skip', 0))
+            byteskip = header.get('byteskip', header.get('byte skip', 0))
+            if encoding == 'raw' and byteskip == -1:
+                num_pixels = int(np.prod(header['sizes']))
+                datafilehandle.seek(-dtype.itemsize * num_pixels, 2)
+                byteskip = 0
+            else:
+                for _ in range(lineskip):
+                    datafilehandle.readline()
+            offset = datafilehandle.tell()
+
+            if encoding == 'raw':
+                def read_span(start, stop):
+                    datafilehandle.seek(offset + byteskip + start)
+                    span = datafilehandle.read(stop - start)
+                    if len(span) < stop - start:
+                        raise NrrdError('Data ends before the region')
+                    return span
+            else:
+                reader = _GzipReader(datafilehandle, offset,
+                                     _gzip_index(datafilehandle, offset,
+                                                 datafilename))
+
+                def read_span(start, stop):
+                    # byteskip applies to the _decompressed_ byte stream
+                    return reader.read(byteskip + start, byteskip + stop)
+
+            data = _read_spans(header, box, read_span)
+        finally:
+            if datafilehandle is not filehandle:
+                datafilehandle.close()
+    return (data, _region_header(header, box))
+
+
+def read_slice(filename, axis, index):
+    """Read the slice at index along axis of a nrrd file, see
+    read_region. Returns a tuple (data, header), the header being that of
+    the region one slice thick, so it keeps the axis"""
+    box = [None] * len(read_header_only(filename)['sizes'])
+    box[axis] = (index, index + 1)
+    data, header = read_region(filename, box)
+    return (np.take(data, 0, axis=axis), header)
+
+
 def _format_nrrd_list(field_value):
     return ' '.join([_to_reproducible_float(x) for x in field_value])
 
@@ -431,56 +761,150 @@ _NRRD_FIELD_FORMATTERS = {
 }
 
 
-def _write_data(data, filehandle, options):
-    # Now write data directly
-    rawdata = data.tostring(order='F')
+def slabs_of(data, nbytes=_WRITE_SLABSIZE):
+    """Splits data along its last axis into pieces of about nbytes, the
+    order they are stored in a nrrd file"""
+    step = max(1, nbytes // max(1, data[..., :1].nbytes))
+    for start_index in range(0, data.shape[-1], step):
+        yield data[..., start_index:start_index + step]
+
+
+def _write_slabs(slabs, filehandle, options):
+    """Writes the data from an iterator of slabs, one at a time. Gzip data
+    is fully flushed after each slab, so decompressing can start at any
+    slab. Returns these points as (raw offset, compressed offset) pairs,
+    relative to the start of the data.
+
+    Every slab must have the type and sizes in options, bar the last
+    size, and together they must have the last size.
+    """
+    dtype = _determine_dtype(options)
+    sizes = list(options['sizes'])
     if options['encoding'] == 'raw':
-        filehandle.write(rawdata)
+        comp_obj = None
+    elif options['encoding'] == 'gzip':
+        comp_obj = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    elif options['encoding'] == 'bzip2':
+        comp_obj = bz2.BZ2Compressor()
     else:
+        raise NrrdError('Unsupported encoding: "%s"' % options['encoding'])
+
+    raw_offset, written, points = 0, 0, []
+
+    def put(chunk):
+        nonlocal written
+        filehandle.write(chunk)
+        written += len(chunk)
+
+    slices = 0
+    for slab in slabs:
+        if slab.dtype != dtype:
+            raise NrrdError('Slab of type %s, the header says %s' % (slab.dtype, dtype))
+        if list(slab.shape[:-1]) != sizes[:-1] or slab.ndim != len(sizes):
+            raise NrrdError('Slab of sizes %s, the header says %s' % (list(slab.shape), sizes))
+        slices += slab.shape[-1]
+        if slices > sizes[-1]:
+            raise NrrdError('More than %d slices in the slabs' % sizes[-1])
+        # fortran order, a view when the slab already is
+        rawdata = memoryview(np.asfortranarray(slab).ravel(order='F')).cast('B')
+        # write data in chunks
+        for start_index in range(0, len(rawdata), _WRITE_CHUNKSIZE):
+            chunk = rawdata[start_index:start_index + _WRITE_CHUNKSIZE]
+            put(chunk if comp_obj is None else comp_obj.compress(chunk))
+        raw_offset += len(rawdata)
         if options['encoding'] == 'gzip':
-            comp_obj = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS | 16)
-        elif options['encoding'] == 'bzip2':
-            comp_obj = bz2.BZ2Compressor()
-        else:
-            raise NrrdError('Unsupported encoding: "%s"' % options['encoding'])
+            put(comp_obj.flush(zlib.Z_FULL_FLUSH))
+            points.append((raw_offset, written))
+    if slices != sizes[-1]:
+        raise NrrdError('%d slices in the slabs, the header says %d' % (slices, sizes[-1]))
+    if comp_obj is not None:
+        put(comp_obj.flush())
+    filehandle.flush()
+    return points
 
-        # write data in chunks
-        start_index = 0
-        while start_index < len(rawdata):
-            end_index = start_index + _WRITE_CHUNKSIZE
-            if end_index > len(rawdata):
-                end_index = len(rawdata)
-            filehandle.write(comp_obj.compress(rawdata[start_index:end_index]))
-            start_index = end_index
-        filehandle.write(comp_obj.flush())
-        filehandle.flush()
 
-def write(filename, data, options={}, detached_header=False):
-    """Write the numpy data to a nrrd file. The nrrd header values to use are
-    inferred from from the data. Additional options can be passed in the
-    options dictionary. See the read() function for the structure of this
-    dictionary.
+def _write_data(data, filehandle, options):
+    return _write_slabs(slabs_of(data), filehandle, options)
 
-    To set data samplings, use e.g. `options['spacings'] = [s1, s2, s3]` for
-    3d data with sampling deltas `s1`, `s2`, and `s3` in each dimension.
 
-    """
+def _fill_options(options, shape, dtype):
     # Infer a number of fields from the ndarray and ignore values
     # in the options dictionary.
-    options['type'] = _TYPEMAP_NUMPY2NRRD[data.dtype.str[1:]]
-    if data.dtype.itemsize > 1:
-        options['endian'] = _NUMPY2NRRD_ENDIAN_MAP[data.dtype.str[:1]]
+    options['type'] = _TYPEMAP_NUMPY2NRRD[dtype.str[1:]]
+    if dtype.itemsize > 1:
+        options['endian'] = _NUMPY2NRRD_ENDIAN_MAP[dtype.str[:1]]
     # if 'space' is specified 'space dimension' can not. See
     # http://teem.sourceforge.net/nrrd/format.html#space
     if 'space' in options.keys() and 'space dimension' in options.keys():
         del options['space dimension']
-    options['dimension'] = data.ndim
-    options['sizes'] = list(data.shape)
+    options['dimension'] = len(shape)
+    options['sizes'] = list(shape)
 
     # The default encoding is 'gzip'
     if 'encoding' not in options:
         options['encoding'] = 'gzip'
 
+
+def _write_header(filehandle, options):
+    filehandle.write(b'NRRD0005\n')
+    filehandle.write(b'# This NRRD file was generated by pynrrd\n')
+    filehandle.write(b'# on ' +
+                     datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S').encode('ascii') +
+                     b'(GMT).\n')
+    filehandle.write(b'# Complete NRRD file format specification at:\n')
+    filehandle.write(b'# http://teem.sourceforge.net/nrrd/format.html\n')
+
+    # Write the fields in order, this ignores fields not in
+    # _NRRD_FIELD_ORDER
+    for field in _NRRD_FIELD_ORDER:
+        if field in options:
+            outline = (field + ': ' +
+                       _NRRD_FIELD_FORMATTERS[field](options[field]) +
+                       '\n').encode('ascii')
+            filehandle.write(outline)
+    d = options.get('keyvaluepairs', {})
+    for (key, value) in sorted(d.items(), key=lambda t: t[0]):
+        outline = (str(key) + ':=' + str(value) + '\n').encode('ascii')
+        filehandle.write(outline)
+
+    # Write the closing extra newline
+    filehandle.write(b'\n')
+
+
+def write_slabs(file, slabs, shape, dtype, options=None):
+    """Write a nrrd file from an iterator of slabs instead of a whole array,
+    so only one slab needs to be in memory at a time. shape and dtype are
+    those of the whole array, the slabs are consecutive pieces of it along
+    its last (slowest) axis. file is a filename or a writable binary file,
+    a zip file entry for example. Options are as for write().
+
+    Returns the points gzip data can be decompressed from, see
+    _write_slabs.
+
+    """
+    # the options filled in are the caller's own
+    options = dict(options or {})
+    _fill_options(options, shape, np.dtype(dtype))
+    if hasattr(file, 'write'):
+        _write_header(file, options)
+        return _write_slabs(slabs, file, options)
+    with open(file, 'wb') as filehandle:
+        _write_header(filehandle, options)
+        return _write_slabs(slabs, filehandle, options)
+
+
+def write(filename, data, options={}, detached_header=False):
+    """Write the numpy data to a nrrd file. The nrrd header values to use are
+    inferred from from the data. Additional options can be passed in the
+    options dictionary. See the read() function for the structure of this
+    dictionary.
+
+    To set data samplings, use e.g. `options['spacings'] = [s1, s2, s3]` for
+    3d data with sampling deltas `s1`, `s2`, and `s3` in each dimension.
+
+    """
+    _fill_options(options, data.shape, data.dtype)
+
     # A bit of magic in handling options here.
     # If *.nhdr filename provided, this overrides `detached_header=False`
     # If *.nrrd filename provided AND detached_header=True, separate header
@@ -503,29 +927,7 @@ def write(filename, data, options={}, detached_header=False):
         datafilename = filename
 
     with open(filename, 'wb') as filehandle:
-        filehandle.write(b'NRRD0005\n')
-        filehandle.write(b'# This NRRD file was generated by pynrrd\n')
-        filehandle.write(b'# on ' +
-                         datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S').encode('ascii') +
-                         b'(GMT).\n')
-        filehandle.write(b'# Complete NRRD file format specification at:\n')
-        filehandle.write(b'# http://teem.sourceforge.net/nrrd/format.html\n')
-
-        # Write the fields in order, this ignores fields not in
-        # _NRRD_FIELD_ORDER
-        for field in _NRRD_FIELD_ORDER:
-            if field in options:
-                outline = (field + ': ' +
-                           _NRRD_FIELD_FORMATTERS[field](options[field]) +
-                           '\n').encode('ascii')
-                filehandle.write(outline)
-        d = options.get('keyvaluepairs', {})
-        for (key, value) in sorted(d.items(), key=lambda t: t[0]):
-            outline = (str(key) + ':=' + str(value) + '\n').encode('ascii')
-            filehandle.write(outline)
-
-        # Write the closing extra newline
-        filehandle.write(b'\n')
+        _write_header(filehandle, options)
 
         # If a single file desired, write data
         if not detached_header:
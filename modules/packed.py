@@ -0,0 +1,138 @@
+"""
+Volumes kept compressed in RAM. The data is split into chunks along the
+first axis, each compressed with zlib at its fastest level, and chunks
+are decompressed on access. Recently decompressed chunks are kept in a
+small shared cache, so repeated reads of the same region are cheap.
+
+Numpy functions and operators accept a CompressedArray like any array,
+decompressing it as a whole first
+"""
+
+import itertools
+import threading
+import zlib
+
+import numpy as np
+from numpy.lib.mixins import NDArrayOperatorsMixin
+
+from lru import LRUCache
+
+# slices along the first axis per chunk
+CHUNK_SLICES = 16
+# only worth keeping compressed if it is at least this many times smaller
+MIN_RATIO = 2
+
+_chunk_cache = LRUCache(128 * 2**20)
+_cache_lock = threading.Lock()
+_tokens = itertools.count()
+
+
+def clear_cache():
+    with _cache_lock:
+        _chunk_cache.clear()
+
+
+class CompressedArray(NDArrayOperatorsMixin):
+    """Read only array stored as compressed chunks"""
+
+    def __init__(self, data, level=1):
+        data = np.ascontiguousarray(data)
+        self.shape = data.shape
+        self.dtype = data.dtype
+        self.token = next(_tokens)
+        self.chunks = [zlib.compress(data[i:i + CHUNK_SLICES].tobytes(),
+                                     level)
+                       for i in range(0, self.shape[0], CHUNK_SLICES)]
+        self.compressed_bytes = sum(len(c) for c in self.chunks)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def chunk(self, i):
+        """Decompressed chunk i, read only"""
+        key = (self.token, i)
+        with _cache_lock:
+            data = _chunk_cache.get(key)
+        if data is None:
+            start = i * CHUNK_SLICES
+            n = min(CHUNK_SLICES, self.shape[0] - start)
+            data = np.frombuffer(zlib.decompress(self.chunks[i]),
+                                 self.dtype).reshape((n,) + self.shape[1:])
+            with _cache_lock:
+                _chunk_cache.put(key, data, data.nbytes)
+        return data
+
+    def read(self, start=0, stop=None):
+        """Uncompressed copy of slices start to stop along the first axis"""
+        stop = self.shape[0] if stop is None else stop
+        out = np.empty((max(stop - start, 0),) + self.shape[1:], self.dtype)
+        for i in range(start // CHUNK_SLICES,
+                       (stop + CHUNK_SLICES - 1) // CHUNK_SLICES):
+            c0 = i * CHUNK_SLICES
+            chunk = self.chunk(i)
+            lo, hi = max(start, c0), min(stop, c0 + len(chunk))
+            out[lo - start:hi - start] = chunk[lo - c0:hi - c0]
+        return out
+
+    def __getitem__(self, index):
+        """Only the chunks covered by the first index are decompressed"""
+        if not isinstance(index, tuple):
+            index = (index,)
+        first, rest = (index[0], index[1:]) if index else (slice(None), ())
+        if isinstance(first, (int, np.integer)):
+            n = first % self.shape[0]
+            return self.read(n, n + 1)[(0,) + rest]
+        if isinstance(first, slice):
+            start, stop, step = first.indices(self.shape[0])
+            if step > 0:
+                block = self.read(start, max(stop, start))
+                return block[(slice(None, None, step),) + rest]
+        return np.asarray(self)[index]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self.read()
+        return data if dtype is None else data.astype(dtype)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        if any(isinstance(o, CompressedArray) for o in kwargs.get("out", ())):
+            raise TypeError("CompressedArray is read only")
+        inputs = [np.asarray(i) if isinstance(i, CompressedArray) else i
+                  for i in inputs]
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def astype(self, dtype):
+        return np.asarray(self).astype(dtype)
+
+    def tolist(self):
+        return np.asarray(self).tolist()
+
+
+def compress(data, level=1):
+    """Returns data as a CompressedArray, or data itself if it does not
+    compress well enough to be worth it"""
+    if not isinstance(data, np.ndarray) or data.size == 0:
+        return data
+    packed = CompressedArray(data, level)
+    if packed.compressed_bytes * MIN_RATIO > data.nbytes:
+        return data
+    return packed
+
+
+def is_compressed(data):
+    return isinstance(data, CompressedArray)
+
+
+def cache_bytes():
+    return _chunk_cache.nbytes
@@ -0,0 +1,139 @@
+"""
+Stage timings and counters, for finding out where the time of a render
+or an export goes. Recording is off by default, and while it is off a
+timed stage costs no more than checking a flag
+"""
+
+import json
+import threading
+import time
+from functools import wraps
+
+ENABLED = False
+
+# name: [calls, total seconds, longest call]
+_timings = {}
+# name: total
+_counters = {}
+_lock = threading.Lock()
+
+
+def enable(on=True):
+    global ENABLED
+    ENABLED = on
+
+
+def reset():
+    with _lock:
+        _timings.clear()
+        _counters.clear()
+
+
+def record(name, seconds):
+    with _lock:
+        entry = _timings.get(name)
+        if entry is None:
+            _timings[name] = [1, seconds, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+            if seconds > entry[2]:
+                entry[2] = seconds
+
+
+def count(name, n=1):
+    if ENABLED:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + n
+
+
+class _Stage():
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        record(self.name, time.perf_counter() - self.start)
+
+
+class _NullStage():
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name, *parts):
+    """Context manager timing a block. Extra parts are joined onto the
+    name with dots, only when recording, so callers can pass layer
+    indices or modes without paying for the string formatting"""
+    if not ENABLED:
+        return _NULL_STAGE
+    if parts:
+        name = ".".join([name] + [str(p) for p in parts])
+    return _Stage(name)
+
+
+def timed(name):
+    """Decorator timing every call of a function"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    """Returns (timings, counters). Timings are dictionaries sorted with
+    the most total time first"""
+    with _lock:
+        timings = [{"name": k,
+                    "calls": v[0],
+                    "total": v[1],
+                    "mean": v[1] / v[0],
+                    "max": v[2]} for k, v in _timings.items()]
+        counters = dict(_counters)
+    timings.sort(key=lambda t: t["total"], reverse=True)
+    return timings, counters
+
+
+def report():
+    """Plain text table of everything recorded so far"""
+    timings, counters = snapshot()
+    lines = ["{:<34} {:>7} {:>10} {:>10} {:>10}".format(
+        "stage", "calls", "total ms", "mean ms", "max ms")]
+    for t in timings:
+        lines.append("{:<34} {:>7} {:>10.1f} {:>10.2f} {:>10.2f}".format(
+            t["name"], t["calls"], t["total"] * 1000, t["mean"] * 1000,
+            t["max"] * 1000))
+    if counters:
+        lines.append("")
+        lines.append("{:<34} {:>7}".format("counter", "total"))
+        for name in sorted(counters):
+            lines.append("{:<34} {:>7}".format(name, counters[name]))
+    return "\n".join(lines)
+
+
+def dump(path):
+    """Writes everything recorded so far to a json file"""
+    timings, counters = snapshot()
+    with open(path, "w") as f:
+        json.dump({"timings": timings, "counters": counters}, f, indent=1)
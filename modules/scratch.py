@@ -0,0 +1,84 @@
+"""
+Scratch folders made per session in a parent shared with other sessions.
+Each holds an owner file its session keeps locked while it runs, so
+folders left behind by sessions that crashed can be told apart from those
+of sessions still running. The lock goes away with the process, however
+it exits, and unlike a pid it cannot be taken over by another process
+"""
+
+import atexit
+import os
+import shutil
+import tempfile
+import time
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+    import fcntl
+
+OWNER_NAME = "owner.lock"  # file locked by the session using the folder
+OWNERLESS_AGE = 60  # seconds a folder without owner file is left alone
+
+
+def _lock(f):
+    """Locks the open file f without waiting, raises OSError if another
+    process holds the lock"""
+    if msvcrt is not None:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    else:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+def make_folder(parent, prefix):
+    """Creates a folder in parent owned by this process, removed when it
+    exits"""
+    os.makedirs(parent, exist_ok=True)
+    folder = tempfile.mkdtemp(prefix=prefix, dir=parent)
+    owner = open(os.path.join(folder, OWNER_NAME), "w")
+    _lock(owner)
+    owner.write(str(os.getpid()))
+    owner.flush()
+
+    def remove():
+        # windows does not delete open files
+        owner.close()
+        shutil.rmtree(folder, ignore_errors=True)
+
+    atexit.register(remove)
+    return folder
+
+
+def is_owned(folder):
+    """Whether a running process holds the owner file of folder"""
+    try:
+        f = open(os.path.join(folder, OWNER_NAME), "r+")
+    except FileNotFoundError:
+        # made by an older version, or its owner is about to lock it
+        return time.time() - os.path.getmtime(folder) < OWNERLESS_AGE
+    with f:
+        try:
+            _lock(f)
+        except OSError:
+            return True
+    return False
+
+
+def remove_stale(parent, prefix):
+    """Removes the folders starting with prefix in parent whose owner
+    exited without removing them"""
+    if not os.path.isdir(parent):
+        return
+    for name in os.listdir(parent):
+        path = os.path.join(parent, name)
+        if not name.startswith(prefix) or not os.path.isdir(path):
+            continue
+        try:
+            owned = is_owned(path)
+        except OSError:
+            # removed meanwhile
+            continue
+        if not owned:
+            shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,174 @@
+"""
+Volumes that are zero outside a bounding box, storing only what is inside
+it. Boxes cover the first three (spatial) axes and are written as
+((start, stop), (start, stop), (start, stop)).
+
+Numpy functions and operators accept a SparseVolume like any array,
+filling in the zeros first. Code that wants to stay inside the box works
+on .box and .data directly
+"""
+
+import numpy as np
+from numpy.lib.mixins import NDArrayOperatorsMixin
+
+# a volume is only kept sparse if its box is at most this part of it
+MAX_FILL = 0.5
+
+
+def full_box(shape):
+    return tuple((0, n) for n in shape[:3])
+
+
+def box_slices(box):
+    return tuple(slice(start, stop) for start, stop in box)
+
+
+def box_volume(box):
+    return int(np.prod([stop - start for start, stop in box]))
+
+
+def intersect(a, b):
+    return tuple((max(a0, b0), max(max(a0, b0), min(a1, b1)))
+                 for (a0, a1), (b0, b1) in zip(a, b))
+
+
+def relative(box, outer):
+    """Slices selecting box out of an array covering outer"""
+    return tuple(slice(start - o0, stop - o0)
+                 for (start, stop), (o0, _) in zip(box, outer))
+
+
+def find_box(data, align=1):
+    """Bounding box of the voxels that are non-zero in any channel. Starts
+    are rounded down to a multiple of align"""
+    nonzero = data != 0
+    if nonzero.ndim > 3:
+        nonzero = nonzero.any(axis=tuple(range(3, nonzero.ndim)))
+    box = []
+    for axis in range(3):
+        others = tuple(a for a in range(3) if a != axis)
+        hits = np.flatnonzero(nonzero.any(axis=others))
+        if hits.size == 0:
+            return ((0, 0),) * 3
+        box.append((hits[0] // align * align, hits[-1] + 1))
+    return tuple(box)
+
+
+class SparseVolume(NDArrayOperatorsMixin):
+    """Volume of the given shape holding data inside box and zeros
+    everywhere else"""
+
+    def __init__(self, box, data, shape):
+        self.box = tuple(box)
+        self.data = data
+        self.shape = tuple(shape)
+        self.dtype = data.dtype
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def region(self, box):
+        """Dense copy of the part of the volume inside box"""
+        shape = tuple(b - a for a, b in box) + self.shape[3:]
+        out = np.zeros(shape, self.dtype)
+        inner = intersect(box, self.box)
+        out[relative(inner, box)] = self.data[relative(inner, self.box)]
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        out = self.region(full_box(self.shape))
+        return out if dtype is None else out.astype(dtype)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        if any(isinstance(o, SparseVolume) for o in kwargs.get("out", ())):
+            raise TypeError("SparseVolume is read only")
+        inputs = [np.asarray(i) if isinstance(i, SparseVolume) else i
+                  for i in inputs]
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def __getitem__(self, index):
+        return np.asarray(self)[index]
+
+    def astype(self, dtype):
+        return np.asarray(self).astype(dtype)
+
+    def tolist(self):
+        return np.asarray(self).tolist()
+
+    def downsample(self):
+        """Every second voxel along the spatial axes, matching a[::2, ::2,
+        ::2] of the dense volume as long as the box starts are even"""
+        box = tuple((start // 2, (stop + 1) // 2) for start, stop in self.box)
+        shape = tuple((n + 1) // 2 for n in self.shape[:3]) + self.shape[3:]
+        data = np.ascontiguousarray(self.data[::2, ::2, ::2])
+        return SparseVolume(box, data, shape)
+
+
+def window(data, start, stop):
+    """Slices start:stop along the first axis of a SparseVolume, as a
+    SparseVolume"""
+    (b0, b1) = data.box[0]
+    lo = min(max(b0, start), stop)
+    hi = max(min(b1, stop), lo)
+    box = ((lo - start, hi - start),) + data.box[1:]
+    return SparseVolume(box, data.data[lo - b0:hi - b0],
+                        (stop - start,) + data.shape[1:])
+
+
+def sparsify(data, align=1):
+    """Returns data as a SparseVolume if its content fills little enough
+    of it, otherwise data itself"""
+    if not isinstance(data, np.ndarray) or data.ndim < 3:
+        return data
+    box = find_box(data, align)
+    if box_volume(box) > MAX_FILL * box_volume(full_box(data.shape)):
+        return data
+    return SparseVolume(box, np.ascontiguousarray(data[box_slices(box)]),
+                        data.shape)
+
+
+def is_sparse(data):
+    return isinstance(data, SparseVolume)
+
+
+def unwrap(data):
+    """The array actually holding the data"""
+    return data.data if isinstance(data, SparseVolume) else data
+
+
+def apply(data, func):
+    """func of data, or of the stored part only for a SparseVolume"""
+    if isinstance(data, SparseVolume):
+        new = func(data.data)
+        return SparseVolume(data.box, new, data.shape[:3] + new.shape[3:])
+    return func(data)
+
+
+def bounds(data):
+    """Box outside which data is zero. Dense arrays and scalars cover
+    everything, returned as None"""
+    return data.box if isinstance(data, SparseVolume) else None
+
+
+def take(data, box):
+    """The part of data inside box. Scalars and per channel values are
+    returned as they are, they broadcast over any box"""
+    if np.ndim(data) < 3:
+        return data
+    if isinstance(data, SparseVolume):
+        if box == data.box:
+            return data.data
+        return data.region(box)
+    return data[box_slices(box)]
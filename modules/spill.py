@@ -0,0 +1,69 @@
+"""
+Scratch storage for volumes moved out of RAM. Arrays are written to files
+and read back as read only memory maps, which numpy treats like any other
+array, so code reading them does not need to know where they live
+"""
+
+import itertools
+import os
+import weakref
+
+import numpy as np
+
+import scratch
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        # still mapped somewhere (windows), removed with the folder on exit
+        pass
+
+
+class SpillStore():
+    """Folder of memory mapped arrays, created on first use in parent and
+    removed when the program exits. Each file is deleted as soon as its
+    memory map is garbage collected"""
+
+    def __init__(self, parent):
+        self.parent = parent
+        self.folder = None
+        self.counter = itertools.count()
+
+    def remove_stale(self):
+        """Removes the folders sessions that did not exit normally left in
+        parent. Those of running sessions are kept"""
+        scratch.remove_stale(self.parent, "spill_")
+
+    def get_folder(self):
+        if self.folder is None:
+            self.folder = scratch.make_folder(self.parent, "spill_")
+        return self.folder
+
+    def spill(self, data):
+        """Returns a read only memory mapped copy of data. Anything but a
+        plain array is returned as it is"""
+        if (not isinstance(data, np.ndarray) or isinstance(data, np.memmap)
+                or data.size == 0):
+            return data
+        path = os.path.join(self.get_folder(),
+                            "{}.dat".format(next(self.counter)))
+        out = np.memmap(path, dtype=data.dtype, mode="w+", shape=data.shape)
+        out[...] = data
+        out.flush()
+        del out
+        mapped = np.memmap(path, dtype=data.dtype, mode="r", shape=data.shape)
+        weakref.finalize(mapped, _remove, path)
+        return mapped
+
+    @staticmethod
+    def restore(data):
+        """Returns data in RAM"""
+        if isinstance(data, np.memmap):
+            return np.array(data)
+        return data
+
+    @staticmethod
+    def is_spilled(data):
+        return isinstance(data, np.memmap)
@@ -10,6 +10,9 @@ Created on Thu Feb  2 10:38:30 2017
 @author: Jack Brookes
 """
 
+import time
+START_TIME = time.perf_counter()
+
 import os
 import stat
 import tempfile
@@ -21,15 +24,19 @@ import tkinter.ttk as ttk
 import tkinter.font as tkfont
 from tkinter import filedialog, messagebox
 import ctypes
-from PIL import Image, ImageTk
 import shutil
 import imp
+import ast
 import copy
 import zipfile
-from scipy.ndimage.interpolation import zoom as scipyzoom
+from concurrent.futures import ThreadPoolExecutor
 import traceback
 import datetime
 import json
+import itertools
+import queue
+import hashlib
+from collections import deque
 
 CURRDIR = os.path.dirname(__file__)
 sys.path.append(os.path.join(CURRDIR, "modules"))
@@ -37,17 +44,107 @@ sys.path.append(os.path.join(CURRDIR, "modules"))
 try:
     import hover
     import nrrd
+    from lru import LRUCache
     from SBF import VerticalScrolledFrame
+    from lazy import lazy_import
+    from library import ModelLibrary
+    import perf
+    from spill import SpillStore
+    import packed
+    import sparse
+    import constant
+    from history import History, diff
+    import journal
+    from exportcache import ExportCache
 except:
     raise
 
+# heavy modules, only loaded once they are first needed
+Image = lazy_import("PIL.Image")
+ImageTk = lazy_import("PIL.ImageTk")
+ndimage = lazy_import("scipy.ndimage")
+
 myappid = 'jackbrookes.simodontmodelbuilder.preproduction.1'
-ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(myappid)
+# windows only, lets the taskbar group our windows
+if hasattr(ctypes, "windll"):
+    ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(myappid)
+
+# worker pool shared by resampling jobs, created on first use
+RESAMPLE_POOL = None
+
+# nrrd headers cached across runs, loaded on first use
+HEADER_CACHE_PATH = os.path.join(CURRDIR, "cache", "nrrd_headers.json")
+HEADER_CACHE = None
+
+# seek indices of gzip nrrds, for reading parts of them
+nrrd.INDEX_FOLDER = os.path.join(CURRDIR, "cache", "gzindex")
+
+# index of the models and output folders, created on first use
+LIBRARY_PATH = os.path.join(CURRDIR, "cache", "library.json")
+LIBRARY_FOLDERS = [os.path.join(CURRDIR, "models"),
+                   os.path.join(CURRDIR, "output")]
+MODEL_LIBRARY = None
+
+# pyramid levels kept per layer (1/2, 1/4, 1/8) and the level used for
+# previews while the user is adjusting layer settings
+PYRAMID_LEVELS = 3
+PREVIEW_LEVEL = 2
+# volumes smaller than this are always rendered at full resolution
+PREVIEW_MIN_VOXELS = 64**3
+# idle time (ms) after the last tweak before refining to full resolution
+REFINE_DELAY = 300
+
+# memory cap for the rendered cross-section images kept by each view
+CROSSSECTION_CACHE_BYTES = 64 * 2**20
+
+# memory cap for the combined masks of chains of several masks
+MASK_CACHE_BYTES = 256 * 2**20
+
+# exported volumes are converted and compressed this much at a time
+EXPORT_SLAB_BYTES = 16 * 2**20
+
+# disk cap for encoded channels kept to be copied into later exports
+EXPORT_CACHE_BYTES = 2048 * 2**20
+
+# time budget (ms) per frame when scrubbing through slices, and how many
+# neighbouring slices are rendered ahead once the user stops scrubbing
+SCRUB_FRAME_MS = 16
+PREFETCH_DELAY = 100
+PREFETCH_SLICES = 4
+
+# how often (ms) the performance panel shows the latest timings
+PERF_REFRESH = 500
+
+# default budget (MB) for layer data and caches. Caches are freed when
+# memory use goes over it, and resizing or generating warns beforehand
+MEMORY_BUDGET_MB = 4096
+
+# layers moved out of RAM are kept as memory mapped files in here
+SPILL_STORE = SpillStore(os.path.join(CURRDIR, "cache", "scratch"))
+# encoded channels of earlier exports, kept in there for the session
+EXPORT_CACHE = ExportCache(os.path.join(CURRDIR, "cache", "scratch"),
+                           EXPORT_CACHE_BYTES)
+
+# time (ms) a layer is left unchanged before its channels are compressed
+COMPRESS_DELAY = 30000
+
+# default cap (MB) on memory kept for undoing changes, the oldest steps are
+# forgotten past it
+HISTORY_MB = 256
+HISTORY = History(HISTORY_MB * 2**20)
+
+# the layer stack is checkpointed to this journal every AUTOSAVE_DELAY ms,
+# on a worker thread, and recovered from it after a crash
+AUTOSAVE_PATH = os.path.join(CURRDIR, "cache", "autosave", "journal.bin")
+AUTOSAVE_DELAY = 60000
+AUTOSAVE = None
 
 
 def load_generators():
     """
-    Checks for generators in /generators folder and imports them
+    Checks for generators in /generators folder. Python files are only
+    scanned for their name and description, the module itself is loaded
+    the first time the generator is used
     """
     gen_folder = os.path.join(CURRDIR, "generators")
     genfiles = []
@@ -61,17 +158,19 @@ def load_generators():
         mod_name, file_ext = os.path.splitext(os.path.split(g)[-1])
         try:
             if file_ext.lower() == '.py':
-                py_mod = imp.load_source(mod_name, g)
-                ispy = True
+                info = scan_generator(g)
+                if info is not None:
+                    gens.append(Generator(mod_name, g, *info))
             elif file_ext.lower() == '.pyc':
+                # compiled generators can't be scanned, so load them now
                 py_mod = imp.load_compiled(mod_name, g)
-                ispy = True
-            else:
-                ispy = False
+                if hasattr(py_mod, "MainFrame"):
+                    gen = Generator(mod_name, g,
+                                    py_mod.GENERATOR_NAME,
+                                    py_mod.GENERATOR_DESCRIPTION)
+                    gen.module = py_mod
+                    gens.append(gen)
 
-            if ispy and hasattr(py_mod, "MainFrame"):
-                gens.append(Generator(py_mod))
-            
         except ImportError as e:
             print("Could not load generator " + g + ": Missing \"" + e.name + "\"")
             continue
@@ -79,11 +178,43 @@ def load_generators():
     return gens
 
 
+def scan_generator(path):
+    """
+    Reads GENERATOR_NAME and GENERATOR_DESCRIPTION from the source of a
+    generator without executing it. Returns None if the file doesn't
+    define a MainFrame
+    """
+    with open(path, 'rb') as f:
+        tree = ast.parse(f.read(), path)
+    values, has_frame = {}, False
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef) and node.name == "MainFrame":
+            has_frame = True
+        elif isinstance(node, ast.Assign):
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    try:
+                        values[target.id] = ast.literal_eval(node.value)
+                    except ValueError:
+                        pass
+    if not has_frame:
+        return None
+    return values["GENERATOR_NAME"], values["GENERATOR_DESCRIPTION"]
+
+
 class Generator():
-    def __init__(self, module):
-        self.name = module.GENERATOR_NAME
-        self.description = module.GENERATOR_DESCRIPTION
-        self.module = module
+    def __init__(self, mod_name, path, name, description):
+        self.mod_name = mod_name
+        self.path = path
+        self.name = name
+        self.description = description
+        self.module = None
+
+    def load(self):
+        """Imports the generator module on first use"""
+        if self.module is None:
+            self.module = imp.load_source(self.mod_name, self.path)
+        return self.module
 
     def get_frame(self, master):
         shape = get_shapes_dict()
@@ -219,6 +350,12 @@ class App(tk.Tk):
         self.layersystem.grid(row=1, column=0, sticky="nsew")
 
     def launch_gen(self, gen):
+        try:
+            gen.load()
+        except ImportError as e:
+            show_error("Could not load generator {}: Missing \"{}\"".format(
+                gen.name, e.name))
+            return
 
         def center_window():
             window.update_idletasks()
@@ -246,6 +383,12 @@ class App(tk.Tk):
                 ln = "New mask" if ln == "" else ln
             else:
                 ln = "New layer" if ln == "" else ln
+            # worst case, every channel is generated
+            voxels = int(np.prod(APP.main_iw.get_shape()))
+            newdata = voxels if asmask else voxels * 6
+            needed = self.layersystem.data_usage() + newdata
+            if not self.layersystem.confirm_memory(needed, "This layer"):
+                return
             # make new layer..
             data = gen.get_data()
             if data is not None:
@@ -336,6 +479,12 @@ class App(tk.Tk):
             filemenu.add_command(label="Load model .zip",
                                  command=load_model_zip)
 
+            filemenu.add_command(label="Load model region",
+                                 command=launch_region)
+
+            filemenu.add_command(label="Model library",
+                                 command=launch_library)
+
             filemenu.add_separator()
 
             filemenu.add_command(label="Save layers as .json",
@@ -347,6 +496,9 @@ class App(tk.Tk):
             filemenu.add_command(label="Export .nrrds",
                                  command=export_nrrds)
 
+            filemenu.add_command(label="Export variants",
+                                 command=launch_variants)
+
             saveimgmenu = tk.Menu(self, tearoff=0)
             saveimgmenu.add_command(label="1x",
                                     command=lambda: export_image(1))
@@ -366,19 +518,22 @@ class App(tk.Tk):
             self.add_cascade(label="File", menu=filemenu)
 
             editmenu = tk.Menu(self, tearoff=0)
-            editmenu.add_command(label="Undo", command=donothing)
-
-            editmenu.add_separator()
+            editmenu.add_command(label="Undo", command=undo,
+                                 accelerator="Ctrl+Z")
+            editmenu.add_command(label="Redo", command=redo,
+                                 accelerator="Ctrl+Y")
 
+#            editmenu.add_separator()
 #            editmenu.add_command(label="Cut", command=donothing)
 #            editmenu.add_command(label="Copy", command=donothing)
 #            editmenu.add_command(label="Paste", command=donothing)
 #            editmenu.add_command(label="Delete", command=donothing)
 #            editmenu.add_command(label="Select All", command=donothing)
-#
-#            self.add_cascade(label="Edit", menu=editmenu)
+
+            self.add_cascade(label="Edit", menu=editmenu)
 
             helpmenu = tk.Menu(self, tearoff=0)
+            helpmenu.add_command(label="Performance", command=launch_perf)
             helpmenu.add_command(label="Todo list", command=launch_todo)
             helpmenu.add_command(label="About", command=launch_about)
             self.add_cascade(label="Help", menu=helpmenu)
@@ -429,20 +584,29 @@ class LayerSystem(tk.Frame):
         self.layerframe.canvas.config(bg=LIGHT_GREY)
         self.layerframe.pack(fill=tk.BOTH, expand=tk.YES)
         self.layers = []
+        # layers taken out of the stack that undo can bring back, oldest
+        # first
+        self.removed = []
+        self.refine_job = None
+        self.compress_job = None
+        # state of the last autosave checkpoint
+        self.autosaved = None
+        self.mask_cache = LRUCache(MASK_CACHE_BYTES)
 
     def export(self):
         TASKMODEL.export(self.data)
 
     def clear(self):
-        for l in self.layers:
-            l.destroy()
-        self.layers = []
-        self.render()
+        if self.layers:
+            self.remove_layers(list(self.layers), "Clear layers")
+        else:
+            self.render()
 
     def get_layers_data(self):
         return [l.to_dict() for l in self.layers]        
 
     def layers_from_dictlist(self, layerlist):
+        newlayers = []
         for layer in layerlist:
             if layer["type"] == "mask":
                 data = np.array(layer["maskdata"])
@@ -458,21 +622,77 @@ class LayerSystem(tk.Frame):
             else:
                 raise Exception("Invalid json value for key: 'type'")
 
-            self.layers.append(newlayer)
+            newlayers.append(newlayer)
 
-        self.update_layers()
-        self.render()
+        self.add_layers(newlayers, "Load layers")
 
 
     def layer_from_data(self, data, name, gen="FILE"):
-        self.layers.append(self.Layer(self, data, name, gen))
-        self.update_layers()
-        self.render()
+        self.add_layers([self.Layer(self, data, name, gen)], "Add layer")
 
     def mask_from_data(self, maskdata, name, gen):
-        self.layers.append(self.Mask(self, maskdata, name, gen))
+        self.add_layers([self.Mask(self, maskdata, name, gen)], "Add mask")
+
+    def add_layers(self, layers, name):
+        self.layers.extend(layers)
+        self.update_layers()
+        self.render()
+        placed = [(self.layers.index(l), l) for l in layers]
+        self.record(name,
+                    lambda: self.take_layers(layers),
+                    lambda: self.insert_layers(placed),
+                    drop=lambda: self.discard_layers(layers))
+
+    def remove_layers(self, layers, name):
+        # removed layers count towards the history through self.removed,
+        # see spill_removed
+        placed = self.take_layers(layers)
+        self.record(name,
+                    lambda: self.insert_layers(placed),
+                    lambda: self.take_layers(layers),
+                    drop=lambda: self.discard_layers(layers))
+
+    def take_layers(self, layers):
+        """Takes layers out of the stack, keeping them so they can be put
+        back. Returns their (index, layer) pairs"""
+        placed = [(self.layers.index(l), l) for l in layers]
+        for l in layers:
+            self.layers.remove(l)
+            self.removed.append(l)
         self.update_layers()
         self.render()
+        return placed
+
+    def insert_layers(self, placed):
+        for i, l in sorted(placed, key=lambda p: p[0]):
+            self.layers.insert(i, l)
+            self.removed.remove(l)
+            if l.visible and l.spilled:
+                l.restore()
+        self.update_layers()
+        self.render()
+
+    def discard_layers(self, layers):
+        """Destroys the layers no longer in the stack, once no step can
+        bring them back"""
+        for l in layers:
+            if l not in self.layers:
+                if l in self.removed:
+                    self.removed.remove(l)
+                l.destroy()
+
+    def spill_removed(self):
+        """Moves removed layers to disk, oldest first, until those left in
+        RAM fit in the history budget next to the history steps"""
+        room = APP.main_iw.history_budget - HISTORY.nbytes
+        held = [l for l in self.removed if not l.spilled]
+        total = sum(sum(l.memory_usage()) for l in held)
+        for l in held:
+            if total <= room:
+                break
+            total -= sum(l.memory_usage())
+            l.spill()
+            total += sum(l.memory_usage())
 
     def swaplayer(self, chosenlayer, offset):
         idx = self.layers.index(chosenlayer)
@@ -481,6 +701,62 @@ class LayerSystem(tk.Frame):
                                                  self.layers[idx])
         self.update_layers()
         self.render()
+        self.record("Move layer",
+                    lambda: self.swaplayer(chosenlayer, -offset),
+                    lambda: self.swaplayer(chosenlayer, offset))
+
+    def record(self, name, undo, redo, **kwargs):
+        """Adds a step to the undo history, capped at the size set in the
+        information panel"""
+        HISTORY.maxbytes = APP.main_iw.history_budget
+        HISTORY.record(name, undo, redo, **kwargs)
+
+    def autosave(self):
+        """Queues a checkpoint of the layer stack if anything changed since
+        the last one, then schedules the next. Only references are taken
+        here, the journal thread does the encoding and writing"""
+        self.after(AUTOSAVE_DELAY, self.autosave)
+        if AUTOSAVE is None or AUTOSAVE.busy:
+            return
+        layers, channels = [], {}
+        for l in self.layers:
+            state, data = l.autosave_state()
+            layers.append(state)
+            channels.update(data)
+        state = {"shape": list(APP.main_iw.get_shape()),
+                 "spacing": APP.main_iw.voxel_size.text,
+                 "layers": layers}
+        if state != self.autosaved:
+            AUTOSAVE.checkpoint(state, channels)
+            self.autosaved = state
+
+    def recover(self, state, channels):
+        """Rebuilds the layer stack from an autosave checkpoint"""
+        HISTORY.begin()
+        try:
+            self.clear()
+            APP.main_iw.set_shape(state["shape"])
+            APP.main_iw.voxel_size.text = state["spacing"]
+            newlayers = []
+            for l in state["layers"]:
+                data = {k: channels[v] for k, v in l["channels"].items()}
+                if l["type"] == "mask":
+                    maskdata = data.get("mask")
+                    if maskdata is not None:
+                        maskdata = np.asarray(maskdata)
+                    newlayer = self.Mask(self, maskdata, l["name"], l["gen"])
+                else:
+                    data = {m: data.get(m) for m in TASKMODEL.modes}
+                    newlayer = self.Layer(self, data, l["name"], l["gen"])
+                    newlayer.set_composites(l["compmodes"])
+                    newlayer.set_opacities(l["opacities"])
+                newlayers.append(newlayer)
+            self.add_layers(newlayers, "Recover session")
+            for newlayer, l in zip(newlayers, state["layers"]):
+                if not l["visible"]:
+                    newlayer.toggle_visible()
+        finally:
+            HISTORY.end("Recover session")
 
     def update_layers(self):
         for s in self.layerframe.interior.pack_slaves():
@@ -488,116 +764,452 @@ class LayerSystem(tk.Frame):
         for l in reversed(self.layers):
             l.pack(fill=tk.X)
 
+    @perf.timed("resize_all")
     def resize_all(self):
-        target_shape = get_shapes_dict()
+        """Resamples every layer and mask to the current shape. Data is
+        always resampled from the original source, jobs are run on the
+        resample pool and results are cached per target shape"""
+        target_shapes = get_shapes_dict()
+        pool = get_resample_pool()
+        jobs = []
         for l in self.layers:
-            if type(l) == self.Layer:
-                for mode in TASKMODEL.modes:
-                    if l.data[mode] is not None:
-                        order = 0 if mode == "segment" else 1
-                        zoom = np.divide(target_shape[mode], l.data[mode].shape)
-                        newdata = (scipyzoom(l.data[mode],
-                                             zoom,
-                                             order=order)).astype(np.uint8)
-                        l.data[mode] = newdata
-            elif type(l) == self.Mask:
-                zoom = np.divide(target_shape['iso'], l.maskdata.shape)
-                newdata = (scipyzoom(l.maskdata,
-                                     zoom,
-                                     order=1)).astype(np.uint8)
-                l.maskdata = newdata
-    def render(self, *args):
+            for key, shape, order in l.resample_targets(target_shapes):
+                cached = l.resampled.get((key, shape))
+                if cached is not None:
+                    l.set_channel(key, cached)
+                else:
+                    job = pool.submit(resample_array,
+                                      l.get_source(key),
+                                      shape,
+                                      order)
+                    jobs.append((l, key, shape, job))
+
+        for l, key, shape, job in jobs:
+            newdata = job.result()
+            l.resampled[(key, shape)] = newdata
+            l.set_channel(key, newdata)
+
+    def render(self, *args, level=0):
         """Loops through all layers and renders them according to
-        layer settings"""
+        layer settings. Levels above 0 render from the layer pyramids"""
+        if level == 0:
+            self.cancel_refine()
 
-        # blank background
-        rendered = gen_blank_data()
+        stagename = "render.preview" if level else "render.full"
+        with perf.stage(stagename):
+            # blank background
+            rendered = gen_blank_data(level)
 
-        # loop through layers starting from layer 0
-        i = 0
-        for layer in self.layers:
-            if layer.visible and type(layer) != self.Mask:
-                mask = self.seek_masks(i)
-                for mode in TASKMODEL.modes:
-                    if type(mask) is not int:
-                        shapedmask = data3d_to_mode(mode, mask)
-                    else:
-                        shapedmask = mask
-                    olddata = np.copy(rendered[mode])
-                    output = self.composite_layer(olddata,
-                                                  layer,
-                                                  shapedmask,
-                                                  mode)
-                    rendered[mode] = output
-            i += 1
+            # loop through layers starting from layer 0
+            for i, layer in enumerate(self.layers):
+                if layer.visible and type(layer) != self.Mask:
+                    with perf.stage("render.layer", i):
+                        self.render_layer(rendered, i, layer, level)
 
         # push data to screen
-        APP.main_mvw.push(rendered)
+        APP.main_mvw.push(rendered, level)
+        if level == 0:
+            self.update_memory()
+
+    def render_layer(self, rendered, i, layer, level=0):
+        """Composites the layer at index i onto rendered, in place"""
+        self.composite_onto(rendered, layer, self.seek_masks(i, level), level)
+
+    def composite_onto(self, rendered, layer, mask, level=0):
+        """Composites layer through mask onto rendered, in place. Only the
+        modes in rendered are composited"""
+        for mode in list(rendered):
+            with perf.stage("render.mode", mode):
+                if np.ndim(mask) > 0:
+                    shapedmask = sparse.apply(
+                        mask, lambda m: data3d_to_mode(mode, m))
+                else:
+                    shapedmask = mask
+                olddata = np.copy(rendered[mode])
+                output = self.composite_layer(olddata,
+                                              layer,
+                                              shapedmask,
+                                              mode,
+                                              level)
+                rendered[mode] = output
+
+    def variants(self, sweeps):
+        """Every combination of the values in sweeps, a list of (layer,
+        setting, mode, values) with setting "blend", "opacity" or
+        "assign", see FixedLayer. Each
+        variant maps (layer, setting, mode) to a value. A setting swept
+        twice raises a ValueError"""
+        keys = [tuple(sweep[:3]) for sweep in sweeps]
+        for key in keys:
+            if keys.count(key) > 1:
+                raise ValueError("{} {} of {} is set in more than one "
+                                 "row".format(key[1], key[2],
+                                              key[0].layer_name_var.get()))
+        return [dict(zip(keys, values))
+                for values in itertools.product(*(s[3] for s in sweeps))]
+
+    @perf.timed("export_variants")
+    def export_variants(self, sweeps, folder, prefix):
+        """Exports a model zip per variant of the layer settings. The
+        layers below the lowest layer being varied are composited once,
+        every variant starts from a copy of that. Variants are composited
+        and written on a pool of worker threads, as many as the memory
+        budget allows. Returns the paths written"""
+        self.flush_render()
+        variants = self.variants(sweeps)
+        first = min(self.layers.index(s[0]) for s in sweeps)
+
+        # shared part of the stack
+        base = gen_blank_data()
+        for i, layer in enumerate(self.layers[:first]):
+            if layer.visible and type(layer) != self.Mask:
+                self.render_layer(base, i, layer)
+        # masks don't vary, so are only worked out once
+        upper = [(layer, self.seek_masks(i))
+                 for i, layer in enumerate(self.layers)
+                 if i >= first and layer.visible and
+                 type(layer) != self.Mask]
+        TASKMODEL.update_options()
+
+        def fixed(variant):
+            # settings are read here, worker threads can't touch Tk
+            overrides = {}
+            for (layer, setting, mode), value in variant.items():
+                overrides.setdefault(layer, {})[(setting, mode)] = value
+            stack = [(FixedLayer(layer, overrides.get(layer, {})), mask)
+                     for layer, mask in upper]
+            return stack, self.stack_keys(self.fixed_stack(overrides))
+
+        def export(n, stack, keys):
+            rendered = {m: np.copy(base[m]) for m in base}
+            for layer, mask in stack:
+                self.composite_onto(rendered, layer, mask)
+            name = TASKMODEL.sanitise_name("{}_{:02d}".format(prefix, n))
+            path = os.path.join(folder, name + ".zip")
+            shapes = {m: a.shape for m, a in rendered.items()}
+            TASKMODEL.write_model(
+                lambda modes: volume_slabs(rendered, modes), path, name,
+                shapes, keys)
+            return path
+
+        # a variant holds its composite while being written
+        per_variant = sum(a.nbytes for a in base.values())
+        spare = APP.main_iw.memory_budget - self.memory_usage()
+        workers = max(1, min(os.cpu_count() or 1, len(variants),
+                             spare // per_variant))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            jobs = [pool.submit(export, n, *fixed(v))
+                    for n, v in enumerate(variants, 1)]
+            paths = [job.result() for job in jobs]
+
+        # which settings went into which file
+        listing = [{"file": os.path.basename(path),
+                    "settings": [{"layer": k[0].layer_name_var.get(),
+                                  "setting": k[1],
+                                  "mode": k[2],
+                                  "value": v} for k, v in variant.items()]}
+                   for path, variant in zip(paths, variants)]
+        with open(os.path.join(folder, prefix + "_variants.json"), "w") as f:
+            json.dump(listing, f, indent=1)
+        return paths
+
+    def update_memory(self):
+        """Shows the memory used per layer and in total, freeing caches
+        first if the total is over the budget"""
+        budget = APP.main_iw.memory_budget
+        total = self.memory_usage()
+        if total > budget:
+            total = self.evict_caches(budget)
+        if total > budget:
+            total = self.spill_layers(budget)
+        for l in self.layers:
+            l.update_memory_label()
+        APP.main_iw.show_memory(total, budget)
+        if self.compress_job is not None:
+            self.after_cancel(self.compress_job)
+        self.compress_job = self.after(COMPRESS_DELAY, self.compress_idle)
+
+    def compress_idle(self):
+        """Compresses the layers in RAM that have not changed for a while"""
+        self.compress_job = None
+        self.spill_removed()
+        now = time.monotonic()
+        for l in self.layers:
+            if (not l.spilled and l.compressed_at != l.last_used and
+                    now - l.last_used > COMPRESS_DELAY / 1000):
+                l.compress()
+        self.update_memory()
+
+    def memory_usage(self):
+        """Bytes held by all layers, masks, the viewer, the history and
+        the mask cache"""
+        total = (APP.main_mvw.memory_usage() + packed.cache_bytes() +
+                 HISTORY.nbytes + self.mask_cache.nbytes)
+        for l in self.layers + self.removed:
+            total += sum(l.memory_usage())
+        return total
+
+    def evict_caches(self, budget):
+        """Frees caches until memory use is under budget, starting with
+        those that are least likely to be needed again. Returns the
+        memory use afterwards"""
+        steps = (packed.clear_cache,
+                 self.mask_cache.clear,
+                 self.drop_stale,
+                 APP.main_mvw.drop_caches,
+                 self.drop_pyramids)
+        total = self.memory_usage()
+        for step in steps:
+            if total <= budget:
+                break
+            step()
+            total = self.memory_usage()
+        return total
+
+    def spill_layers(self, budget):
+        """Moves layers to disk until memory use is under budget, removed
+        layers kept for undo first, then hidden layers and then the ones
+        least recently changed. Returns the memory use afterwards"""
+        order = self.removed + sorted(self.layers,
+                                      key=lambda l: (l.visible, l.last_used))
+        total = self.memory_usage()
+        for l in order:
+            if total <= budget:
+                break
+            if not l.spilled:
+                l.spill()
+                total = self.memory_usage()
+        return total
 
-    def seek_masks(self, idx):
-        """gets masks directly above the layer at current index"""
-        try:
-            possible = self.layers[(idx+1):]
-        except IndexError:
-            possible = []
-        mask = 1
-        for p in possible:
+    def drop_stale(self):
+        for l in self.layers:
+            l.drop_stale()
+
+    def drop_pyramids(self):
+        for l in self.layers:
+            l.pyramid = {}
+
+    def data_usage(self):
+        """Bytes held by layer data and the rendered volume, which unlike
+        caches cannot be freed"""
+        total = array_bytes(APP.main_mvw.data.values())
+        for l in self.layers:
+            total += l.memory_usage()[0]
+        return total
+
+    def resize_usage(self, target_shapes):
+        """Estimated bytes held after resampling everything to
+        target_shapes, once caches have been freed"""
+        total = sum(int(np.prod(s)) for s in target_shapes.values())
+        for l in self.layers:
+            seen = set()
+            for key, shape, order in l.resample_targets(target_shapes):
+                source = l.get_source(key)
+                total += array_bytes([source], seen)
+                if source.shape != shape:
+                    total += int(np.prod(shape))
+        return total
+
+    def confirm_memory(self, needed, action):
+        """Asks before an action that would take memory use to needed
+        bytes, if that is over the budget"""
+        budget = APP.main_iw.memory_budget
+        if needed <= budget:
+            return True
+        message = ("{} will use about {} of memory, over the budget of {}."
+                   "\n\nContinue anyway?").format(action,
+                                                    format_bytes(needed),
+                                                    format_bytes(budget))
+        return messagebox.askyesno("Memory budget", message, parent=APP)
+
+    def render_interactive(self, *args):
+        """Renders a low resolution preview straight away and schedules
+        a full resolution render for when the user stops interacting"""
+        shape = APP.main_iw.get_shape()
+        if np.prod(shape) < PREVIEW_MIN_VOXELS:
+            self.render()
+            return
+        self.render(level=PREVIEW_LEVEL)
+        self.cancel_refine()
+        self.refine_job = self.after(REFINE_DELAY, self.render)
+
+    def cancel_refine(self):
+        if self.refine_job is not None:
+            self.after_cancel(self.refine_job)
+            self.refine_job = None
+
+    def flush_render(self):
+        """Makes sure the viewer holds a full resolution render,
+        used before anything is exported"""
+        if self.refine_job is not None:
+            self.render()
+
+    @perf.timed("seek_masks")
+    def seek_masks(self, idx, level=0):
+        """gets masks directly above the layer at current index, combined
+        into one uint8 mask. Chains of several masks are cached until one
+        of them changes. If any of them are sparse, only the overlap of
+        their boxes is computed"""
+        chain = self.mask_chain(idx)
+        masks = []
+        for p in chain:
+            m = p.get_level("mask", level)
+            masks.append(m.value if constant.is_constant(m) else m)
+        if not masks:
+            return 255
+        if len(masks) == 1:
+            return masks[0]
+
+        # masks change version when their data is modified, and shape
+        # when resized
+        key = (level,) + tuple((p.uid, p.version, np.shape(m))
+                               for p, m in zip(chain, masks))
+        cached = self.mask_cache.get(key)
+        if cached is not None:
+            perf.count("mask_cache.hit")
+            return cached
+        perf.count("mask_cache.miss")
+        combined = self.combine_masks(masks, get_shapes_dict(level)['iso'])
+        self.mask_cache.put(key, combined, array_bytes([combined]))
+        return combined
+
+    def mask_chain(self, idx):
+        """The visible masks directly above the layer at idx"""
+        chain = []
+        for p in self.layers[(idx+1):]:
             if type(p) != self.Mask:
                 break
             elif p.visible:
-                mask = np.multiply(mask, p.maskdata/255)
-        return mask * 255
-
-    def composite_layer(self, olddata, layer, mask, mode):
+                chain.append(p)
+        return chain
+
+    def combine_masks(self, masks, shape):
+        """Product of masks covering a volume of shape, as uint8"""
+        box = None
+        for m in masks:
+            mbox = sparse.bounds(m)
+            if mbox is not None:
+                box = mbox if box is None else sparse.intersect(box, mbox)
+        mask = 1
+        for m in masks:
+            if box is not None:
+                m = sparse.take(m, box)
+            mask = np.multiply(mask, m/255)
+        mask = np.rint(np.multiply(mask, 255)).astype(np.uint8)
+        if box is None:
+            return mask
+        return sparse.SparseVolume(box, mask, shape)
+
+    def fixed_stack(self, overrides={}):
+        """The visible layers as FixedLayers, each with the chain of masks
+        above it. overrides maps layers to the settings replaced, see
+        FixedLayer. Settings are read now, later changes have no effect"""
+        stack = []
+        for i, layer in enumerate(self.layers):
+            if layer.visible and type(layer) != self.Mask:
+                stack.append((FixedLayer(layer, overrides.get(layer, {})),
+                              self.mask_chain(i)))
+        return stack
+
+    def stack_keys(self, stack):
+        """Key per mode that changes whenever the composite of the mode
+        would, made from the ids, data versions and shapes of the layers
+        and masks in stack and the layer settings for the mode. Equal keys
+        mean equal channels within a session"""
+        keys = {}
+        for mode in TASKMODEL.modes:
+            state = [tuple(APP.main_iw.get_shape())]
+            for layer, chain in stack:
+                state.append((layer.layer.uid,
+                              layer.layer.version,
+                              np.shape(layer.get_level(mode, 0)),
+                              layer.composites[mode].get(),
+                              layer.opacities[mode].get(),
+                              layer.segment if mode == "segment" else None,
+                              [(p.uid, p.version,
+                                np.shape(p.get_channel("mask")))
+                               for p in chain]))
+            keys[mode] = hashlib.sha1(repr(state).encode()).hexdigest()
+        return keys
+
+    def composite_slabs(self, stack=None, modes=None):
+        """Composites the layer stack a slab of slices along the first axis
+        at a time, yielding a dict of the channels of each slab. This is
+        the order the exported nrrds are stored in, so the full composite
+        never has to exist. Only modes are composited if given"""
+        if stack is None:
+            stack = self.fixed_stack()
+        if modes is None:
+            modes = TASKMODEL.modes
+        stack = [(layer, [p.get_channel("mask") for p in chain])
+                 for layer, chain in stack]
+        shapes = get_shapes_dict()
+        for start, stop in slab_ranges(shapes):
+            rendered = {m: np.zeros((stop - start,) + shapes[m][1:],
+                                    np.uint8)
+                        for m in modes}
+            for layer, masks in stack:
+                masks = [m.value if constant.is_constant(m) else m
+                         for m in masks]
+                masks = [slab_of(m, start, stop) for m in masks]
+                if not masks:
+                    mask = 255
+                elif len(masks) == 1:
+                    mask = masks[0]
+                else:
+                    mask = self.combine_masks(masks,
+                                              rendered['iso'].shape)
+                self.composite_onto(rendered,
+                                    FixedLayer(layer, {}, (start, stop)),
+                                    mask)
+            yield rendered
+
+    @perf.timed("composite_layer")
+    def composite_layer(self, olddata, layer, mask, mode, level=0):
+        """Blends layer data onto olddata. Only the overlap of sparse layer
+        data and masks is blended voxel by voxel, outside it the result is
+        what blending zero data or a zero mask gives"""
         comp = layer.composites[mode].get()
         if comp == "DISABLED":
             return olddata
-        # multiply mask by opacity
-        mask = mask * layer.opacities[mode].get() / 255
-        # apply mask to layer data, in multiply case we invert
-        if comp == "MULTIPLY":
-            newdata = np.multiply(np.subtract(255, layer.data[mode]),
-                                  mask).astype(np.uint8)
+        data = layer.get_level(mode, level)
+        if constant.is_constant(data):
+            # the value broadcasts against any region
+            data = data.value
+        opacity = layer.opacities[mode].get()
+        everything = sparse.full_box(olddata.shape)
+        databox = sparse.bounds(data) or everything
+        maskbox = sparse.bounds(mask) or everything
+        inside = sparse.intersect(databox, maskbox)
+
+        def blend_box(box, boxdata):
+            # multiply mask by opacity
+            boxmask = sparse.take(mask, box) * opacity / 255
+            return blend(olddata[sparse.box_slices(box)],
+                         boxdata,
+                         boxmask,
+                         comp,
+                         mode)
+
+        if inside == everything:
+            return blend_box(everything, sparse.take(data, everything))
+
+        result = blend_box(inside, sparse.take(data, inside))
+        if mode == "segment" and comp == "REPLACE":
+            output = np.zeros_like(olddata)
+        elif mode != "segment" and comp in ("REPLACE", "MULTIPLY"):
+            # zero data still darkens or replaces where the mask is set
+            output = olddata
+            output[sparse.box_slices(maskbox)] = blend_box(maskbox, 0)
         else:
-            newdata = np.multiply(layer.data[mode], mask).astype(np.uint8)
-
-        if mode != "segment":
-            if comp == "REPLACE":
-                if newdata.ndim == 4 and mode == 'iso':
-                    newdata = newdata.squeeze()
-                # REPLACE data, old data shown where mask < 1
-                output = (newdata +
-                          np.multiply(olddata, (1-mask))).astype(np.uint8)
-
-            elif comp == "ADD":
-                # ADD layer data
-                diff = 255 - newdata  # a temp uint8 array here
-                np.putmask(olddata, diff < olddata, diff)
-                output = np.add(
-                                olddata,
-                                newdata)
-            elif comp == "MULTIPLY":
-
-                # MULTIPLY layer data
-                output = np.subtract(olddata, np.multiply(newdata/255,
-                                     olddata)).astype(np.uint8)
-            # if disabled, do nothing
-        elif mode == "segment":
-            # special settings for segment
-            comp = layer.composites[mode].get()
-            if comp == "REPLACE":
-                output = newdata
-            elif comp == "SMART":
-                # where there is no new data, use previous data
-                np.putmask(newdata, newdata == 0, olddata)
-                output = newdata
-        else:
-            Exception("Unknown mode recieved")
-
+            output = olddata
+        output[sparse.box_slices(inside)] = result
         return output
 
     class LayerObject(tk.Frame):
         height = 60
+        # ids stay with a layer for the whole session, see autosave_state
+        uids = itertools.count()
 
         def create_icons(self, objectname):
             # icons
@@ -661,21 +1273,200 @@ class LayerSystem(tk.Frame):
                 i += 1
 
 
+        def create_source_label(self, text, tooltip):
+            """Source label, with the memory used by the layer next to it"""
+            frame = tk.Frame(self)
+            frame.grid(row=0, column=1, sticky="SEW", padx=3)
+            src = tk.Label(
+                     frame,
+                     anchor="w",
+                     font=OVERLAY_FONT,
+                     text=text)
+            src.pack(side=tk.LEFT)
+            hover.createToolTip(src, tooltip)
+            self.memory_label = tk.Label(
+                     frame,
+                     anchor="e",
+                     font=TINY_FONT,
+                     fg=MEDIUM_GREY)
+            self.memory_label.pack(side=tk.RIGHT)
+            hover.createToolTip(self.memory_label,
+                                "Memory used by data (and caches)")
+
+        def memory_usage(self):
+            """Returns bytes held in RAM as (data, caches). Arrays shared
+            between the data, the source and the caches are only counted
+            once"""
+            seen = set()
+            data = array_bytes(self.data_arrays(), seen)
+            caches = array_bytes(list(self.resampled.values()) +
+                                 list(self.pyramid.values()), seen)
+            return data, caches
+
+        def update_memory_label(self):
+            data, caches = self.memory_usage()
+            text = "{} ({})".format(format_bytes(data), format_bytes(caches))
+            if self.spilled:
+                text = "on disk, " + text
+            elif self.compressed:
+                text = "compressed, " + text
+            self.memory_label.config(text=text)
+
+        def channel_keys(self):
+            """Keys of the channels holding data"""
+            return [k for k in self.source if self.source[k] is not None]
+
+        @property
+        def spilled(self):
+            return any(SPILL_STORE.is_spilled(sparse.unwrap(a))
+                       for a in self.data_arrays())
+
+        @property
+        def compressed(self):
+            return any(packed.is_compressed(sparse.unwrap(a))
+                       for a in self.data_arrays())
+
+        def map_arrays(self, func):
+            """Replaces every source and current channel by func of it,
+            arrays shared between the two or with the resample cache stay
+            shared"""
+            done = {}
+            for key in self.channel_keys():
+                for get, put in ((self.get_source, self.set_source),
+                                 (self.get_channel, self.set_channel)):
+                    old = get(key)
+                    if id(old) not in done:
+                        done[id(old)] = (old, sparse.apply(old, func))
+                    put(key, done[id(old)][1])
+            self.resampled = {k: done[id(v)][1] if id(v) in done else v
+                              for k, v in self.resampled.items()}
+
+        def spill(self):
+            """Moves the layer's data to memory mapped files, which the
+            compositor reads like any other array. Caches are dropped, they
+            are rebuilt from the mapped data when needed"""
+            self.resampled = {}
+            self.pyramid = {}
+            self.map_arrays(SPILL_STORE.spill)
+
+        def restore(self):
+            """Brings spilled data back into RAM"""
+            self.map_arrays(SPILL_STORE.restore)
+
+        def compress(self):
+            """Keeps the channels that compress well as compressed chunks,
+            which are decompressed as they are read"""
+            self.drop_stale()
+            self.map_arrays(packed.compress)
+            self.compressed_at = self.last_used
+
+        def drop_stale(self):
+            """Drops resampled copies that are not the current data"""
+            current = set(id(a) for a in self.data_arrays())
+            self.resampled = {k: v for k, v in self.resampled.items()
+                              if id(v) in current}
+
+        def autosave_state(self):
+            """Settings and current channels for the autosave journal.
+            Channels are keyed by an id that changes with the data"""
+            channels = {}
+            for key in self.channel_keys():
+                data = self.get_channel(key)
+                blobid = "{}.{}.{}.{}".format(self.uid, key, self.version,
+                                              "x".join(map(str, data.shape)))
+                channels[blobid] = data
+            state = {"uid": self.uid,
+                     "name": self.layer_name_var.get(),
+                     "gen": self.gen,
+                     "visible": self.visible,
+                     "channels": {k.split(".")[1]: k for k in channels}}
+            return state, channels
+
         def toggle_visible(self):
             # change icon
             self.visible = not self.visible
+            self.last_used = time.monotonic()
+            # hidden layers are spilled first once memory runs short, see
+            # spill_layers
+            if self.visible and self.spilled:
+                self.restore()
             self.parent.render()
             txt = u"\u2713" if self.visible else "-"
             self.icons['visible'].config(text=txt)
+            self.parent.record("Toggle visibility",
+                               self.toggle_visible,
+                               self.toggle_visible)
 
         def invert(self):
-            for mode in TASKMODEL.compmodes:
-                self.data[mode] = 255 - self.data[mode]
+            modes = [m for m in TASKMODEL.compmodes if self.data[m] is not None]
+            self.modify(lambda d: 255 - d, modes, "Invert layer")
+            self.parent.render()
+
+        def get_level(self, key, level):
+            """Returns channel data at a pyramid level, each level being
+            half the resolution of the one below. Built on first use"""
+            if level == 0:
+                return self.get_channel(key)
+            try:
+                return self.pyramid[(key, level)]
+            except KeyError:
+                data = downsample(self.get_level(key, level - 1))
+                self.pyramid[(key, level)] = data
+                return data
+
+        def drop_levels(self, key):
+            for level in range(1, PYRAMID_LEVELS + 1):
+                self.pyramid.pop((key, level), None)
+
+        def modify(self, func, keys, name="Modify layer"):
+            """Applies func to the source and current data of each channel.
+            Resampled copies are dropped since they are now stale. The
+            change to the source is kept in the history as a delta"""
+            changes = {}
+            for key in keys:
+                source = self.get_source(key)
+                current = self.get_channel(key)
+                newsource = compact(func(source))
+                changes[key] = diff(source, newsource)
+                self.set_source(key, newsource)
+                if current is source:
+                    self.set_channel(key, newsource)
+                else:
+                    self.set_channel(key, compact(func(current)))
+            self.resampled = {}
+            self.last_used = time.monotonic()
+            self.version += 1
+            self.parent.record(name,
+                               lambda: self.apply_changes(changes, "undo"),
+                               lambda: self.apply_changes(changes, "redo"),
+                               nbytes=sum(c.nbytes for c in changes.values()))
+
+        def apply_changes(self, changes, direction):
+            """Undoes or redoes changes recorded by modify. Resized data is
+            resampled again from the source, which is all that is stored"""
+            for key, change in changes.items():
+                source = self.get_source(key)
+                current = self.get_channel(key)
+                newsource = compact(getattr(change, direction)(source))
+                self.set_source(key, newsource)
+                if current is source or np.ndim(current) == 0:
+                    self.set_channel(key, newsource)
+                else:
+                    order = 0 if key == "segment" else 1
+                    self.set_channel(key, resample_array(newsource,
+                                                         current.shape,
+                                                         order))
+            self.resampled = {}
+            self.last_used = time.monotonic()
+            self.version += 1
             self.parent.render()
 
         def duplicate(self):
+            # copies are made in RAM, even if the data is on disk
+            data = {k: None if v is None else np.array(v)
+                    for k, v in self.data.items()}
             self.parent.layer_from_data(
-                                        copy.deepcopy(self.data),
+                                        data,
                                         self.layer_name_var.get(),
                                         self.gen)
 
@@ -689,9 +1480,7 @@ class LayerSystem(tk.Frame):
             self.parent.swaplayer(self, direction)
 
         def delete(self):
-            self.destroy()
-            self.parent.layers.remove(self)
-            self.parent.render()
+            self.parent.remove_layers([self], "Delete layer")
 
     class Mask(LayerObject):
         def __init__(self, parent, maskdata, name, gen, **kwargs):
@@ -710,18 +1499,23 @@ class LayerSystem(tk.Frame):
             self.grid_rowconfigure(1, weight=1)
             self.grid_propagate(0)
             self.create_icons("mask")
-            self.maskdata = maskdata.squeeze() if maskdata is not None else 1
+            self.last_used = time.monotonic()
+            self.compressed_at = None
+            self.uid = next(self.uids)
+            self.version = 0
+            if maskdata is not None:
+                self.maskdata = compact(maskdata.squeeze())
+            else:
+                self.maskdata = 1
+            self.source = self.maskdata
+            self.resampled = {}
+            self.pyramid = {}
             self.gen = gen
             self.layer_name_var = tk.StringVar()
             self.layer_name_var.set(name)
             # source
-            src = tk.Label(
-                     self,
-                     anchor="w",
-                     font=OVERLAY_FONT,
-                     text="MASK: {}".format(gen.upper()))
-            src.grid(row=0, column=1, sticky="SEW", padx=3)
-            hover.createToolTip(src, "Mask source")
+            self.create_source_label("MASK: {}".format(gen.upper()),
+                                     "Mask source")
 
             # name
             ne = ttk.Entry(
@@ -732,10 +1526,40 @@ class LayerSystem(tk.Frame):
             hover.createToolTip(ne, "Mask name")
 
         def invert(self):
-
-            self.maskdata = 255 - self.maskdata
+            self.modify(lambda d: 255 - d, ["mask"], "Invert mask")
             self.parent.render()
 
+        def data_arrays(self):
+            return [self.maskdata, self.source]
+
+        def channel_keys(self):
+            if np.ndim(self.source) > 0:
+                return ["mask"]
+            return []
+
+        def resample_targets(self, target_shapes):
+            if np.ndim(self.source) == 0:
+                return []
+            return [("mask", tuple(target_shapes['iso']), 1)]
+
+        def get_source(self, key):
+            return self.source
+
+        def set_source(self, key, data):
+            self.source = data
+
+        def get_channel(self, key):
+            return self.maskdata
+
+        def set_channel(self, key, data):
+            self.maskdata = data
+            self.drop_levels(key)
+
+        def autosave_state(self):
+            state, channels = super().autosave_state()
+            state["type"] = "mask"
+            return state, channels
+
         def to_dict(self):
             return {
                 "type": "mask",
@@ -753,6 +1577,8 @@ class LayerSystem(tk.Frame):
 
         def __init__(self, parent, data, name, gen, **kwargs):
             self.parent = parent
+            # blend settings as last recorded, see on_param
+            self.params = None
             tk.Frame.__init__(
                               self,
                               parent.layerframe.interior,
@@ -771,15 +1597,13 @@ class LayerSystem(tk.Frame):
             self.grid_rowconfigure(1, weight=1)
             self.grid_propagate(0)
             self.create_icons("layer")
+            self.last_used = time.monotonic()
+            self.compressed_at = None
+            self.uid = next(self.uids)
+            self.version = 0
 
             # source
-            src = tk.Label(
-                     self,
-                     anchor="w",
-                     font=OVERLAY_FONT,
-                     text=gen.upper())
-            src.grid(row=0, column=1, sticky="SEW", padx=3)
-            hover.createToolTip(src, "Layer source")
+            self.create_source_label(gen.upper(), "Layer source")
 
             # name
             ne = ttk.Entry(
@@ -800,7 +1624,7 @@ class LayerSystem(tk.Frame):
                                     self,
                                     cvar,
                                     *self.comp_functions,
-                                    command=parent.render)
+                                    command=self.on_param)
                 bx.grid(row=0, column=i, sticky="ew")
                 bx.config(width=self.max_comp_width)
                 if data[mode] is None:
@@ -817,7 +1641,7 @@ class LayerSystem(tk.Frame):
                                 self,
                                 from_=0,
                                 to=1,
-                                command=parent.render)
+                                command=self.on_param)
                 scale.grid(row=1, column=i, sticky="ew")
                 scale.set(1)
                 hover.createToolTip(scale, "Opacity")
@@ -831,13 +1655,23 @@ class LayerSystem(tk.Frame):
                                 self,
                                 svar,
                                 *self.segment_functions,
-                                command=parent.render)
+                                command=self.on_param)
             bx.grid(row=0, column=i, sticky="ew")
             bx.config(width=self.max_comp_width)
 
             if not "segment" in data:
                 data["segment"] = None
 
+            # constant channels only keep their value, mostly empty ones
+            # their bounding box
+            for k in data:
+                data[k] = compact(data[k])
+
+            # original resolution data, resampled from on resize
+            self.source = dict(data)
+            self.resampled = {}
+            self.pyramid = {}
+
             if data['segment'] is None:
                 svar.set(self.segment_functions[-1])  # disabled
                 bx.state(["disabled"])
@@ -871,29 +1705,90 @@ class LayerSystem(tk.Frame):
 
             make_segmod("-", "Decrement segment", -1, 0)
             make_segmod("+", "Increment segment", 1, 1)
+            self.params = self.get_params()
+
+        def get_params(self):
+            return ({m: self.composites[m].get() for m in self.composites},
+                    {m: self.opacities[m].get() for m in self.opacities})
+
+        def set_params(self, params):
+            self.set_composites(params[0])
+            self.set_opacities(params[1])
+            self.parent.render()
+
+        def on_param(self, *args):
+            """Records a change of blend mode or opacity, changes made
+            within a second of each other are undone together"""
+            if self.params is not None:
+                old, new = self.params, self.get_params()
+                if new != old:
+                    self.params = new
+                    self.parent.record("Change blending",
+                                       lambda: self.set_params(old),
+                                       lambda: self.set_params(new),
+                                       merge_key=(id(self), "params"))
+            self.parent.render_interactive()
 
         def seg_mod(self, amount):
-            tempdata = np.copy(self.data['segment'])
-            if amount > 0:
-                buff = 15-amount
-                criteria = tempdata > buff
-            else:
-                buff = -amount
-                criteria = tempdata < buff
-            np.putmask(tempdata, criteria, buff)
-            # modify the data only where data > 0
-            np.putmask(tempdata, tempdata > 0,
-                       (tempdata + amount).astype(np.uint8))
-            self.data['segment'] = tempdata
+            def shift(data):
+                tempdata = np.copy(data)
+                if amount > 0:
+                    buff = 15-amount
+                    criteria = tempdata > buff
+                else:
+                    buff = -amount
+                    criteria = tempdata < buff
+                np.putmask(tempdata, criteria, buff)
+                # modify the data only where data > 0
+                np.putmask(tempdata, tempdata > 0,
+                           (tempdata + amount).astype(np.uint8))
+                return tempdata
+
+            self.modify(shift, ['segment'], "Change segment")
             self.parent.render()
 
+        def data_arrays(self):
+            return list(self.data.values()) + list(self.source.values())
+
+        def resample_targets(self, target_shapes):
+            targets = []
+            for mode in TASKMODEL.modes:
+                if self.source[mode] is not None:
+                    order = 0 if mode == "segment" else 1
+                    targets.append((mode, tuple(target_shapes[mode]), order))
+            return targets
+
+        def get_source(self, key):
+            return self.source[key]
+
+        def set_source(self, key, data):
+            self.source[key] = data
+
+        def get_channel(self, key):
+            return self.data[key]
+
+        def set_channel(self, key, data):
+            self.data[key] = data
+            self.drop_levels(key)
+
         def set_composites(self, new_composites):
             for comp_mode, comp_value in new_composites.items():
                 self.composites[comp_mode].set(comp_value)
+            self.params = self.get_params()
 
         def set_opacities(self, new_opacities):
             for comp_mode, opacity_value in new_opacities.items():
                 self.opacities[comp_mode].set(opacity_value)
+            self.params = self.get_params()
+
+        def autosave_state(self):
+            state, channels = super().autosave_state()
+            state["type"] = "layer"
+            compmodes, opacities = self.get_params()
+            state["compmodes"] = compmodes
+            state["opacities"] = {m: opacities[m]
+                                  for m in TASKMODEL.compmodes}
+            return state, channels
 
         def to_dict(self):
             data = {}
@@ -918,8 +1813,18 @@ class ModelViewerWidget(tk.Frame):
         self.w = self.cget('width')
         self.h = self.cget('height')
 
-        # general initial blank data
+        # general initial blank data. data always holds the last full
+        # resolution render, display holds what is currently shown
         self.data = {}
+        self.display = {}
+        self.level = 0
+        # bumped on every push so cached images of old renders are not used
+        self.generation = 0
+        self.hover_view = None
+        self.frame_times = deque()
+        # slicing friendly copies of the active channel, see axis_data
+        self.axis_copies = {}
+        self.axis_copies_key = None
 
         self.zoomlvl = 1
 
@@ -958,7 +1863,7 @@ class ModelViewerWidget(tk.Frame):
     def get_images(self):
         images, names = [], []
         for v in self.views:
-            images.append(v.orig_img)
+            images.append(v.full_img())
             names.append("axis{:d}".format(v.axis))
         return zip(images, names)
 
@@ -972,13 +1877,10 @@ class ModelViewerWidget(tk.Frame):
 
     class ModelViewerCanvas(tk.Canvas):
 
-        activecanvas = None
-
         def __init__(self, parent, axis, axisname, m, n, **kwargs):
             self.axis_colour = AXIS_COLOUR_LIST[axis]
             self.axis_light_colour = CANVAS_COLOUR_LIST[axis]
             self.mvw = parent
-            self.hline, self.vline = None, None
             self.index = 0
             self.axisname = "{}. {}".format(axis, axisname)
             self.w = int(self.mvw.w/m)
@@ -990,15 +1892,35 @@ class ModelViewerWidget(tk.Frame):
                                **kwargs)
             self.axis = axis
             self.other_axes = [0, 1, 2].pop(axis)
+            self.cache = LRUCache(CROSSSECTION_CACHE_BYTES)
+            self.cache_generation = None
+            self.frame_job = self.prefetch_job = None
+            self.last_frame = 0
             self.create_slider(self.mvw.controlframe)
             self.setup_display()
 
         def setup_display(self):
-            self.image_on_canvas = self.create_image(self.w/2, self.h/2,
-                                                     anchor=tk.CENTER)
+            self.image_on_canvas = self.create_image(0, 0, anchor=tk.NW)
+            self.pan = [0, 0]
+            self.data = None
+            # index lines and hover readout are created once and moved
+            self.hline = self.create_line(0, 0, 0, 0, width=2,
+                                          state=tk.HIDDEN)
+            self.vline = self.create_line(0, 0, 0, 0, width=2,
+                                          state=tk.HIDDEN)
+            self.probe = self.mvw.HoverProbe(self)
             self.bind(
                       "<Motion>",
                       self.display_hover)
+            self.bind(
+                      "<ButtonPress-3>",
+                      self.start_pan)
+            self.bind(
+                      "<B3-Motion>",
+                      self.drag_pan)
+            self.bind(
+                      "<Double-Button-3>",
+                      self.reset_pan)
             self.bind(
                       "<MouseWheel>",
                       self.mouse_wheel)
@@ -1016,31 +1938,71 @@ class ModelViewerWidget(tk.Frame):
             self.canvastext.pack(pady=(0, 3))
             textframe.place(anchor="se", relx=1, rely=1)
 
-            self.hovertxt = self.hoverb = 0
-
 
         def slice_data(self):
+            """Slices the displayed volume at the current index"""
+            self.data, self.slice_index = self.slice_at(self.index)
+            return self.data
+
+        def slice_at(self, index):
+            """Returns the slice at full resolution index along with its
+            index into the displayed volume"""
+            axisdata = self.mvw.axis_data(self.axis)
+            if axisdata is None:
+                return None, 0
+            index = min(index // self.mvw.scale, axisdata.shape[0] - 1)
+            return axisdata[index], index
+
+        @perf.timed("update_crosssection")
+        def update_crosssection(self):
+            self.show()
 
+        def show(self):
+            """Displays the visible part of the current slice at the
+            current zoom and pan"""
+            # slicing is only a view, so is always redone for hovering
+            dataslice = self.slice_data()
+            self.set_orig_size(dataslice)
+            if dataslice is None:
+                # nothing rendered yet
+                self.itemconfig(self.image_on_canvas, image="")
+                return
+            self.img, self.pimg, self.img_pos = self.rendered(self.index,
+                                                              dataslice)
+
+            self.coords(self.image_on_canvas, *self.img_pos)
+            self.itemconfig(self.image_on_canvas, image=self.pimg)
             try:
-                if self.axis == 0:
-                    self.data = self.mvw.activedata[self.index, :, :]
-                    return self.data
-                elif self.axis == 1:
-                    self.data = self.mvw.activedata[:, self.index, :]
-                    return self.data
-                elif self.axis == 2:
-                    self.data = self.mvw.activedata[:, :, self.index]
-                    return self.data
-                else:
-                    raise ValueError('Invalid axis supplied')
-            except TypeError:
-                return None
+                self.update_all_lines()
+            except AttributeError:
+                pass
 
-        def update_crosssection(self):
-            dataslice = self.slice_data()
-            self.img = self.smart_img_from_array(dataslice)
-            self.set_orig_img()
-            self.zoom()
+        def rendered(self, index, dataslice=None):
+            """Image of the slice at index, reusing a previously rendered
+            image where possible"""
+            mvw = self.mvw
+            if self.cache_generation != mvw.generation:
+                # images of older renders will never be shown again
+                self.cache.clear()
+                self.cache_generation = mvw.generation
+            key = (mvw.generation, mvw.tabrow.tab, self.axis, index,
+                   mvw.zoomlvl, tuple(self.pan))
+            cached = self.cache.get(key)
+            if cached is None:
+                perf.count("crosssection.cache_miss")
+                if dataslice is None:
+                    dataslice, _ = self.slice_at(index)
+                cached = self.zoom_img(dataslice)
+                w, h = cached[0].size
+                # photo images are stored by Tk as 32 bit pixels
+                self.cache.put(key, cached, w * h * 4)
+            else:
+                perf.count("crosssection.cache_hit")
+            return cached
+
+        def full_img(self):
+            """Unscaled image of the whole current slice"""
+            return self.smart_img_from_array(self.slice_data())
 
         def smart_img_from_array(self, data):
             if data is not None:
@@ -1048,7 +2010,7 @@ class ModelViewerWidget(tk.Frame):
                     imgmode = 'L'
                     # data = data.transpose((1,0))
                 elif data.ndim == 3 and data.shape[2] == 1:
-                    data = np.squeeze(data)
+                    data = data[:, :, 0]
                     imgmode = 'L'
                     # data = data.transpose((1,0))
                 elif data.ndim == 3 and data.shape[2] == 3:
@@ -1068,21 +2030,71 @@ class ModelViewerWidget(tk.Frame):
                 img = Image.new("RGB", (10, 10), "white")
             return img
 
-        def set_orig_img(self):
-            """keeps a hold of unscaled image"""
-            self.orig_img = self.img
-            self.orig_imgw, self.orig_imgh = self.img.size
+        def set_orig_size(self, dataslice):
+            """keeps a hold of unscaled slice size"""
+            if dataslice is None:
+                self.orig_imgw, self.orig_imgh = 10, 10
+            else:
+                self.orig_imgh, self.orig_imgw = dataslice.shape[:2]
 
         def zoom(self):
-            new_w = max(1, int(self.orig_imgw * self.mvw.zoomlvl))
-            new_h = max(1, int(self.orig_imgh * self.mvw.zoomlvl))
-            self.img = self.orig_img.resize((new_w, new_h), Image.NEAREST)
-            self.pimg = ImageTk.PhotoImage(self.img)
-            self.itemconfig(self.image_on_canvas, image=self.pimg)
-            try:
-                self.update_all_lines()
-            except AttributeError:
-                pass
+            self.show()
+
+        @perf.timed("zoom_img")
+        def zoom_img(self, dataslice):
+            """Crops the slice to the region visible on the canvas before
+            scaling it up, so the cost is bounded by the canvas size"""
+            z = self.mvw.zoomlvl * self.mvw.scale
+            cx, cy = self.view_centre()
+            halfw, halfh = self.w / 2 / z, self.h / 2 / z
+            x0 = max(0, int(np.floor(cx - halfw)))
+            x1 = min(self.orig_imgw, int(np.ceil(cx + halfw)))
+            y0 = max(0, int(np.floor(cy - halfh)))
+            y1 = min(self.orig_imgh, int(np.ceil(cy + halfh)))
+            if dataslice is not None:
+                dataslice = dataslice[y0:y1, x0:x1]
+            img = self.smart_img_from_array(dataslice)
+            new_w = max(1, int(round((x1 - x0) * z)))
+            new_h = max(1, int(round((y1 - y0) * z)))
+            img = img.resize((new_w, new_h), Image.NEAREST)
+            pos = (self.w / 2 + (x0 - cx) * z,
+                   self.h / 2 + (y0 - cy) * z)
+            return img, ImageTk.PhotoImage(img), pos
+
+        def view_centre(self):
+            """Slice pixel shown at the centre of the canvas"""
+            scale = self.mvw.scale
+            return (self.orig_imgw / 2 + self.pan[0] / scale,
+                    self.orig_imgh / 2 + self.pan[1] / scale)
+
+        def canvas_to_image(self, x, y):
+            """Slice pixel under canvas position x, y"""
+            z = self.mvw.zoomlvl * self.mvw.scale
+            cx, cy = self.view_centre()
+            ix = int(np.floor(cx + (x - self.w / 2) / z))
+            iy = int(np.floor(cy + (y - self.h / 2) / z))
+            return ix, iy
+
+        def start_pan(self, event):
+            self.pan_anchor = (event.x, event.y)
+
+        def drag_pan(self, event):
+            """pan is kept in full resolution voxels so it is unaffected
+            by preview renders"""
+            z = self.mvw.zoomlvl
+            ax, ay = self.pan_anchor
+            self.pan_anchor = (event.x, event.y)
+            maxx = self.orig_imgw * self.mvw.scale / 2
+            maxy = self.orig_imgh * self.mvw.scale / 2
+            panx = self.pan[0] - (event.x - ax) / z
+            pany = self.pan[1] - (event.y - ay) / z
+            self.pan = [min(maxx, max(-maxx, panx)),
+                        min(maxy, max(-maxy, pany))]
+            self.show()
+
+        def reset_pan(self, event=None):
+            self.pan = [0, 0]
+            self.show()
 
         def update_all_lines(self):
             for v in self.mvw.views:
@@ -1093,7 +2105,7 @@ class ModelViewerWidget(tk.Frame):
 
         def update_slider(self):
             try:
-                self.numlayers = self.mvw.activedata.shape[self.axis]
+                self.numlayers = self.mvw.data[self.mvw.tabrow.tab].shape[self.axis]
                 self.slider.state(["!disabled"])
                 self.slider.set_max(self.numlayers-1)
                 self.index = min(self.numlayers-1, int(self.slider.value))
@@ -1115,12 +2127,48 @@ class ModelViewerWidget(tk.Frame):
             self.slider.pack()
 
         def slider_callback(self, sliderval):
-            self.index = int(sliderval)
+            """Only the latest slider value is drawn, at most once per
+            frame budget, so intermediate values of a fast drag are
+            dropped rather than queued"""
+            self.pending_index = int(sliderval)
+            self.cancel_prefetch()
+            if self.frame_job is None:
+                elapsed = (time.perf_counter() - self.last_frame) * 1000
+                wait = int(max(0, SCRUB_FRAME_MS - elapsed))
+                self.frame_job = self.after(wait, self.draw_frame)
+
+        def draw_frame(self):
+            self.frame_job = None
+            self.index = self.pending_index
             self.update_crosssection()
             self.mvw.draw_crosssection_lines(
                                              self.index,
                                              self.numlayers,
                                              self.axis)
+            self.last_frame = time.perf_counter()
+            self.mvw.frame_drawn(self.last_frame)
+            self.prefetch_job = self.after(PREFETCH_DELAY, self.prefetch)
+
+        def prefetch(self, offsets=None):
+            """Renders slices either side of the current one into the
+            cache, one per idle callback so the UI stays responsive"""
+            if offsets is None:
+                offsets = []
+                for i in range(1, PREFETCH_SLICES + 1):
+                    offsets += [i, -i]
+            self.prefetch_job = None
+            while offsets:
+                index = self.index + offsets.pop(0)
+                if 0 <= index < self.numlayers:
+                    self.rendered(index)
+                    break
+            if offsets:
+                self.prefetch_job = self.after_idle(self.prefetch, offsets)
+
+        def cancel_prefetch(self):
+            if self.prefetch_job is not None:
+                self.after_cancel(self.prefetch_job)
+                self.prefetch_job = None
 
         def draw_index_line(self, other_index, other_maxindex, other_axis):
             # top view:
@@ -1162,75 +2210,27 @@ class ModelViewerWidget(tk.Frame):
             if direction == 'horizontal':
                 x1 = 0
                 x2 = self.w
-                y1 = self.h/2 + other_relindex*z
+                y1 = self.h/2 + (other_relindex - self.pan[1])*z
                 y2 = y1
-                self.delete(self.hline)
-                self.hline = self.create_line(x1, y1, x2, y2,
-                                              width=2,
-                                              fill=line_colour,
-                                              dash=(d,))
+                self.coords(self.hline, x1, y1, x2, y2)
+                self.itemconfig(self.hline,
+                                fill=line_colour,
+                                dash=(d,),
+                                state=tk.NORMAL)
 
             if direction == 'vertical':
-                x1 = self.w/2 + other_relindex*z
+                x1 = self.w/2 + (other_relindex - self.pan[0])*z
                 x2 = x1
                 y1 = 0
                 y2 = self.h
-                self.delete(self.vline)
-                self.vline = self.create_line(x1, y1, x2, y2,
-                                              width=2,
-                                              fill=line_colour,
-                                              dash=(d,))
+                self.coords(self.vline, x1, y1, x2, y2)
+                self.itemconfig(self.vline,
+                                fill=line_colour,
+                                dash=(d,),
+                                state=tk.NORMAL)
 
         def display_hover(self, event):
-            self.activecanvas = self
-
-            # get current voxel position under cursor
-            img_x, img_y = tuple(self.coords(self.image_on_canvas))
-            x = event.x - img_x
-            y = event.y - img_y
-            z = self.mvw.zoomlvl
-            ix = int(x/z + self.orig_imgw/2)
-            iy = int(y/z  + self.orig_imgh/2)
-
-            strval = self.get_voxel_value(ix, iy)
-            if strval:
-
-                # get cursor quartile
-                v = 'n' if event.y < self.h/2 else 's'
-                h = 'w' if event.x < self.w/2 else 'e'
-                xm = 1 if h == 'w' else -1
-                ym = 1 if v == 'n' else -1
-                xc, yc = 4, 2
-                self.delete(self.hovertxt)
-                self.hovertxt = self.create_text(
-                                                 event.x + (6+xc)*xm,
-                                                 event.y + (6+yc)*ym,
-                                                 font = TAB_FONT,
-                                                 text=strval,
-                                                 anchor=v+h)
-
-                textbbox = self.bbox(self.hovertxt)
-                textbbox = (textbbox[0] - xc,
-                            textbbox[1] - yc,
-                            textbbox[2] + xc,
-                            textbbox[3] + yc)
-                self.delete(self.hoverb)
-                self.hoverb = self.create_rectangle(
-                                                    textbbox,
-                                                    fill="white")
-                self.tag_lower(self.hoverb, self.hovertxt)
-            else:
-                self.hide_hover()
-
-            # hide from others
-            for v in self.mvw.views:
-                if v.activecanvas != self:
-                    v.hide_hover()
-
-
-        def hide_hover(self):
-            self.delete(self.hovertxt)
-            self.delete(self.hoverb)
+            self.probe.motion(event)
 
         def mouse_wheel(self, event):
             self.display_hover(event)
@@ -1240,12 +2240,104 @@ class ModelViewerWidget(tk.Frame):
                 self.mvw.forcezoom(-0.25)
 
         def get_voxel_value(self, x, y):
-            try:
-                if x < 0 or y < 0: raise IndexError()
-                val = self.data[y, x]
-                return str(val)
-            except IndexError:
+            """Values of every channel at slice pixel x, y"""
+            voxel = self.voxel_at(x, y)
+            if voxel is None:
                 return ""
+            return self.mvw.probe_voxel(voxel)
+
+        def voxel_at(self, x, y):
+            """Index into the displayed volume of slice pixel x, y"""
+            if self.data is None:
+                return None
+            h, w = self.data.shape[:2]
+            if not (0 <= x < w and 0 <= y < h):
+                return None
+            if self.axis == 0:
+                return (self.slice_index, y, x)
+            elif self.axis == 1:
+                return (y, self.slice_index, x)
+            else:
+                return (y, x, self.slice_index)
+
+    class HoverProbe():
+        """Voxel readout following the cursor on a view. The canvas
+        items are created once and moved around, and motion events are
+        coalesced so the readout refreshes at most once per frame"""
+
+        interval = 16  # ms, one frame of a 60Hz display
+
+        def __init__(self, canvas):
+            self.canvas = canvas
+            self.position = None
+            self.job = None
+            self.box = canvas.create_rectangle(0, 0, 0, 0,
+                                               fill="white",
+                                               state=tk.HIDDEN)
+            self.text = canvas.create_text(0, 0,
+                                           font=TAB_FONT,
+                                           justify=tk.LEFT,
+                                           state=tk.HIDDEN)
+            canvas.bind("<Leave>", self.hide, add="+")
+
+        def motion(self, event):
+            self.position = (event.x, event.y)
+            if self.job is None:
+                self.job = self.canvas.after(self.interval, self.refresh)
+
+        def refresh(self):
+            self.job = None
+            canvas, mvw = self.canvas, self.canvas.mvw
+            # only one view shows a readout at a time
+            if mvw.hover_view is not canvas:
+                if mvw.hover_view is not None:
+                    mvw.hover_view.probe.hide()
+                mvw.hover_view = canvas
+
+            x, y = self.position
+            strval = canvas.get_voxel_value(*canvas.canvas_to_image(x, y))
+            if not strval:
+                self.hide()
+                return
+
+            # get cursor quartile
+            v = 'n' if y < canvas.h/2 else 's'
+            h = 'w' if x < canvas.w/2 else 'e'
+            xm = 1 if h == 'w' else -1
+            ym = 1 if v == 'n' else -1
+            xc, yc = 4, 2
+            canvas.coords(self.text, x + (6+xc)*xm, y + (6+yc)*ym)
+            canvas.itemconfig(self.text, text=strval, anchor=v+h,
+                              state=tk.NORMAL)
+            textbbox = canvas.bbox(self.text)
+            canvas.coords(self.box,
+                          textbbox[0] - xc,
+                          textbbox[1] - yc,
+                          textbbox[2] + xc,
+                          textbbox[3] + yc)
+            canvas.itemconfig(self.box, state=tk.NORMAL)
+
+        def hide(self, *args):
+            if self.job is not None:
+                self.canvas.after_cancel(self.job)
+                self.job = None
+            self.canvas.itemconfig(self.box, state=tk.HIDDEN)
+            self.canvas.itemconfig(self.text, state=tk.HIDDEN)
+
+    def probe_voxel(self, voxel):
+        """Formats the value of every displayed channel at voxel"""
+        lines = []
+        for mode in TASKMODEL.modes:
+            data = self.display.get(mode)
+            if data is None:
+                continue
+            val = data[voxel]
+            if np.ndim(val) == 0:
+                txt = str(val)
+            else:
+                txt = " ".join(str(c) for c in val)
+            lines.append("{}: {}".format(mode.upper(), txt))
+        return "\n".join(lines)
 
     def draw_crosssection_lines(self, src_idx, src_maxindex, src_axis):
         a = 0
@@ -1255,21 +2347,60 @@ class ModelViewerWidget(tk.Frame):
                 v.draw_index_line(src_idx, src_maxindex, src_axis)
             a += 1
 
-    def push(self, data):
-        self.data = data
-        self.update_sliders()
+    def push(self, data, level=0):
+        self.display = data
+        self.level = level
+        self.generation += 1
+        if level == 0:
+            self.data = data
+            self.update_sliders()
         self.update_data_channel()
 
     def update_data_channel(self, *args):
         self.update_crosssections()
 
+    def memory_usage(self):
+        """Bytes held by rendered volumes, slicing copies and images"""
+        total = array_bytes(list(self.data.values()) +
+                            list(self.display.values()) +
+                            list(self.axis_copies.values()))
+        return total + sum(v.cache.nbytes for v in self.views)
+
+    def drop_caches(self):
+        """Frees slicing copies and cached images, rebuilt on demand"""
+        self.axis_copies = {}
+        self.axis_copies_key = None
+        for v in self.views:
+            v.cache.clear()
+
     @property
     def activedata(self):
         try:
-            return self.data[self.tabrow.tab]
+            return self.display[self.tabrow.tab]
         except KeyError:
             return None
 
+    def axis_data(self, axis):
+        """Active channel with the given axis moved first and laid out
+        contiguously, so every slice is a contiguous block of memory.
+        Copies are built lazily and only kept for the current render"""
+        activedata = self.activedata
+        if activedata is None:
+            return None
+        key = (self.generation, self.tabrow.tab, axis)
+        if key not in self.axis_copies:
+            if key[:2] != self.axis_copies_key:
+                self.axis_copies = {}
+                self.axis_copies_key = key[:2]
+            moved = np.moveaxis(activedata, axis, 0)
+            self.axis_copies[key] = np.ascontiguousarray(moved)
+        return self.axis_copies[key]
+
+    @property
+    def scale(self):
+        """Display pixels per voxel of the currently shown pyramid level"""
+        return 2 ** self.level
+
     def create_zoomslider(self, target_frame):
         width = target_frame.cget('width')
         self.zoomslider = self.Slider(target_frame, 'Zoom', "{0:.2f}x", False,
@@ -1278,6 +2409,17 @@ class ModelViewerWidget(tk.Frame):
                                       command=self.zoomslider_callback,
                                       value=1.0)
         self.zoomslider.pack()
+        self.fpslabel = tk.Label(target_frame, fg=MEDIUM_GREY)
+        self.fpslabel.pack(pady=(5, 0))
+        hover.createToolTip(self.fpslabel, "Slice scrubbing frame rate")
+
+    def frame_drawn(self, t):
+        """Records a scrubbing frame and reports the frame rate over
+        the last second"""
+        self.frame_times.append(t)
+        while self.frame_times[0] < t - 1:
+            self.frame_times.popleft()
+        self.fpslabel.config(text="{:d} fps".format(len(self.frame_times)))
 
     def zoomslider_callback(self, slider_float):
         self.zoomlvl = slider_float
@@ -1356,6 +2498,22 @@ class InformationWidget(tk.Frame):
         self.voxel_size = NiceEntry(self, "Voxel size (m)")
         self.voxel_size.grid(row=1, column=0)
 
+        self.budget = NiceEntry(self, "Memory budget (MB)")
+        self.budget.grid(row=0, column=0)
+        self.budget.text = str(MEMORY_BUDGET_MB)
+        hover.createToolTip(self.budget,
+                            "Caches are freed when memory use goes over this")
+        self.history = NiceEntry(self, "Undo memory (MB)")
+        self.history.grid(row=0, column=1)
+        self.history.text = str(HISTORY_MB)
+        hover.createToolTip(self.history,
+                            "The oldest changes are forgotten past this")
+        self.memory_label = tk.Label(self, anchor="sw", fg=MEDIUM_GREY)
+        self.memory_label.grid(row=0, column=2, columnspan=2, sticky="sew",
+                               padx=5, pady=3)
+        # shape the layers were last resized to
+        self.applied_shape = None
+
         palframe = tk.Frame(self)
         palframe.grid(row=0, column=4, sticky="ns")
         tk.Label(palframe,
@@ -1385,14 +2543,59 @@ class InformationWidget(tk.Frame):
         self.columnconfigure(4, weight=1)
 
     def update(self):
+        needed = APP.layersystem.resize_usage(get_shapes_dict())
+        if not APP.layersystem.confirm_memory(needed, "Resizing"):
+            return
+        old, new = self.applied_shape, self.get_shape()
+        self.resize(new)
+        if old is not None and old != new:
+            # sources are kept, so undoing is resampling again
+            APP.layersystem.record("Resize",
+                                   lambda: self.resize(old),
+                                   lambda: self.resize(new))
+
+    def resize(self, shape):
+        # set first, so set_shape doesn't record a step of its own
+        self.applied_shape = tuple(shape)
+        self.set_shape(shape)
         APP.layersystem.resize_all()
         APP.layersystem.render()
 
+    @property
+    def memory_budget(self):
+        """Budget in bytes"""
+        try:
+            mb = float(self.budget.text)
+        except ValueError:
+            mb = MEMORY_BUDGET_MB
+            self.budget.text = str(mb)
+        return int(mb * 2**20)
+
+    @property
+    def history_budget(self):
+        """Undo history cap in bytes"""
+        try:
+            mb = float(self.history.text)
+        except ValueError:
+            mb = HISTORY_MB
+            self.history.text = str(mb)
+        return int(mb * 2**20)
+
+    def show_memory(self, used, budget):
+        self.memory_label.config(text="Memory used: {} of {}".format(
+            format_bytes(used), format_bytes(budget)))
+
     def set_shape(self, shape):
+        old, self.applied_shape = self.applied_shape, tuple(shape)
         self.shape = shape
         self.axis0.text = str(self.shape[0])
         self.axis1.text = str(self.shape[1])
         self.axis2.text = str(self.shape[2])
+        if old is not None and old != self.applied_shape:
+            # only the entries, the data is undone by its own steps
+            APP.layersystem.record("Set shape",
+                                   lambda: self.set_shape(old),
+                                   lambda: self.set_shape(shape))
 
     def get_shape(self, *args):
         a = self.axis0.int_val
@@ -1432,7 +2635,7 @@ class TaskModel():
         self.options = {}
         self.mode_file_names = {}
         self.mode_file_paths = {}
-        self.screenshot = Image.new("RGB", (10, 10), "white")
+        self.screenshot = None
 
     def modelpath_to_datafolder(self, modelpath, name):
         return os.path.join(modelpath, self.zeros,
@@ -1475,27 +2678,75 @@ class TaskModel():
 
         return mode_file_names, mode_file_paths
 
-    def load_model(self, modelpath):
+    def load_model(self, modelpath, box=None):
+        """Loads a model folder as the only layer. Given a box, ((start,
+        stop),) * 3 along the axes of the layer data, only that part of
+        it is read"""
         _, name = os.path.split(modelpath)
         _, mode_file_paths = self.get_nrrd_files(modelpath)
-        data = self.load_data(mode_file_paths, name)
-        APP.layersystem.clear()
-        APP.layersystem.layer_from_data(data, name)
+        HISTORY.begin()
+        try:
+            data = self.load_data(mode_file_paths, name, box)
+            APP.layersystem.clear()
+            APP.layersystem.layer_from_data(data, name)
+        finally:
+            HISTORY.end("Load model")
+
+    def add_region(self, modelpath, box):
+        """Adds the part of a model folder inside box as a layer on top of
+        the stack, resampled to the current shape. The stack and export
+        options are kept"""
+        if not APP.layersystem.layers:
+            self.load_model(modelpath, box)
+            return
+        _, name = os.path.split(modelpath)
+        _, mode_file_paths = self.get_nrrd_files(modelpath)
+        data = {m: self.load_nrrd(path, m, box)[0]
+                for m, path in mode_file_paths.items()}
+        data['segment'] = np.log2(data['segment']).astype(np.uint8)
+        layer = APP.layersystem.Layer(APP.layersystem, data,
+                                      name + " region", "FILE")
+        for key, shape, order in layer.resample_targets(get_shapes_dict()):
+            newdata = resample_array(layer.get_source(key), shape, order)
+            layer.resampled[(key, shape)] = newdata
+            layer.set_channel(key, newdata)
+        APP.layersystem.add_layers([layer], "Add model region")
 
     def setup_template(self):
         (self.mode_file_names,
          self.mode_file_paths) = self.get_nrrd_files(self.template_path)
-        self.load_data(self.mode_file_paths, self.template_name)
+        self.load_options(self.mode_file_paths, self.template_name)
 
+    @perf.timed("export_model")
     def export_model(self, data, zip_path):
         # regenerate options
         name = os.path.splitext(os.path.basename(zip_path))[0]
         self.name = self.sanitise_name(name)
         self.update_options()
+        shapes = {m: data[m].shape for m in self.modes}
+        self.write_model(lambda modes: volume_slabs(data, modes), zip_path,
+                         self.name, shapes)
+
+    @perf.timed("export_stack")
+    def export_stack(self, zip_path):
+        """Exports the layer stack as a model zip, compositing and writing
+        it a slab at a time"""
+        name = os.path.splitext(os.path.basename(zip_path))[0]
+        self.name = self.sanitise_name(name)
+        self.update_options()
+        stack = APP.layersystem.fixed_stack()
+        self.write_model(
+            lambda modes: APP.layersystem.composite_slabs(stack, modes),
+            zip_path, self.name, keys=APP.layersystem.stack_keys(stack))
+
+    def write_model(self, make_slabs, zip_path, name, shapes=None,
+                    keys=None):
+        """Writes a model zip from slabs of its channels, see save_slabs.
+        Only reads the options, so several models can be written at once
+        from worker threads"""
         # create zip file
-        zip_file = zipfile.ZipFile(zip_path, "w")
-        # temp dir
-        with tempfile.TemporaryDirectory() as tempdir:
+        with zipfile.ZipFile(zip_path, "w") as zip_file, \
+                tempfile.TemporaryDirectory() as tempdir:
             # copy template to temp directory
             targetdir = os.path.join(tempdir, self.template_name)
             shutil.copytree(
@@ -1510,36 +2761,111 @@ class TaskModel():
             datafolder = self.modelpath_to_datafolder(modelpath,
                                                      self.template_name)
 
-            self.save_nrrds(data, datafolder)
+            self.save_slabs(make_slabs, datafolder, shapes=shapes, keys=keys)
 
             # rename and move to zip file
-            self.move_rename_template(modelpath, zip_file, self.name)
+            self.move_rename_template(modelpath, zip_file, name)
 
 
+    @perf.timed("save_nrrds")
     def save_nrrds(self, data, datafolder, in_subfolders = True):
-        # segment data as 16bit
-        temp = np.copy(data['segment']).astype(np.uint16)
-        seg_16 = np.power(2, temp)
-        data['segment'] = seg_16
-        # target nrrd files
+        shapes = {m: data[m].shape for m in self.modes}
+        self.save_slabs(lambda modes: volume_slabs(data, modes), datafolder,
+                        in_subfolders, shapes)
+
+    @perf.timed("save_slabs")
+    def save_slabs(self, make_slabs, datafolder, in_subfolders = True,
+                   shapes = None, keys = None):
+        """Writes the nrrd of every mode. make_slabs(modes) gives an
+        iterator of dicts holding consecutive slabs of the channels of
+        modes along the first axis, which are handed straight to an
+        encoding thread per mode. Channels have the current shape unless
+        shapes are given.
+
+        keys map modes to a key for the channel's content. Files encoded
+        before for the same key and options are copied, those modes are
+        not asked for"""
+        if shapes is None:
+            shapes = get_shapes_dict()
+        if keys is None:
+            keys = {}
+        targets, cachekeys = {}, {}
         for m in self.modes:
             # construct target nrrd file path
             if in_subfolders:
-                targetpath = os.path.join(datafolder,
+                targets[m] = os.path.join(datafolder,
                                           self.mode_folder_names[m],
                                           self.mode_file_names[m])
             else:
-                targetpath = os.path.join(datafolder,
+                targets[m] = os.path.join(datafolder,
                                           self.mode_file_names[m])
-            # transpose back
-            reshaped = self.reshape_data(data[m])
-            # write
-            nrrd.write(targetpath, reshaped, options = self.options[m])
-
-    def load_data(self, mode_file_paths, name):
+            if keys.get(m) is not None:
+                options = json.dumps(self.options[m], sort_keys=True,
+                                     default=str)
+                cachekeys[m] = hashlib.sha1(
+                    (keys[m] + m + options).encode()).hexdigest()
+        todo = [m for m in self.modes if not (
+            m in cachekeys and EXPORT_CACHE.fetch(cachekeys[m], targets[m]))]
+        perf.count("export_cache.hit", len(self.modes) - len(todo))
+        if not todo:
+            return
+        feeds = {m: queue.Queue(maxsize=1) for m in todo}
+
+        def feed(m):
+            while True:
+                slab = feeds[m].get()
+                if slab is None:
+                    return
+                yield slab
+
+        with ThreadPoolExecutor(max_workers=len(todo)) as pool:
+            jobs = {}
+            for m in todo:
+                # the writer fills in the options it is given
+                jobs[m] = pool.submit(self.write_nrrd, targets[m],
+                                      feed(m), shapes[m], m,
+                                      dict(self.options[m]))
+            try:
+                for slab in make_slabs(todo):
+                    for m in todo:
+                        put_while(feeds[m], slab[m], jobs[m])
+            finally:
+                for m in todo:
+                    put_while(feeds[m], None, jobs[m])
+            for job in jobs.values():
+                job.result()
+        for m in todo:
+            if m in cachekeys:
+                EXPORT_CACHE.store(cachekeys[m], targets[m])
+
+    def write_nrrd(self, target, slabs, shape, mode, options):
+        """Writes one channel of the given shape to a nrrd file or file
+        object, from slabs along its first axis. These are transposed back
+        and converted one at a time, the last nrrd axis being the first one
+        here. The type is that of the first slab, as the data's type is
+        with nrrd.write. Returns the gzip flush points, see
+        nrrd.write_slabs"""
+        def converted():
+            for slab in slabs:
+                slab = np.asarray(slab)
+                if mode == "segment":
+                    # segment data as 16bit
+                    slab = np.left_shift(1, slab, dtype=np.uint16)
+                yield self.reshape_data(slab)
+
+        out = converted()
+        first = next(out, None)
+        dtype = np.uint8 if first is None else first.dtype
+        if first is not None:
+            out = itertools.chain([first], out)
+        with perf.stage("nrrd.write", mode):
+            return nrrd.write_slabs(target, out, tuple(reversed(shape)),
+                                    dtype, options)
+
+    def load_data(self, mode_file_paths, name, box=None):
         data = {}
         for mode, path in mode_file_paths.items():
-            data[mode], self.options[mode] = self.load_nrrd(path, mode)
+            data[mode], self.options[mode] = self.load_nrrd(path, mode, box)
         data['segment'] = np.log2(data['segment']).astype(np.uint8)
         APP.main_iw.set_shape(data['iso'].shape)
         self.voxelsize = float(self.options['iso']['spacings'][1])
@@ -1547,13 +2873,35 @@ class TaskModel():
         self.name = name
         return data
 
-    def load_nrrd(self, file_path, mode):
+    def load_options(self, mode_file_paths, name):
+        """Like load_data, but only reads the nrrd headers"""
+        for mode, path in mode_file_paths.items():
+            self.options[mode] = read_nrrd_header(path)
+        # headers list sizes in reverse, as the data gets transposed
+        shape = tuple(reversed(self.options['iso']['sizes']))[:3]
+        APP.main_iw.set_shape(shape)
+        self.voxelsize = float(self.options['iso']['spacings'][1])
+        APP.main_iw.voxel_size.text = "{:.6f}".format(self.voxelsize)
+        self.name = name
+
+    def load_nrrd(self, file_path, mode, box=None):
         fixed_file_path = os.path.normpath(file_path)
-        readdata, options = nrrd.read(fixed_file_path)
+        with perf.stage("nrrd.read", mode):
+            if box is None:
+                readdata, options = nrrd.read(fixed_file_path)
+            else:
+                readdata, options = nrrd.read_region(
+                    fixed_file_path, self.nrrd_box(fixed_file_path, box))
         data = self.reshape_data(readdata)
 
         return data.astype(np.uint8), options
 
+    def nrrd_box(self, path, box):
+        """box along the axes of the layer data as a box in the nrrd at
+        path, whose axes are reversed and start with any channels"""
+        ndim = len(read_nrrd_header(path)["sizes"])
+        return [None] * (ndim - len(box)) + list(reversed(box))
+
     def reshape_data(self, data):
         """
         Checks data type and reshapes it into usable form
@@ -1598,10 +2946,10 @@ class TaskModel():
         for root, dirs, files in os.walk(folder):
             for fname in files:
                 full_path = os.path.join(root, fname)
-                os.chmod(full_path, stat.S_IWRITE)
+                os.chmod(full_path, os.stat(full_path).st_mode | stat.S_IWRITE)
             for dname in dirs:
                 full_path = os.path.join(root, dname)
-                os.chmod(full_path, stat.S_IWRITE)
+                os.chmod(full_path, os.stat(full_path).st_mode | stat.S_IWRITE)
 
     def sanitise_name(self, value):
         """
@@ -1622,6 +2970,7 @@ class TaskModel():
         newpath = os.path.join(parent, newfilename)
         shutil.move(filepath, newpath)
 
+    @perf.timed("move_rename_template")
     def move_rename_template(self, tempfolder, zip_file, newname):
 
         tn = self.template_name
@@ -1643,6 +2992,8 @@ class TaskModel():
 
         # replace screenshot
         sspath = self.modelpath_to_screenshot(tempfolder)
+        if self.screenshot is None:
+            self.screenshot = Image.new("RGB", (10, 10), "white")
         self.screenshot.save(sspath)
 
         # rename data folder
@@ -1651,11 +3002,12 @@ class TaskModel():
         shutil.move(datafolder, target)
 
         # move all files to zip file
-        for dirpath, dirs, files in os.walk(tempfolder):
-            for f in files:
-                fn = os.path.join(dirpath, f)
-                relname = os.path.relpath(fn, tempfolder)
-                zip_file.write(fn, relname)
+        with perf.stage("move_rename_template.zip"):
+            for dirpath, dirs, files in os.walk(tempfolder):
+                for f in files:
+                    fn = os.path.join(dirpath, f)
+                    relname = os.path.relpath(fn, tempfolder)
+                    zip_file.write(fn, relname)
 
 
     def replace_screenshot(self):
@@ -1671,9 +3023,39 @@ class TaskModel():
 
 
 
-def get_shapes_dict():
+def read_nrrd_header(path):
+    """
+    Reads the header of an nrrd file, using a cache kept across runs
+    which is keyed by the file's modification time and size
+    """
+    global HEADER_CACHE
+    if HEADER_CACHE is None:
+        try:
+            with open(HEADER_CACHE_PATH) as f:
+                HEADER_CACHE = json.load(f)
+        except (OSError, ValueError):
+            HEADER_CACHE = {}
+
+    path = os.path.normpath(os.path.abspath(path))
+    st = os.stat(path)
+    stamp = [st.st_mtime, st.st_size]
+    entry = HEADER_CACHE.get(path)
+    if entry is None or entry["stamp"] != stamp:
+        entry = {"stamp": stamp, "header": nrrd.read_header_only(path)}
+        HEADER_CACHE[path] = entry
+        try:
+            os.makedirs(os.path.dirname(HEADER_CACHE_PATH), exist_ok=True)
+            with open(HEADER_CACHE_PATH, 'w') as f:
+                json.dump(HEADER_CACHE, f)
+        except OSError as e:
+            print("Could not save header cache: {}".format(e))
+    # callers modify the options they are given
+    return copy.deepcopy(entry["header"])
+
+
+def get_shapes_dict(level=0):
     shapes = {k: None for k in TASKMODEL.modes}
-    shape = APP.main_iw.get_shape()
+    shape = level_shape(APP.main_iw.get_shape(), level)
     shapes['color'] = shape + (3,)
     shapes['density'] = shape + (1,)
     shapes['iso'] = shape
@@ -1681,9 +3063,89 @@ def get_shapes_dict():
     return shapes
 
 
-def gen_blank_data():
+def put_while(q, item, job):
+    """Puts item on q, giving up if job has finished, as nothing would
+    take it off"""
+    while True:
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            if job.done():
+                # raises whatever stopped it
+                job.result()
+                return
+
+
+def get_resample_pool():
+    global RESAMPLE_POOL
+    if RESAMPLE_POOL is None:
+        RESAMPLE_POOL = ThreadPoolExecutor(max_workers=os.cpu_count())
+    return RESAMPLE_POOL
+
+
+def resample_array(data, shape, order):
+    """Zooms data to shape, returns data unchanged if already that shape"""
+    if data.shape == tuple(shape):
+        return data
+    if constant.is_constant(data):
+        return data.resized(shape)
+    zoom = np.divide(shape, data.shape)
+    resampled = ndimage.zoom(data, zoom, order=order).astype(np.uint8)
+    if sparse.is_sparse(data):
+        return compact(resampled)
+    return resampled
+
+
+def array_bytes(arrays, seen=None):
+    """Combined size of the distinct arrays in arrays held in RAM, counting
+    compressed arrays by their compressed size and sparse volumes by what
+    they store. Anything else (including memory mapped arrays) is ignored.
+    Arrays whose ids are in seen are skipped and seen is updated, so one
+    set can be used to count a group of collections"""
+    if seen is None:
+        seen = set()
+    total = 0
+    for a in arrays:
+        a = sparse.unwrap(a)
+        if id(a) in seen:
+            continue
+        if isinstance(a, np.ndarray) and not SPILL_STORE.is_spilled(a):
+            seen.add(id(a))
+            total += a.nbytes
+        elif packed.is_compressed(a):
+            seen.add(id(a))
+            total += a.compressed_bytes
+    return total
+
+
+def format_bytes(n):
+    if n < 2**20:
+        return "{:.0f} kB".format(n / 2**10)
+    elif n < 2**30:
+        return "{:.1f} MB".format(n / 2**20)
+    return "{:.2f} GB".format(n / 2**30)
+
+
+def level_shape(shape, level):
+    """Shape of the spatial axes after downsampling to a pyramid level"""
+    f = 2 ** level
+    return tuple(-(-n // f) for n in shape)
+
+
+def downsample(data):
+    """Halves the resolution of the three spatial axes"""
+    # masks without data are the scalar 1
+    if np.ndim(data) == 0:
+        return data
+    if sparse.is_sparse(data) or constant.is_constant(data):
+        return data.downsample()
+    return np.ascontiguousarray(data[::2, ::2, ::2])
+
+
+def gen_blank_data(level=0):
     blank = {k: None for k in TASKMODEL.modes}
-    shapes = get_shapes_dict()
+    shapes = get_shapes_dict(level)
     blank['color'] = np.zeros(shapes['color'], dtype=np.uint8)
     blank['density'] = np.zeros(shapes['density'], dtype=np.uint8)
     blank['iso'] = np.zeros(shapes['iso'], dtype=np.uint8)
@@ -1692,9 +3154,159 @@ def gen_blank_data():
     return blank
 
 
+def blend(olddata, data, mask, comp, mode):
+    """Blends data onto olddata with mask already multiplied by opacity,
+    all three covering the same region. data and mask may also be values
+    that broadcast over it"""
+    # apply mask to layer data, in multiply case we invert
+    if comp == "MULTIPLY":
+        newdata = np.multiply(np.subtract(255, data),
+                              mask).astype(np.uint8)
+    else:
+        newdata = np.multiply(data, mask).astype(np.uint8)
+
+    if mode != "segment":
+        if comp == "REPLACE":
+            if newdata.ndim == 4 and mode == 'iso':
+                newdata = newdata[:, :, :, 0]
+            if np.ndim(mask) == 0 and mask == 1:
+                # fully opaque, none of the old data shows through
+                output = newdata
+            else:
+                # REPLACE data, old data shown where mask < 1
+                output = (newdata +
+                          np.multiply(olddata, (1-mask))).astype(np.uint8)
+
+        elif comp == "ADD":
+            # ADD layer data, clipping old data so the sum cannot overflow
+            diff = 255 - newdata  # a temp uint8 array here
+            output = np.add(
+                            np.minimum(olddata, diff),
+                            newdata)
+        elif comp == "MULTIPLY":
+
+            # MULTIPLY layer data
+            output = np.subtract(olddata, np.multiply(newdata/255,
+                                 olddata)).astype(np.uint8)
+        # if disabled, do nothing
+    elif mode == "segment":
+        # special settings for segment
+        if comp == "REPLACE":
+            output = newdata
+        elif comp == "SMART":
+            # where there is no new data, use previous data
+            output = np.where(newdata == 0, olddata, newdata)
+    else:
+        Exception("Unknown mode recieved")
+
+    if output.shape != olddata.shape:
+        # constant data with a scalar mask blends to a single value
+        full = np.empty_like(olddata)
+        full[...] = output
+        output = full
+    return output
+
+
+def compact(data):
+    """Keeps data as a single value if it is the same everywhere, or as
+    its bounding box if it is mostly empty. Box starts are aligned so the
+    box downsamples onto the pyramid grid"""
+    data = constant.constant_of(data)
+    return sparse.sparsify(data, align=2**PYRAMID_LEVELS)
+
+
+class FixedSetting():
+    """Holds a value behind the get() of a Tk variable"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+class FixedLayer():
+    """Layer with its blend settings read once and then fixed, with some
+    replaced by settings, a dict mapping ("blend" or "opacity", mode) to
+    a value. ("assign", "segment") moves every voxel in a segment to the
+    segment given. No Tk variables are read after, so it can be composited
+    on any thread. Given a window (start, stop), only those slices along
+    the first axis of its data are seen"""
+
+    def __init__(self, layer, settings, window=None):
+        self.layer = layer
+        self.window = window
+        self.segment = settings.get(("assign", "segment"))
+        if isinstance(layer, FixedLayer):
+            composites = {m: v.get() for m, v in layer.composites.items()}
+            opacities = {m: v.get() for m, v in layer.opacities.items()}
+        else:
+            composites, opacities = layer.get_params()
+        for (setting, mode), value in settings.items():
+            if setting == "blend":
+                composites[mode] = value
+            elif setting == "opacity":
+                opacities[mode] = value
+        self.composites = {m: FixedSetting(v) for m, v in composites.items()}
+        self.opacities = {m: FixedSetting(v) for m, v in opacities.items()}
+
+    def get_level(self, key, level):
+        data = self.layer.get_level(key, level)
+        if self.window is not None:
+            data = slab_of(data, *self.window)
+        if key == "segment" and self.segment is not None:
+            data = assign_segment(data, self.segment)
+        return data
+
+
+def assign_segment(data, segment):
+    """data with every voxel in a segment, so above zero, moved to
+    segment. Sparse and constant volumes are kept as they are, scalars
+    and missing data are returned as they are"""
+    if np.ndim(data) == 0:
+        return data
+    return sparse.apply(
+        data, lambda d: np.minimum(d, 1) * np.uint8(segment))
+
+
+def slab_ranges(shapes, nbytes=None):
+    """(start, stop) slices along the first axis, each slab of all the
+    channels of the given shapes taking about nbytes"""
+    if nbytes is None:
+        nbytes = EXPORT_SLAB_BYTES
+    per_slice = sum(int(np.prod(s[1:])) for s in shapes.values())
+    step = max(1, nbytes // max(1, per_slice))
+    length = list(shapes.values())[0][0]
+    return [(start, min(start + step, length))
+            for start in range(0, length, step)]
+
+
+def slab_of(data, start, stop):
+    """Slices start:stop along the first axis, keeping sparse and constant
+    volumes as they are. Scalars are returned as they are"""
+    if np.ndim(data) == 0:
+        return data
+    if sparse.is_sparse(data):
+        return sparse.window(data, start, stop)
+    if constant.is_constant(data):
+        return data.resized((stop - start,) + data.shape[1:])
+    return data[start:stop]
+
+
+def volume_slabs(data, modes=None):
+    """Dicts of slabs along the first axis of the volumes in data, only
+    of modes if given"""
+    if modes is None:
+        modes = list(data)
+    shapes = {m: data[m].shape for m in modes}
+    for start, stop in slab_ranges(shapes):
+        yield {m: data[m][start:stop] for m in modes}
+
+
 def data3d_to_mode(mode, data):
     if mode == "color":
-        return np.repeat(data[:, :, :, np.newaxis], 3, 3)
+        # broadcasts over the rgb channels, without a copy per channel
+        return data[:, :, :, np.newaxis]
     elif mode == "density" or mode == "segment":
         return data[:, :, :, np.newaxis]
     elif mode == "iso":
@@ -1714,17 +3326,23 @@ def load_layers_json():
         with open(file_path) as f:
             input_dict = json.load(f)
 
-        APP.layersystem.clear()
-        APP.main_iw.set_shape(input_dict["shape"])
-        APP.main_iw.voxel_size.text = input_dict["spacing"]
-        APP.layersystem.layers_from_dictlist(input_dict["layers"])
+        HISTORY.begin()
+        try:
+            APP.layersystem.clear()
+            APP.main_iw.set_shape(input_dict["shape"])
+            APP.main_iw.voxel_size.text = input_dict["spacing"]
+            APP.layersystem.layers_from_dictlist(input_dict["layers"])
+        finally:
+            HISTORY.end("Load layers")
         
 
 
-def load_model_zip():
+def load_model_zip(raw_file_path=None):
     initial = os.path.join(CURRDIR, "models")
     filetypes = [('Compressed zip folder', '*.zip')]
-    raw_file_path = filedialog.askopenfilename(initialdir=initial,
+    if raw_file_path is None:
+        raw_file_path = filedialog.askopenfilename(
+                                               initialdir=initial,
                                                title = "Load model .zip",
                                                parent = APP,
                                                defaultextension = '.zip',
@@ -1748,9 +3366,11 @@ def load_model_zip():
 
 
 
-def load_model_folder():
+def load_model_folder(raw_file_path=None):
     initial = os.path.join(CURRDIR, "models")
-    raw_file_path = filedialog.askdirectory(initialdir=initial,
+    if raw_file_path is None:
+        raw_file_path = filedialog.askdirectory(
+                                            initialdir=initial,
                                             title = "Load model folder",
                                             parent = APP)
     file_path = os.path.normpath(raw_file_path)
@@ -1760,6 +3380,145 @@ def load_model_folder():
         except FileNotFoundError:
             messagebox.showinfo("Error", "Invalid folder")
 
+def launch_region(raw_file_path=None):
+    """Dialog loading part of a model folder, previewing slices of its
+    colour channel. Only the slices and the part asked for are read. The
+    part either replaces the stack as a model, or is added to it as a
+    layer"""
+    if raw_file_path is None:
+        raw_file_path = filedialog.askdirectory(
+            initialdir=os.path.join(CURRDIR, "models"),
+            title="Load model region", parent=APP)
+    if not raw_file_path:
+        return
+    modelpath = os.path.normpath(raw_file_path)
+    try:
+        _, paths = TASKMODEL.get_nrrd_files(modelpath)
+    except FileNotFoundError:
+        messagebox.showinfo("Error", "Invalid folder")
+        return
+    shape = tuple(reversed(read_nrrd_header(paths["iso"])["sizes"]))
+
+    window = tk.Toplevel(APP)
+    window.wm_title("Load model region")
+    boxframe = tk.Frame(window)
+    boxframe.pack(fill=tk.X, padx=5, pady=5)
+    for col, text in enumerate(["Axis", "Start", "Stop"]):
+        tk.Label(boxframe, text=text, anchor="w").grid(row=0, column=col,
+                                                      sticky="w")
+    boxvars = []
+    for axis, n in enumerate(shape):
+        tk.Label(boxframe, text="xyz"[axis]).grid(row=axis + 1, column=0)
+        startvar, stopvar = tk.IntVar(value=0), tk.IntVar(value=n)
+        for col, var in ((1, startvar), (2, stopvar)):
+            ttk.Entry(boxframe, textvariable=var,
+                      width=8).grid(row=axis + 1, column=col)
+        boxvars.append((startvar, stopvar))
+    preview = tk.Label(window)
+    preview.pack(padx=5, pady=5)
+    slicevar = tk.IntVar(value=shape[2] // 2)
+    ttk.Scale(window, from_=0, to=shape[2] - 1, variable=slicevar,
+              orient=tk.HORIZONTAL,
+              command=lambda _: show_slice()).pack(fill=tk.X, padx=5)
+
+    def get_box():
+        box = tuple((v0.get(), v1.get()) for v0, v1 in boxvars)
+        for (start, stop), n in zip(box, shape):
+            if not 0 <= start < stop <= n:
+                raise ValueError("Region must lie within {}".format(shape))
+        return box
+
+    def show_slice():
+        try:
+            box = get_box()
+        except (ValueError, tk.TclError) as e:
+            show_error(e)
+            return
+        z = int(slicevar.get())
+        box = box[:2] + ((z, z + 1),)
+        data, _ = nrrd.read_region(paths["color"],
+                                   TASKMODEL.nrrd_box(paths["color"], box))
+        # rows of the image along y
+        rgb = TASKMODEL.reshape_data(data)[:, :, 0].transpose(1, 0, 2)
+        img = Image.fromarray(np.ascontiguousarray(rgb, np.uint8), "RGB")
+        img.thumbnail((256, 256), Image.NEAREST)
+        preview.image = ImageTk.PhotoImage(img)
+        preview.configure(image=preview.image)
+
+    def load(add):
+        try:
+            box = get_box()
+        except (ValueError, tk.TclError) as e:
+            show_error(e)
+            return
+        window.destroy()
+        if add:
+            TASKMODEL.add_region(modelpath, box)
+        else:
+            TASKMODEL.load_model(modelpath, box)
+
+    buttons = tk.Frame(window)
+    buttons.pack(fill=tk.X, padx=5, pady=5)
+    ttk.Button(buttons, text="Preview", command=show_slice).pack(
+        side=tk.LEFT)
+    ttk.Button(buttons, text="Add as layer",
+               command=lambda: load(True)).pack(side=tk.RIGHT)
+    ttk.Button(buttons, text="Load as model",
+               command=lambda: load(False)).pack(side=tk.RIGHT)
+    show_slice()
+
+
+def launch_library():
+    """Lists every model in the models and output folders. Details come
+    from the library index, so only new or changed models are opened"""
+    global MODEL_LIBRARY
+    if MODEL_LIBRARY is None:
+        MODEL_LIBRARY = ModelLibrary(LIBRARY_PATH)
+    entries = MODEL_LIBRARY.refresh(LIBRARY_FOLDERS)
+
+    window = tk.Toplevel(APP)
+    window.wm_title("Model library")
+    window.geometry("520x480")
+    frame = VerticalScrolledFrame(window)
+    frame.pack(fill=tk.BOTH, expand=tk.YES)
+    frame.interior.grid_columnconfigure(1, weight=1)
+    # photo images have to be kept alive by us
+    window.thumbnails = []
+
+    def load(entry):
+        window.destroy()
+        if entry["path"].lower().endswith('.zip'):
+            load_model_zip(entry["path"])
+        else:
+            load_model_folder(entry["path"])
+
+    row = 0
+    for e in entries:
+        if e["thumbnail"]:
+            thumb = tk.PhotoImage(data=e["thumbnail"])
+            window.thumbnails.append(thumb)
+            tk.Label(frame.interior, image=thumb).grid(row=row, column=0,
+                                                       rowspan=2, pady=2)
+        tk.Label(frame.interior,
+                 text=e["name"],
+                 font=TAB_FONT,
+                 anchor="w").grid(row=row, column=1, sticky="ew", padx=5)
+        info = "{} voxels, {} m, {:.1f} MB, segments {}".format(
+            "x".join(str(n) for n in e["shape"]),
+            e["spacing"],
+            e["size"] / 2**20,
+            ", ".join(str(n) for n in e["segments"]))
+        tk.Label(frame.interior,
+                 text=info,
+                 fg=MEDIUM_GREY,
+                 anchor="w").grid(row=row+1, column=1, sticky="ew", padx=5)
+        ttk.Button(frame.interior,
+                   text="Load",
+                   command=lambda x=e: load(x)).grid(row=row, column=2,
+                                                     rowspan=2, padx=5)
+        row += 2
+
+
 def save_layers_json():
     indir = os.path.join(CURRDIR, "layers")
     defaultname = TASKMODEL.gen_date_name()
@@ -1791,8 +3550,13 @@ def export_nrrds():
         full_path = os.path.join(file_path, defaultname)
         if not os.path.exists(full_path):
             os.makedirs(full_path)
-        data = copy.deepcopy(APP.main_mvw.data)
-        TASKMODEL.save_nrrds(data, full_path, in_subfolders = False)
+        # composited from the layers a slab at a time, so exports are at
+        # full resolution whatever is on screen
+        stack = APP.layersystem.fixed_stack()
+        TASKMODEL.save_slabs(
+            lambda modes: APP.layersystem.composite_slabs(stack, modes),
+            full_path, in_subfolders = False,
+            keys = APP.layersystem.stack_keys(stack))
 
 def export_model_folder():
     indir = os.path.join(CURRDIR, "output")
@@ -1806,12 +3570,116 @@ def export_model_folder():
                                                  parent = APP)
     if raw_file_path:
         file_path = os.path.normpath(raw_file_path)
-        TASKMODEL.export_model(copy.deepcopy(APP.main_mvw.data), file_path)
+        # the screenshot is taken from the views
+        APP.layersystem.flush_render()
+        TASKMODEL.export_stack(file_path)
         
 
+def launch_variants():
+    """Dialog setting up a sweep over layer settings, exported as one
+    model zip per combination"""
+    layers = [l for l in APP.layersystem.layers
+              if type(l) == APP.layersystem.Layer]
+    if not layers:
+        messagebox.showinfo("Export variants", "No layers to vary",
+                            parent=APP)
+        return
+    names = ["{}: {}".format(APP.layersystem.layers.index(l),
+                             l.layer_name_var.get()) for l in layers]
+    settings = (["opacity " + m for m in TASKMODEL.compmodes] +
+                ["blend " + m for m in TASKMODEL.modes] +
+                ["assign segment"])
+
+    window = tk.Toplevel(APP)
+    window.wm_title("Export variants")
+    rowsframe = tk.Frame(window)
+    rowsframe.pack(fill=tk.BOTH, padx=5, pady=5)
+    for col, text in enumerate(["Layer", "Setting",
+                                "Values (comma separated)"]):
+        tk.Label(rowsframe, text=text, anchor="w").grid(row=0, column=col,
+                                                       sticky="w")
+    rows = []
+
+    def add_row():
+        layervar, settingvar, valuesvar = (tk.StringVar(), tk.StringVar(),
+                                           tk.StringVar())
+        r = len(rows) + 1
+        ttk.OptionMenu(rowsframe, layervar, names[-1],
+                       *names).grid(row=r, column=0, sticky="ew")
+        ttk.OptionMenu(rowsframe, settingvar, settings[0],
+                       *settings).grid(row=r, column=1, sticky="ew")
+        ttk.Entry(rowsframe, textvariable=valuesvar,
+                  width=30).grid(row=r, column=2, sticky="ew")
+        rows.append((layervar, settingvar, valuesvar))
+
+    def parse(layervar, settingvar, valuesvar):
+        layer = layers[names.index(layervar.get())]
+        setting, mode = settingvar.get().split(" ")
+        values = [v.strip() for v in valuesvar.get().split(",")
+                  if v.strip()]
+        if setting == "opacity":
+            values = [min(max(float(v), 0), 1) for v in values]
+        elif setting == "assign":
+            # the segments seg_mod steps through
+            values = [int(v) for v in values]
+            for v in values:
+                if not 1 <= v <= 15:
+                    raise ValueError("Segment {} is not within 1 to "
+                                     "15".format(v))
+        else:
+            allowed = (layer.segment_functions if mode == "segment"
+                       else layer.comp_functions)[1:]
+            values = [v.upper() for v in values]
+            for v in values:
+                if v not in allowed:
+                    raise ValueError("{} is not one of {}".format(
+                        v, ", ".join(allowed)))
+        return (layer, setting, mode, values)
+
+    def export():
+        try:
+            sweeps = [parse(*r) for r in rows if r[2].get().strip()]
+            count = len(APP.layersystem.variants(sweeps)) if sweeps else 0
+        except ValueError as e:
+            show_error(e)
+            return
+        if not sweeps:
+            return
+        folder = filedialog.askdirectory(
+            title="Select folder for {} variants".format(count),
+            initialdir=os.path.join(CURRDIR, "output"),
+            parent=window)
+        if folder:
+            window.destroy()
+            APP.config(cursor="watch")
+            APP.update_idletasks()
+            try:
+                APP.layersystem.export_variants(sweeps,
+                                                os.path.normpath(folder),
+                                                TASKMODEL.gen_date_name())
+            finally:
+                APP.config(cursor="")
+
+    add_row()
+    tk.Label(window, anchor="w", justify=tk.LEFT,
+             text="Every combination is exported as a model zip. The "
+                  "program does not respond\nuntil all of them are "
+                  "written, which takes a while for many variants.").pack(
+        fill=tk.X, padx=5)
+    buttons = tk.Frame(window)
+    buttons.pack(fill=tk.X, padx=5, pady=5)
+    ttk.Button(buttons, text="Add setting", command=add_row).pack(
+        side=tk.LEFT)
+    ttk.Button(buttons, text="Export", command=export).pack(side=tk.RIGHT)
+
+
 def new_model():
-    TASKMODEL.setup_template()
-    APP.layersystem.clear()
+    HISTORY.begin()
+    try:
+        TASKMODEL.setup_template()
+        APP.layersystem.clear()
+    finally:
+        HISTORY.end("New model")
 
 
 class NiceEntry(tk.Frame):
@@ -1899,11 +3767,22 @@ def donothing():
     print("Not yet implemented")
 
 
+def undo(*args):
+    if HISTORY.undo() is not None:
+        APP.layersystem.update_memory()
+
+
+def redo(*args):
+    if HISTORY.redo() is not None:
+        APP.layersystem.update_memory()
+
+
 def export_image(scale):
     ttl = "Select folder to save images in"
     raw_file_path = filedialog.askdirectory(title = ttl, parent = APP)
     file_path = os.path.normpath(raw_file_path)
     if file_path:
+        APP.layersystem.flush_render()
         for image, name in APP.main_mvw.get_images():
             w, h = image.size
             new_w = w * scale
@@ -1922,6 +3801,52 @@ def launch_about():
     messagebox.showinfo("About", '\n'.join(message))
 
 
+def launch_perf():
+    """Shows the stage timings recorded while renders and exports run.
+    Recording is switched on from here and stays on after closing"""
+    window = tk.Toplevel(APP)
+    window.wm_title("Performance")
+    window.geometry("620x420")
+    controls = tk.Frame(window)
+    controls.pack(fill=tk.X, padx=5, pady=5)
+    enabled = tk.BooleanVar()
+    enabled.set(perf.ENABLED)
+
+    def save():
+        raw_file_path = filedialog.asksaveasfilename(
+            title="Save performance report",
+            parent=window,
+            defaultextension=".json",
+            filetypes=(("JSON", "*.json"), ("Text", "*.txt")))
+        if raw_file_path:
+            if raw_file_path.lower().endswith(".txt"):
+                with open(raw_file_path, "w") as f:
+                    f.write(perf.report())
+            else:
+                perf.dump(raw_file_path)
+
+    ttk.Checkbutton(controls,
+                    text="Record timings",
+                    variable=enabled,
+                    command=lambda: perf.enable(enabled.get())).pack(
+                        side=tk.LEFT)
+    ttk.Button(controls, text="Reset", command=perf.reset).pack(
+        side=tk.LEFT, padx=5)
+    ttk.Button(controls, text="Save report", command=save).pack(
+        side=tk.LEFT)
+    text = tk.Text(window, font="TkFixedFont", wrap=tk.NONE)
+    text.pack(fill=tk.BOTH, expand=tk.YES)
+
+    def refresh():
+        if not window.winfo_exists():
+            return
+        text.delete("1.0", tk.END)
+        text.insert(tk.END, perf.report())
+        window.after(PERF_REFRESH, refresh)
+
+    refresh()
+
+
 def launch_todo():
     message = ["Click to move slice lines",
                "More blend modes",
@@ -1941,18 +3866,52 @@ def show_error(e):
     messagebox.showinfo("Error", e)
 
 
+def report_startup():
+    """Records how long it took from launch until the window was shown,
+    for the performance panel and dumps"""
+    perf.record("startup", time.perf_counter() - START_TIME)
+
+
+def start_autosave():
+    """Offers to recover the session left in the journal by a crash, then
+    starts a new journal"""
+    global AUTOSAVE
+    try:
+        found = journal.recover(AUTOSAVE_PATH)
+    except Exception as e:
+        print("Could not read autosave: {}".format(e))
+        found = None
+    if found is not None:
+        message = ("The last session did not close properly.\n\n"
+                   "Recover its layers?")
+        if messagebox.askyesno("Recover session", message, parent=APP):
+            APP.layersystem.recover(*found)
+    AUTOSAVE = journal.Journal(AUTOSAVE_PATH)
+    APP.layersystem.autosave()
+
+
 def create_shortcuts():
     APP.bind('<Control-Tab>', APP.main_mvw.tabrow.cycle)
+    APP.bind('<Control-z>', undo)
+    APP.bind('<Control-y>', redo)
 
 
 def main():
     global TASKMODEL, APP, APP_NAME
     APP_NAME = "Simodont model builder"
+    # scratch files of a session that crashed
+    SPILL_STORE.remove_stale()
+    EXPORT_CACHE.remove_stale()
     TASKMODEL = TaskModel()
     APP = App(APP_NAME)
     create_shortcuts()
-    new_model()
+    APP.after(0, report_startup)
+    APP.after_idle(new_model)
+    APP.after_idle(start_autosave)
     APP.mainloop()
+    # closed normally, nothing to recover next time
+    if AUTOSAVE is not None:
+        AUTOSAVE.close()
 
 
 if __name__ == "__main__":